@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
 import sys
 import ast
+import os.path
 import pandas as pd
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, jsonify, request
 from flasgger import Swagger
 from flasgger.utils import swag_from
-from string import capwords
 
 from resources import constants
-from utils import api_utils, data_utils
+from utils import api_utils, cache_utils, dataset_utils, index_utils
+from utils.response_utils import cache_response, get_export_format, send_data_file, send_table
 
 
 SWAGGER_CONFIG = {
@@ -126,10 +127,25 @@ def get_funding_categories(country):
     return jsonify(metadata=metadata, data=result, params={"country": country})
 
 
+def send_tabular_data(result, file_name, **fields):
+    """
+    Helper function for tabular endpoints, responding with the result dataframe as json (in the list orientation) along
+    with the other fields (e.g. metadata and params), or streamed as csv or ndjson (named after file_name) if requested
+    with the format query arg.
+    """
+    try:
+        export_format = get_export_format()
+    except ValueError as e:
+        return 'Error: {}'.format(e), 400
+    if export_format:
+        return send_table(result, file_name, export_format)
+    return jsonify(data=result.to_dict(orient='list'), **fields)
+
+
 def get_funding_by_fts_dimension(country, fts_dimension):
     """
     Helper function for FTS funding endpoints.
-    Returns whether data retrieval was successful (or http errorcode if not), and the resulting json data (or error message if not).
+    Returns whether data retrieval was successful (or http errorcode if not), and the resulting dataframe (or error message if not).
     """
     country = country.strip().capitalize()
     fts_donors_file = 'fts-{}.csv'.format(fts_dimension)
@@ -139,7 +155,7 @@ def get_funding_by_fts_dimension(country, fts_dimension):
     result.drop(constants.COUNTRY_COL, axis=1, inplace=True)
     contact = api_utils.load_metadata('/funding/{}/:country'.format(fts_dimension), 'contact', literal=True)
     metadata['contact'] = contact
-    return success, result.to_dict(orient='list'), metadata
+    return success, result, metadata
 
 
 @app.route('/funding/donors/<string:country>/', methods=['GET'])
@@ -149,7 +165,7 @@ def get_funding_donors(country):
     success, result, metadata = get_funding_by_fts_dimension(country, 'donors')
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country})
+    return send_tabular_data(result, 'fts_donors_{}'.format(country.lower()), metadata=metadata, params={"country": country})
 
 
 @app.route('/funding/clusters/<string:country>/', methods=['GET'])
@@ -159,7 +175,7 @@ def get_funding_clusters(country):
     success, result, metadata = get_funding_by_fts_dimension(country, 'clusters')
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country})
+    return send_tabular_data(result, 'fts_clusters_{}'.format(country.lower()), metadata=metadata, params={"country": country})
 
 
 @app.route('/funding/recipients/<string:country>/', methods=['GET'])
@@ -169,7 +185,7 @@ def get_funding_recipients(country):
     success, result, metadata = get_funding_by_fts_dimension(country, 'recipients')
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country})
+    return send_tabular_data(result, 'fts_recipients_{}'.format(country.lower()), metadata=metadata, params={"country": country})
 
 
 @app.route('/needs/totals/<string:country>/', methods=['GET'])
@@ -232,7 +248,7 @@ def get_needs_regions(country):
 def get_needs_assessment_by_type(country='Nigeria', state='Borno', dtm_assessment_type='baseline'):
     """
     Helper function for DTM needs assessment endpoints.
-    Returns whether data retrieval was successful (or http errorcode if not), and the resulting json data (or error message if not).
+    Returns whether data retrieval was successful (or http errorcode if not), and the resulting dataframe (or error message if not).
     """
     country = country.strip().capitalize()
     if country != 'Nigeria':
@@ -243,7 +259,6 @@ def get_needs_assessment_by_type(country='Nigeria', state='Borno', dtm_assessmen
     if not success:
         return 501, result
     result.drop(state_col, axis=1, inplace=True)
-    result = result.to_dict(orient='list')
     contact = api_utils.load_metadata('/needs/assessment/{}/:country'.format(dtm_assessment_type), 'contact', literal=True)
     metadata['contact'] = contact
     return success, result, metadata
@@ -259,7 +274,8 @@ def get_needs_assessment_site(country):
     success, result, metadata = get_needs_assessment_by_type(country, state, dtm_assessment_type)
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country, "state": state})
+    file_name = 'dtm_{}_{}_{}'.format(dtm_assessment_type, country.lower(), state.lower())
+    return send_tabular_data(result, file_name, metadata=metadata, params={"country": country, "state": state})
 
 
 @app.route('/needs/assessment/location/<string:country>/', methods=['GET'])
@@ -272,7 +288,8 @@ def get_needs_assessment_location(country):
     success, result, metadata = get_needs_assessment_by_type(country, state, dtm_assessment_type)
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country, "state": state})
+    file_name = 'dtm_{}_{}_{}'.format(dtm_assessment_type, country.lower(), state.lower())
+    return send_tabular_data(result, file_name, metadata=metadata, params={"country": country, "state": state})
 
 
 @app.route('/needs/assessment/baseline/<string:country>/', methods=['GET'])
@@ -285,94 +302,61 @@ def get_needs_assessment_baseline(country):
     success, result, metadata = get_needs_assessment_by_type(country, state, dtm_assessment_type)
     if not success or success == 501:
         return result, 501
-    return jsonify(metadata=metadata, data=result, params={"country": country, "state": state})
+    file_name = 'dtm_{}_{}_{}'.format(dtm_assessment_type, country.lower(), state.lower())
+    return send_tabular_data(result, file_name, metadata=metadata, params={"country": country, "state": state})
 
 
 @app.route('/indicators/gni/<string:orientation>', methods=['GET'])
+@cache_response('gni_per_capita.csv')
 @swag_from('api_configs/world/indicators_gni.yml')
 def get_indicators_gni(orientation):
-    params = None
-    success, result, metadata = api_utils.safely_load_data('gni_per_capita.csv', 'GNI PPP indicator', has_metadata=True)
-    if not success:
-        return result, 501
     country = request.args.get('country', None)
     country_code = request.args.get('country_code', None)
-    if country_code:
-        params = {"country_code": country_code}
-        country_code = capwords(str(country_code).strip())
-        result = data_utils.fuzzy_filter(result, 'Country Code', country_code)
-    elif country:
-        params = {"country": country}
-        country = str(country).strip().capitalize()
-        result = data_utils.fuzzy_filter(result, 'Country Name', country)
-    result = result[['Country Name', 'Country Code', '2011', '2012', '2013', '2014', '2015']]  # No data after 2015
-    if orientation == 'index':
-        result = result.set_index('Country Code')
-    result = result.to_dict(orient=orientation)
+    success, result, metadata = dataset_utils.get_indicators_gni(orientation, country, country_code)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result)
 
 
 @app.route('/populations/refugeelike/asylum/<string:orientation>', methods=['GET'])
+@cache_response(constants.UNHCR_FILE_NAMES['asylum_country'], 'metadata.csv')
 @swag_from('api_configs/world/populations_refugeelike_asylum.yml')
 def get_populations_refugeelike_asylum(orientation):
     params = None
-    data_path = constants.UNHCR_FILE_NAMES['asylum_country']
-    success, result, metadata = api_utils.safely_load_data(data_path, 'UNHCR refugee-like populations by asylum country', has_metadata=True)
-    if not success:
-        return result, 501
     country = request.args.get('country', None)
     if country:
         params = {"country": country}
-        country = str(country).strip().capitalize()
-        result = data_utils.fuzzy_filter(result, constants.COUNTRY_COL, country)
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
-    contact = api_utils.load_metadata('/populations/refugeelike/asylum', 'contact', literal=True)
-    metadata['contact'] = contact
+    success, result, metadata = dataset_utils.get_populations_refugeelike('asylum', orientation, country)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
 @app.route('/populations/refugeelike/origin/<string:orientation>', methods=['GET'])
+@cache_response(constants.UNHCR_FILE_NAMES['origin_country'], 'metadata.csv')
 @swag_from('api_configs/world/populations_refugeelike_origin.yml')
 def get_populations_refugeelike_origin(orientation):
     params = None
-    data_path = constants.UNHCR_FILE_NAMES['origin_country']
-    success, result, metadata = api_utils.safely_load_data(data_path, 'UNHCR refugee-like populations by origin country', has_metadata=True)
-    if not success:
-        return result, 501
     country = request.args.get('country', None)
     if country:
         params = {"country": country}
-        country = str(country).strip().capitalize()
-        result = data_utils.fuzzy_filter(result, constants.COUNTRY_COL, country)
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
-    contact = api_utils.load_metadata('/populations/refugeelike/origin', 'contact', literal=True)
-    metadata['contact'] = contact
+    success, result, metadata = dataset_utils.get_populations_refugeelike('origin', orientation, country)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
 @app.route('/populations/totals/<string:orientation>', methods=['GET'])
+@cache_response(constants.ESA_FILE_NAMES['wpp_overall'], 'metadata.csv')
 @swag_from('api_configs/world/populations_totals.yml')
 def get_populations_totals(orientation):
     params = None
-    data_path = constants.ESA_FILE_NAMES['wpp_overall']
-    success, result, metadata = api_utils.safely_load_data(data_path, 'UN ESA WPP world populations', has_metadata=True)
-    if not success:
-        return result, 501
-    result = result[result['Year'] > 2014]  # The latest official statistics are from 2015, followed by projections into 2017
     country = request.args.get('country', None)
     if country:
         params = {"country": country}
-        country = str(country).strip().capitalize()
-        result = data_utils.fuzzy_filter(result, constants.COUNTRY_COL, country)
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
-    contact = api_utils.load_metadata('/populations/totals', 'contact', literal=True)
-    metadata['contact'] = contact
+    success, result, metadata = dataset_utils.get_populations_totals(orientation, country)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
@@ -380,17 +364,12 @@ def get_populations_totals(orientation):
 @swag_from('api_configs/world/funding_progress.yml')
 def get_funding_progress(orientation):
     params = None
-    success, result, metadata = api_utils.safely_load_data('funding_progress.csv', 'FTS funding progress by country appeal', has_metadata=True)
-    if not success:
-        return result, 501
     countryCode = request.args.get('countryCode', None)
     if countryCode:
         params = {"countryCode": countryCode}
-        countryCode = str(countryCode).strip().upper()
-        result = result[result.countryCode == countryCode]
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
+    success, result, metadata = dataset_utils.get_funding_progress(orientation, countryCode)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
@@ -398,16 +377,16 @@ def get_funding_progress(orientation):
 @swag_from('api_configs/world/funding_donors_appeal.yml')
 def get_funding_plan_donors():
     params = None
-    success, result, metadata = api_utils.safely_load_data('funding_donors_appeal.csv', 'FTS funding donors to each appeal', has_metadata=True)
+    success, index, metadata = dataset_utils.load_indexed_data('funding_donors_appeal.csv', 'FTS funding donors to each appeal')
     if not success:
-        return result, 501
+        return index, 501
+    result = index.df
     planID = request.args.get('planID', None)
     if planID:
         params = {"planID": planID}
         planID = int(planID)
-        result = result[result.plan_id == planID]
-    result = result.to_dict(orient='list')
-    return jsonify(metadata=metadata, data=result, params=params)
+        result = index.select(index.lookup('plan_id', [planID]))
+    return send_tabular_data(result, 'fts_donors_appeal', metadata=metadata, params=params)
 
 
 
@@ -415,21 +394,23 @@ def get_funding_plan_donors():
 @swag_from('api_configs/world/funding_clusters.yml')
 def get_funding_plan_clusters(orientation):
     params = None
-    success, result, metadata = api_utils.safely_load_data('funding_clusters.csv', 'FTS funding progress by country appeal and cluster', has_metadata=True)
+    build_index = dataset_utils.build_funding_index(['cluster', 'revisedRequirements', 'totalFunding', 'percentFunded'])
+    success, index, metadata = dataset_utils.load_indexed_data('funding_clusters.csv', 'FTS funding progress by country appeal and cluster',
+                                                               'funding_by_country', build_index)
     if not success:
-        return result, 501
+        return index, 501
+    result = index.df
+    countryCodes = None
     countryCode = request.args.get('countryCode', None)
     if countryCode:
         params = {"countryCode": countryCode}
         countryCode = str(countryCode).strip().upper()
-        result = result[result.countryCode == countryCode]
+        countryCodes = [countryCode]
+        result = index.select(index.lookup('countryCode', countryCodes))
     if orientation == 'list':
         result = result.to_dict(orient='list')
     if orientation == 'index':
-        result = result.groupby('countryCode')[['cluster','revisedRequirements','totalFunding',
-                                                'percentFunded']]
-        result = result.apply(lambda x: x.to_dict(orient='record'))
-        result = result.to_dict()
+        result = index.records_by_group(countryCodes)
     return jsonify(metadata=metadata, data=result, params=params)
 
 
@@ -438,22 +419,12 @@ def get_funding_plan_clusters(orientation):
 @swag_from('api_configs/world/funding_countries_destination.yml')
 def get_funding_countries_destination(orientation, year):
     params = None
-    success, result, metadata = api_utils.safely_load_data('funding_dest_countries.csv', 'FTS funding by destination country and year', has_metadata=True)
-    if not success:
-        return result, 501
     countryCode = request.args.get('countryCode', None)
     if countryCode:
         params = {"countryCode": countryCode}
-        countryCode = str(countryCode).strip().upper()
-        result = result[result.countryCode == countryCode]
-
-    year = int(year)
-    result = result[result.year == year]
-
-    if orientation == 'list':
-        result = result.to_dict(orient='list')
-    if orientation == 'index':
-        result = result.set_index('countryCode').to_dict(orient=orientation)
+    success, result, metadata = dataset_utils.get_funding_countries_destination(orientation, year, countryCode)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
@@ -461,70 +432,154 @@ def get_funding_countries_destination(orientation, year):
 @swag_from('api_configs/world/funding_donors_country.yml')
 def get_funding_countries_donors(orientation):
     params = None
-    success, result, metadata = api_utils.safely_load_data('funding_donors_country.csv', 'FTS funding donors to each country', has_metadata=True)
-    if not success:
-        return result, 501
     countryCode = request.args.get('countryCode', None)
     if countryCode:
         params = {"countryCode": countryCode}
-        countryCode = str(countryCode).strip().upper()
-        result = result[result.countryCode == countryCode]
-
-    if orientation == 'list':
-        result = result.to_dict(orient='list')
-    if orientation == 'index':
-        #result = result.set_index('countryCode').to_dict(orient=orientation)
-        result = result.groupby(['countryCode'])[['organization_name','totalFunding']]
-        result = result.apply(lambda x: x.to_dict(orient='record'))
-        result = result.to_dict()
+    success, result, metadata = dataset_utils.get_funding_countries_donors(orientation, countryCode)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
 @app.route('/needs/plans/<string:orientation>/', methods=['GET'])
+@cache_response('2017_appeals_needs_consolidated.csv')
 @swag_from('api_configs/world/needs_plans.yml')
 def get_needs_plans(orientation):
     params = None
-    success, result, metadata = api_utils.safely_load_data('2017_appeals_needs_consolidated.csv', 'HNO needs by country appeal', has_metadata=True)
-    if not success:
-        return result, 501
     countryCode = request.args.get('countryCode', None)
     if countryCode:
         params = {"countryCode": countryCode}
-        countryCode = str(countryCode).strip().upper()
-        result = result[result.countryCode == countryCode]
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
+    success, result, metadata = dataset_utils.get_needs_plans(orientation, countryCode)
+    if not success:
+        return result, 501
     return jsonify(metadata=metadata, data=result, params=params)
 
 
+def build_events_index(data_file):
+    """
+    Helper function to build the indexes used to filter ACLED events (see get_events_by_filters).
+    Returns a function that indexes the loaded data on the country, event type, year and event date columns.
+    """
+    def build_index(result, metadata):
+        columns = dict((column.upper(), column) for column in result.columns)
+        filter_cols = [columns[column] for column in constants.ACLED_FILTER_COLS]
+        return index_utils.DataIndex(result, filter_cols, columns[constants.ACLED_DATE_COL], constants.ACLED_FILE_DATE_FORMATS[data_file])
+    return build_index
+
+
+def get_events_by_filters(data_file, data_description):
+    """
+    Helper function for ACLED events endpoints.
+    Without query args, returns all events. Otherwise supports filtering on country, event_type and year (comma-separated
+    values, case-insensitive), an event date range (start_date/end_date, YYYY-MM-DD), projecting columns (fields, comma-separated),
+    and pagination (limit, and cursor as returned in next_cursor). Any of these can be streamed as csv or ndjson (format).
+    Filtered, projected or paged requests return one page of events at a time: constants.ACLED_DEFAULT_PAGE_SIZE
+    events when no limit is given, and at most constants.ACLED_MAX_PAGE_SIZE events.
+    Returns whether data retrieval was successful (or http errorcode if not), and the resulting dataframe as data along
+    with the params and paging fields if filtered (or error message if not).
+    """
+    if not [arg for arg in request.args if arg != 'format']:
+        success, result, metadata = api_utils.safely_load_data(data_file, data_description, has_metadata=False)
+        if not success:
+            return 501, result
+        return success, {"data": result}
+    try:
+        index = api_utils.load_data_index(data_file, 'events', build_events_index(data_file))
+    except Exception as e:
+        return 501, 'Error: No {} data was found ({})'.format(data_description, e)
+    columns = dict((column.upper(), column) for column in index.df.columns)
+    params = request.args.to_dict()
+    try:
+        filters = {}
+        for column in constants.ACLED_FILTER_COLS:
+            values = request.args.get(column.lower(), None)
+            if values:
+                filters[columns[column]] = values.split(',')
+        start_date = request.args.get('start_date', None)
+        end_date = request.args.get('end_date', None)
+        fields = request.args.get('fields', None)
+        if fields:
+            fields = [columns[field.strip().upper()] for field in fields.split(',')]
+        cursor = int(request.args.get('cursor', 0))
+        limit = request.args.get('limit', None)
+        limit = min(int(limit), constants.ACLED_MAX_PAGE_SIZE) if limit else constants.ACLED_DEFAULT_PAGE_SIZE
+        if cursor < 0 or limit < 1:
+            raise ValueError('cursor must be non-negative and limit must be positive')
+        positions = index.positions(filters, start_date, end_date)
+    except (KeyError, ValueError) as e:
+        return 400, 'Error: Invalid query parameters for {} data ({})'.format(data_description, e)
+    total = len(positions)
+    end = min(cursor + limit, total)
+    result = index.select(positions[cursor:end], fields)
+    paging = {"total": total, "cursor": cursor, "limit": limit, "next_cursor": end if end < total else None}
+    return True, {"data": result, "params": params, "paging": paging}
+
+
+def send_events_export(data_file, data_description):
+    """
+    Helper function for ACLED events endpoints, responding to requests without filters (all events, as json or as a
+    csv download) with the export of the data_file published by `run_acled.py`, served as-is along with its
+    pre-compressed variants (see constants.ACLED_EXPORT_FILES).
+    Returns None if the request has filters or asks for another format, or if no up to date export was published,
+    for the response to be built from the data instead (see get_events_response).
+    """
+    if [arg for arg in request.args if arg != 'format']:
+        return None
+    try:
+        export_format = get_export_format()
+    except ValueError:
+        return None
+    if export_format is None:
+        export_file, mimetype, download_name = constants.ACLED_EXPORT_FILES[data_file]['json'], 'application/json', None
+    elif export_format == 'csv':
+        export_file, mimetype, download_name = constants.ACLED_EXPORT_FILES[data_file]['csv'], 'text/csv', data_file
+    else:
+        return None
+    try:
+        data_file_signature = cache_utils.file_signature(api_utils.get_data_file_path(data_file))
+        if cache_utils.file_signature(api_utils.get_data_file_path(export_file))[1] < data_file_signature[1]:
+            return None
+    except OSError:
+        return None
+    return send_data_file(export_file, data_description, mimetype, download_name=download_name)
+
+
+def get_events_response(data_file, data_description):
+    """
+    Helper function for ACLED events endpoints, building the response to the request from the data_file (see
+    get_events_by_filters), cached per query (see cache_response).
+    """
+    success, result = get_events_by_filters(data_file, data_description)
+    if not success or success in (400, 501):
+        return result, success
+    return send_tabular_data(result.pop('data'), os.path.splitext(data_file)[0], **result)
+
+
 @app.route('/events/acled', methods=['GET'])
 @swag_from('api_configs/world/events_acled.yml')
 def get_events_acled():
-    success, result, metadata = api_utils.safely_load_data('acled.csv', 'ACLED events', has_metadata=False)
-    if not success:
-        return result, 501
-    return jsonify(data=result.to_dict(orient='list'))
+    response = send_events_export('acled.csv', 'ACLED events')
+    if response is None:
+        response = cache_response('acled.csv')(get_events_response)('acled.csv', 'ACLED events')
+    return response
 
 
 @app.route('/events/acled-africa', methods=['GET'])
 @swag_from('api_configs/world/events_acled_africa.yml')
 def get_events_acled_africa():
-    success, result, metadata = api_utils.safely_load_data('acled_all_africa.csv', 'ACLED Africa events', has_metadata=False)
-    if not success:
-        return result, 501
-    return jsonify(data=result.to_dict(orient='list'))
+    response = send_events_export('acled_all_africa.csv', 'ACLED Africa events')
+    if response is None:
+        response = cache_response('acled_all_africa.csv')(get_events_response)('acled_all_africa.csv', 'ACLED Africa events')
+    return response
 
 
 @app.route('/fragility/fragile-state-index/<string:orientation>', methods=['GET'])
+@cache_response('fsi_2017.csv')
 @swag_from('api_configs/world/fragile_state_index.yml')
 def get_fragile_state_index(orientation):
-    success, result, metadata = api_utils.safely_load_data('fsi_2017.csv', 'Fragile State Index', has_metadata=True)
+    success, result, metadata = dataset_utils.get_fragile_state_index(orientation)
     if not success:
         return result, 501
-    if orientation == 'index':
-        result = result.set_index('countryCode')
-    result = result.to_dict(orient=orientation)
     return jsonify(metadata=metadata, data=result)
 
 
@@ -538,30 +593,18 @@ def get_metadata_all(orientation):
 @app.route('/displacement_tracker/', methods=['GET'])
 @swag_from('api_configs/displacement_tracker/displacement_tracker.yml')
 def get_tracker_json_data():
-    success, result = api_utils.safely_load_json_data('displacement_tracker.json','Displacement Tracker Data')
-    if not success:
-        return result, 501
-    return jsonify(result)
+    return send_data_file('displacement_tracker.json', 'Displacement Tracker Data', 'application/json')
 
 @app.route('/displacement_tracker/metadata', methods=['GET'])
 @swag_from('api_configs/displacement_tracker/displacement_tracker_metadata.yml')
 def get_tracker_json_metadata():
-    success, result = api_utils.safely_load_json_data('displacement_tracker_metadata.json','Displacement Tracker Metadata')
-    if not success:
-        return result, 501
-    return jsonify(result)
+    return send_data_file('displacement_tracker_metadata.json', 'Displacement Tracker Metadata', 'application/json')
 
 @app.route('/displacement_tracker/csv', methods=['GET'])
 @swag_from('api_configs/displacement_tracker/displacement_tracker_csv.yml')
 def get_tracker_csv_data():
-    success, result, metadata = api_utils.safely_load_data('displacement_tracker.csv', 'Displacement Tracker Data', has_metadata=False)
-    if not success:
-        return result, 501
-    result = result[result['CountryCode'] != 'null']
-    resp = make_response(result.to_csv(encoding='utf-8', index=False))
-    resp.headers["Content-Disposition"] = "attachment; filename=displacement_tracker.csv"
-    resp.headers["Content-Type"] = "text/csv"
-    return resp
+    return send_data_file(constants.DISPLACEMENT_TRACKER_EXPORT_FILE, 'Displacement Tracker Data', 'text/csv',
+                          download_name='displacement_tracker.csv')
 
 
 def main():
@@ -1,10 +1,14 @@
+import sys
 import requests
+import numpy as np
 import pandas as pd
 import os.path
 import resources.constants
 import json
 from pandas.io.json import json_normalize
-from utils.data_utils import get_ordinal_number
+from utils.data_utils import get_ordinal_number, write_columnar, write_compressed_variants, write_content_hash
+from utils.http_utils import ordered_map
+from utils import dataset_utils, publish_utils
 
 """
 This script aggregates data from multiple endpoints and returns a single .json file containing all data
@@ -12,6 +16,9 @@ used in the displacement tracker project.
 
 Scheduling this script would mean that the /displacement_tracker endpoint always returned the latest data
 contained within the Humanitarian Data Service API.
+
+By default the data is read in-process from the derived data files that the API serves (see `utils/dataset_utils.py`),
+run `python displacement_tracker_data.py http` to get it from the API at ROOT instead.
 """
 
 # For development
@@ -34,21 +41,99 @@ URL_NEEDS = '/needs/plans/index'
 URL_FUNDING_DEST_COUNTRY = '/funding/countries/destination/index/{}'.format(FUNDING_YEAR)
 URL_FUNDING_DEST_DONORS = '/funding/countries/donors/index'
 
+# Maximum number of concurrent requests to the API
+MAX_CONCURRENCY = 4
+
+# Timeout (in seconds) of the request for each source, the largest responses get the longest
+DEFAULT_TIMEOUT = 30
+SOURCE_TIMEOUTS = {
+    'population': 60,
+    'fragile_state': 60,
+    'populations_refugeelike_asylum': 60,
+    'populations_refugeelike_origin': 60
+}
 
 
 # Define path for raw country names data
 country_names_path = os.path.join(resources.constants.EXAMPLE_RAW_DATA_PATH, 'UNSD Methodology.csv')
 
 # Define path for relatable geography populations data
-relatable_population_path = os.path.join(resources.constants.EXAMPLE_DERIVED_DATA_PATH, '2017_relatable_population_rankings.csv')
+relatable_population_path = os.path.join(publish_utils.get_published_data_path(), resources.constants.RELATABLE_POPULATION_FILE)
 
 # Define path for stories of displacement
-displacement_stories_path = os.path.join(resources.constants.EXAMPLE_DERIVED_DATA_PATH, 'stories_of_displacement_links.csv')
+displacement_stories_path = os.path.join(publish_utils.get_published_data_path(), 'stories_of_displacement_links.csv')
 
 # Create a blank dictionary to store metadata for each field
 metadata_dict = {}
 
 
+def fetch_source(source):
+    """
+    Get the json data of the given (name, url, timeout) source from the API.
+    Return a tuple of the name and the json data, or None if the request failed or returned no data.
+    """
+    name, url, timeout = source
+    try:
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+        if 'data' not in result:
+            raise ValueError('no data in the response')
+    except (requests.RequestException, ValueError) as e:
+        print 'Could not get the {} data from {}, leaving its fields empty ({})'.format(name, url, e)
+        return name, None
+    return name, result
+
+
+def fetch_sources(urls, timeouts=SOURCE_TIMEOUTS, max_workers=MAX_CONCURRENCY):
+    """
+    Get the json data of each source (a dict of name to url) from the API concurrently, using a pool of at most
+    max_workers threads and the timeout of each source (see SOURCE_TIMEOUTS).
+    Return a dict of name to json data, which is None for the sources whose request failed so that only the fields
+    derived from them are left empty rather than the whole merge failing.
+    """
+    sources = [(name, url, timeouts.get(name, DEFAULT_TIMEOUT)) for name, url in sorted(urls.items())]
+    return dict(ordered_map(fetch_source, sources, max_workers=max_workers))
+
+
+def read_source(source):
+    """
+    Read the data of the given (name, get_data) source in-process, where get_data returns the same data as the API
+    endpoint of the source (see `utils/dataset_utils.py`).
+    Return a tuple of the name and the data in the same form as the endpoint's json response, or None if it failed.
+    """
+    name, get_data = source
+    try:
+        success, result, metadata = get_data()
+    except Exception as e:
+        success, result = False, e
+    if not success:
+        print 'Could not read the {} data, leaving its fields empty ({})'.format(name, result)
+        return name, None
+    # Key rows without a country code by 'null', as in the json response
+    result = dict(('null' if key is None else key, value) for key, value in result.items())
+    return name, {'data': result, 'metadata': metadata}
+
+
+def read_sources(funding_year=FUNDING_YEAR):
+    """
+    Read the data of every source in-process from the derived data files, without going through the API.
+    Return a dict of name to data like fetch_sources.
+    """
+    sources = [
+        ('population', lambda: dataset_utils.get_populations_totals('index')),
+        ('fragile_state', lambda: dataset_utils.get_fragile_state_index('index')),
+        ('populations_refugeelike_asylum', lambda: dataset_utils.get_populations_refugeelike('asylum', 'index')),
+        ('populations_refugeelike_origin', lambda: dataset_utils.get_populations_refugeelike('origin', 'index')),
+        ('indicators_gni', lambda: dataset_utils.get_indicators_gni('index')),
+        ('plans_progress', lambda: dataset_utils.get_funding_progress('index')),
+        ('funding_dest_country', lambda: dataset_utils.get_funding_countries_destination('index', funding_year)),
+        ('funding_dest_donors', lambda: dataset_utils.get_funding_countries_donors('index')),
+        ('needs', lambda: dataset_utils.get_needs_plans('index'))
+    ]
+    return dict(read_source(source) for source in sources)
+
+
 def merge_data(
         funding_year = FUNDING_YEAR,
         country_names_path=country_names_path,
@@ -62,9 +147,30 @@ def merge_data(
         url_fragile_state=(ROOT + URL_FRAGILE_STATE),
         url_needs=(ROOT + URL_NEEDS),
         url_funding_dest_country=(ROOT + URL_FUNDING_DEST_COUNTRY),
-        url_funding_dest_donors=(ROOT + URL_FUNDING_DEST_DONORS)
+        url_funding_dest_donors=(ROOT + URL_FUNDING_DEST_DONORS),
+        timeouts=SOURCE_TIMEOUTS,
+        max_workers=MAX_CONCURRENCY,
+        in_process=True
     ):
 
+    ####################  SOURCE DATA ####################
+    # Read the data of every source in-process, or get it from the API concurrently (see fetch_sources)
+    if in_process:
+        source_data = read_sources(funding_year)
+    else:
+        source_data = fetch_sources({
+            'population': url_population,
+            'fragile_state': url_fragile_state,
+            'populations_refugeelike_asylum': url_populations_refugeelike_asylum,
+            'populations_refugeelike_origin': url_populations_refugeelike_origin,
+            'indicators_gni': url_indicators_gni,
+            'plans_progress': url_plans_progress,
+            'funding_dest_country': url_funding_dest_country,
+            'funding_dest_donors': url_funding_dest_donors,
+            'needs': url_needs
+        }, timeouts=timeouts, max_workers=max_workers)
+
+
     ####################  COUNTRY NAMES ####################
     # Get the data from .csv
     df_country_names = pd.read_csv(country_names_path, encoding='utf-8')
@@ -111,27 +217,32 @@ def merge_data(
 
     ####################  POPULATIONS ####################
     # Get the data from the API
-    population_data = requests.get(url_population).json()
+    population_data = source_data['population']
 
-    # Extract metadata
-    if 'metadata' in population_data:
-        population_metadata = population_data['metadata']
-    else:
-        population_metadata = {}
+    if population_data is not None:
+        # Extract metadata
+        if 'metadata' in population_data:
+            population_metadata = population_data['metadata']
+        else:
+            population_metadata = {}
 
-    # Build dataframe
-    df_population = pd.DataFrame(population_data['data']).T
+        # Build dataframe
+        df_population = pd.DataFrame(population_data['data']).T
 
-    # Select relevant fields
-    df_population = df_population[[
-        'PopTotal'
-    ]]
+        # Select relevant fields
+        df_population = df_population[[
+            'PopTotal'
+        ]]
 
-    # Rename fields
-    df_population.rename(columns={'PopTotal': 'Population'}, inplace=True)
+        # Rename fields
+        df_population.rename(columns={'PopTotal': 'Population'}, inplace=True)
 
-    # Drop null values
-    df_population = df_population.dropna()
+        # Drop null values
+        df_population = df_population.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        population_metadata = {}
+        df_population = pd.DataFrame(columns=['Population'])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_population.columns:
@@ -140,28 +251,35 @@ def merge_data(
 
     ####################  FRAGILE STATE ####################
     # Get the data from the API
-    fragile_state_data = requests.get(url_fragile_state).json()
+    fragile_state_data = source_data['fragile_state']
 
-    # Extract metadata
-    if 'metadata' in fragile_state_data:
-        fragile_state_metadata = fragile_state_data['metadata']
-    else:
-        fragile_state_metadata = {}
+    if fragile_state_data is not None:
+        # Extract metadata
+        if 'metadata' in fragile_state_data:
+            fragile_state_metadata = fragile_state_data['metadata']
+        else:
+            fragile_state_metadata = {}
 
-    # Build a dataframe
-    df_fragile_state = pd.DataFrame(fragile_state_data['data']).T
+        # Build a dataframe
+        df_fragile_state = pd.DataFrame(fragile_state_data['data']).T
 
-    # Select relevant fields
-    df_fragile_state = df_fragile_state[[
-        'Total', 'Rank'
-    ]]
+        # Select relevant fields
+        df_fragile_state = df_fragile_state[[
+            'Total', 'Rank'
+        ]]
 
-    # Rename fields
-    df_fragile_state.rename(columns={'Total': 'Fragile State Index Score',
-                                     'Rank': 'Fragile State Index Rank'}, inplace=True)
+        # Rename fields
+        df_fragile_state.rename(columns={'Total': 'Fragile State Index Score',
+                                         'Rank': 'Fragile State Index Rank'}, inplace=True)
 
-    # Drop null values
-    df_fragile_state = df_fragile_state.dropna()
+        # Drop null values
+        df_fragile_state = df_fragile_state.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        fragile_state_metadata = {}
+        df_fragile_state = pd.DataFrame(columns=[
+            'Fragile State Index Score', 'Fragile State Index Rank'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_fragile_state.columns:
@@ -170,40 +288,49 @@ def merge_data(
 
     ####################  POPULATIONS_REFUGEELIKE_ASYLUM ####################
     # Get the data from the API
-    populations_refugeelike_asylum_data = requests.get(url_populations_refugeelike_asylum).json()
+    populations_refugeelike_asylum_data = source_data['populations_refugeelike_asylum']
 
-    # Extract metadata
-    if 'metadata' in populations_refugeelike_asylum_data:
-        populations_refugeelike_asylum_metadata = populations_refugeelike_asylum_data['metadata']
-    else:
-        populations_refugeelike_asylum_metadata = {}
+    if populations_refugeelike_asylum_data is not None:
+        # Extract metadata
+        if 'metadata' in populations_refugeelike_asylum_data:
+            populations_refugeelike_asylum_metadata = populations_refugeelike_asylum_data['metadata']
+        else:
+            populations_refugeelike_asylum_metadata = {}
 
-    # Build a dataframe
-    df_populations_refugeelike_asylum = pd.DataFrame(populations_refugeelike_asylum_data['data']).T
+        # Build a dataframe
+        df_populations_refugeelike_asylum = pd.DataFrame(populations_refugeelike_asylum_data['data']).T
 
-    # Select relevant fields
-    df_populations_refugeelike_asylum = df_populations_refugeelike_asylum[[
-        'Total population of concern', 'Total Refugee and people in refugee-like situations',
-        'IDPs protected/assisted by UNHCR, incl. people in IDP-like situations','Asylum-seekers'
-    ]]
+        # Select relevant fields
+        df_populations_refugeelike_asylum = df_populations_refugeelike_asylum[[
+            'Total population of concern', 'Total Refugee and people in refugee-like situations',
+            'IDPs protected/assisted by UNHCR, incl. people in IDP-like situations','Asylum-seekers'
+        ]]
 
-    # Rename fields
-    df_populations_refugeelike_asylum.rename(columns={
-        'IDPs protected/assisted by UNHCR, incl. people in IDP-like situations': 'IDPs protected/assisted by UNHCR',
-        'Asylum-seekers': 'Asylum-seekers (asylum)'
-    }, inplace=True)
+        # Rename fields
+        df_populations_refugeelike_asylum.rename(columns={
+            'IDPs protected/assisted by UNHCR, incl. people in IDP-like situations': 'IDPs protected/assisted by UNHCR',
+            'Asylum-seekers': 'Asylum-seekers (asylum)'
+        }, inplace=True)
 
 
-    # Add field to rank total total population of concern
-    df_populations_refugeelike_asylum['Rank of total population of concern'] = df_populations_refugeelike_asylum[
-        'Total population of concern'].rank(ascending=False, method='min').astype(int)
+        # Add field to rank total total population of concern
+        df_populations_refugeelike_asylum['Rank of total population of concern'] = df_populations_refugeelike_asylum[
+            'Total population of concern'].rank(ascending=False, method='min').astype(int)
 
-    # Add field to add refugees and asylum-seekers
-    df_populations_refugeelike_asylum['Total refugees and asylum-seekers (asylum)'] = df_populations_refugeelike_asylum[
-        'Total Refugee and people in refugee-like situations'] + df_populations_refugeelike_asylum['Asylum-seekers (asylum)']
+        # Add field to add refugees and asylum-seekers
+        df_populations_refugeelike_asylum['Total refugees and asylum-seekers (asylum)'] = df_populations_refugeelike_asylum[
+            'Total Refugee and people in refugee-like situations'] + df_populations_refugeelike_asylum['Asylum-seekers (asylum)']
 
-    # Drop null values
-    df_populations_refugeelike_asylum = df_populations_refugeelike_asylum.dropna()
+        # Drop null values
+        df_populations_refugeelike_asylum = df_populations_refugeelike_asylum.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        populations_refugeelike_asylum_metadata = {}
+        df_populations_refugeelike_asylum = pd.DataFrame(columns=[
+            'Total population of concern', 'Total Refugee and people in refugee-like situations',
+            'IDPs protected/assisted by UNHCR', 'Asylum-seekers (asylum)', 'Rank of total population of concern',
+            'Total refugees and asylum-seekers (asylum)'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_populations_refugeelike_asylum.columns:
@@ -212,35 +339,43 @@ def merge_data(
 
     ####################  POPULATIONS_REFUGEELIKE_ORIGIN ####################
     # Get the data from the API
-    populations_refugeelike_origin_data = requests.get(url_populations_refugeelike_origin).json()
+    populations_refugeelike_origin_data = source_data['populations_refugeelike_origin']
 
-    # Extract metadata
-    if 'metadata' in populations_refugeelike_origin_data:
-        populations_refugeelike_origin_metadata = populations_refugeelike_origin_data['metadata']
-    else:
-        populations_refugeelike_origin_metadata = {}
+    if populations_refugeelike_origin_data is not None:
+        # Extract metadata
+        if 'metadata' in populations_refugeelike_origin_data:
+            populations_refugeelike_origin_metadata = populations_refugeelike_origin_data['metadata']
+        else:
+            populations_refugeelike_origin_metadata = {}
 
-    # Build a dataframe
-    df_populations_refugeelike_origin = pd.DataFrame(populations_refugeelike_origin_data['data']).T
+        # Build a dataframe
+        df_populations_refugeelike_origin = pd.DataFrame(populations_refugeelike_origin_data['data']).T
 
-    # Select relevant fields
-    df_populations_refugeelike_origin = df_populations_refugeelike_origin[[
-        'Total Refugee and people in refugee-like situations', 'Asylum-seekers'
-    ]]
+        # Select relevant fields
+        df_populations_refugeelike_origin = df_populations_refugeelike_origin[[
+            'Total Refugee and people in refugee-like situations', 'Asylum-seekers'
+        ]]
 
-    # Rename fields
-    df_populations_refugeelike_origin.rename(columns={
-        'Total Refugee and people in refugee-like situations': 'Total refugees who have fled from country',
-        'Asylum-seekers': 'Asylum-seekers (origin)'
-    }, inplace=True)
+        # Rename fields
+        df_populations_refugeelike_origin.rename(columns={
+            'Total Refugee and people in refugee-like situations': 'Total refugees who have fled from country',
+            'Asylum-seekers': 'Asylum-seekers (origin)'
+        }, inplace=True)
 
 
-    # Add field to add refugees and asylum-seekers
-    df_populations_refugeelike_origin['Total refugees and asylum-seekers (origin)'] = df_populations_refugeelike_origin[
-        'Total refugees who have fled from country'] + df_populations_refugeelike_origin['Asylum-seekers (origin)']
+        # Add field to add refugees and asylum-seekers
+        df_populations_refugeelike_origin['Total refugees and asylum-seekers (origin)'] = df_populations_refugeelike_origin[
+            'Total refugees who have fled from country'] + df_populations_refugeelike_origin['Asylum-seekers (origin)']
 
-    # Drop null values
-    df_populations_refugeelike_origin = df_populations_refugeelike_origin.dropna()
+        # Drop null values
+        df_populations_refugeelike_origin = df_populations_refugeelike_origin.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        populations_refugeelike_origin_metadata = {}
+        df_populations_refugeelike_origin = pd.DataFrame(columns=[
+            'Total refugees who have fled from country', 'Asylum-seekers (origin)',
+            'Total refugees and asylum-seekers (origin)'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_populations_refugeelike_origin.columns:
@@ -249,27 +384,32 @@ def merge_data(
 
     ####################  INDICATORS GNI ####################
     # Get the data from the API
-    indicators_gni_data = requests.get(url_indicators_gni).json()
+    indicators_gni_data = source_data['indicators_gni']
 
-    # Extract metadata
-    if 'metadata' in indicators_gni_data:
-        indicators_gni_metadata = indicators_gni_data['metadata']
-    else:
-        indicators_gni_metadata = {}
+    if indicators_gni_data is not None:
+        # Extract metadata
+        if 'metadata' in indicators_gni_data:
+            indicators_gni_metadata = indicators_gni_data['metadata']
+        else:
+            indicators_gni_metadata = {}
 
-    # Build a dataframe
-    df_indicators_gni = pd.DataFrame(indicators_gni_data['data']).T
+        # Build a dataframe
+        df_indicators_gni = pd.DataFrame(indicators_gni_data['data']).T
 
-    # Select relevant fields
-    df_indicators_gni = df_indicators_gni[[
-        '2015'
-    ]]
+        # Select relevant fields
+        df_indicators_gni = df_indicators_gni[[
+            '2015'
+        ]]
 
-    # Rename fields
-    df_indicators_gni.rename(columns={'2015': 'GDP Per Capita'}, inplace=True)
+        # Rename fields
+        df_indicators_gni.rename(columns={'2015': 'GDP Per Capita'}, inplace=True)
 
-    # Drop null values
-    df_indicators_gni = df_indicators_gni.dropna()
+        # Drop null values
+        df_indicators_gni = df_indicators_gni.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        indicators_gni_metadata = {}
+        df_indicators_gni = pd.DataFrame(columns=['GDP Per Capita'])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_indicators_gni.columns:
@@ -278,71 +418,86 @@ def merge_data(
 
     ####################  PLANS PROGRESS ####################
     # Get the data from the API
-    plans_progress_data = requests.get(url_plans_progress).json()
+    plans_progress_data = source_data['plans_progress']
 
-    # Extract metadata
-    if 'metadata' in plans_progress_data:
-        plans_progress_metadata = plans_progress_data['metadata']
-    else:
-        plans_progress_metadata = {}
+    if plans_progress_data is not None:
+        # Extract metadata
+        if 'metadata' in plans_progress_data:
+            plans_progress_metadata = plans_progress_data['metadata']
+        else:
+            plans_progress_metadata = {}
 
-    # Build a dataframe
-    df_plans_progress = pd.DataFrame(plans_progress_data['data']).T
+        # Build a dataframe
+        df_plans_progress = pd.DataFrame(plans_progress_data['data']).T
 
-    # Select relevant fields
-    df_plans_progress = df_plans_progress[[
-        'appealFunded', 'revisedRequirements', 'neededFunding'
-    ]]
+        # Select relevant fields
+        df_plans_progress = df_plans_progress[[
+            'appealFunded', 'revisedRequirements', 'neededFunding'
+        ]]
 
-    # Rename fields
-    df_plans_progress.rename(columns={'appealFunded': 'Appeal funds committed to date',
-                                      'revisedRequirements': 'Appeal funds requested',
-                                      'neededFunding': 'Appeal funds still needed'}, inplace=True)
+        # Rename fields
+        df_plans_progress.rename(columns={'appealFunded': 'Appeal funds committed to date',
+                                          'revisedRequirements': 'Appeal funds requested',
+                                          'neededFunding': 'Appeal funds still needed'}, inplace=True)
 
-    df_plans_progress['Appeal percent funded'] = df_plans_progress['Appeal funds committed to date']/df_plans_progress['Appeal funds requested']
+        df_plans_progress['Appeal percent funded'] = df_plans_progress['Appeal funds committed to date']/df_plans_progress['Appeal funds requested']
 
-    # Drop null values
-    df_plans_progress = df_plans_progress.dropna()
+        # Drop null values
+        df_plans_progress = df_plans_progress.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        plans_progress_metadata = {}
+        df_plans_progress = pd.DataFrame(columns=[
+            'Appeal funds committed to date', 'Appeal funds requested', 'Appeal funds still needed',
+            'Appeal percent funded'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_plans_progress.columns:
         metadata_dict[column] = plans_progress_metadata
 
     # Add an FTS data as-of date so it can be included in the .csv data dump
-    df_plans_progress['FTS funding data as-of date'] = plans_progress_data['metadata']['source_data']
+    df_plans_progress['FTS funding data as-of date'] = plans_progress_metadata.get('source_data')
 
 
     ######## FUNDING BY DESTINATION COUNTRY ############
     #Get the data from the API
-    funding_dest_country_data = requests.get(url_funding_dest_country).json()
+    funding_dest_country_data = source_data['funding_dest_country']
 
-    # Extract metadata
-    if 'metadata' in funding_dest_country_data:
-        funding_dest_country_metadata = funding_dest_country_data['metadata']
-    else:
-        funding_dest_country_metadata = {}
+    if funding_dest_country_data is not None:
+        # Extract metadata
+        if 'metadata' in funding_dest_country_data:
+            funding_dest_country_metadata = funding_dest_country_data['metadata']
+        else:
+            funding_dest_country_metadata = {}
 
-    # Build a dataframe
-    df_funding_dest_country = pd.DataFrame(funding_dest_country_data['data']).T
+        # Build a dataframe
+        df_funding_dest_country = pd.DataFrame(funding_dest_country_data['data']).T
 
-    # Select relevant fields
-    df_funding_dest_country = df_funding_dest_country[[
-        'totalFunding'
-    ]]
+        # Select relevant fields
+        df_funding_dest_country = df_funding_dest_country[[
+            'totalFunding'
+        ]]
 
-    # Keep only records where totalFunding > 0
-    df_funding_dest_country = df_funding_dest_country[df_funding_dest_country['totalFunding'] > 0]
+        # Keep only records where totalFunding > 0
+        df_funding_dest_country = df_funding_dest_country[df_funding_dest_country['totalFunding'] > 0]
 
-    # Rename fields
-    df_funding_dest_country.rename(columns={'totalFunding': 'Humanitarian aid received'},
-                                   inplace=True)
+        # Rename fields
+        df_funding_dest_country.rename(columns={'totalFunding': 'Humanitarian aid received'},
+                                       inplace=True)
 
-    # Add field to rank total total population of concern
-    df_funding_dest_country['Rank of humanitarian aid received'] = df_funding_dest_country[
-        'Humanitarian aid received'].rank(ascending=False, method='min').astype(int)
+        # Add field to rank total total population of concern
+        df_funding_dest_country['Rank of humanitarian aid received'] = df_funding_dest_country[
+            'Humanitarian aid received'].rank(ascending=False, method='min').astype(int)
 
-    # Drop null values
-    df_funding_dest_country = df_funding_dest_country.dropna()
+        # Drop null values
+        df_funding_dest_country = df_funding_dest_country.dropna()
+    else:
+        # The request failed, so leave the fields from this source empty
+        funding_dest_country_metadata = {}
+        df_funding_dest_country = pd.DataFrame(columns=[
+            'Humanitarian aid received', 'Rank of humanitarian aid received'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_funding_dest_country.columns:
@@ -351,19 +506,24 @@ def merge_data(
 
     ################## TOP 5 DONORS TO EACH DESTINATION COUNTRY ###################
     #Get the data from the API
-    funding_dest_donors_data = requests.get(url_funding_dest_donors).json()
+    funding_dest_donors_data = source_data['funding_dest_donors']
 
-    # Extract metadata
-    if 'metadata' in funding_dest_donors_data:
-        funding_dest_donors_metadata = funding_dest_donors_data['metadata']
-    else:
-        funding_dest_donors_metadata = {}
+    if funding_dest_donors_data is not None:
+        # Extract metadata
+        if 'metadata' in funding_dest_donors_data:
+            funding_dest_donors_metadata = funding_dest_donors_data['metadata']
+        else:
+            funding_dest_donors_metadata = {}
 
-    # Build a dataframe
-    df_funding_dest_donors = json_normalize(funding_dest_donors_data['data']).T
-    #df_funding_dest_donors = pd.DataFrame(funding_dest_donors_data['data']).T
+        # Build a dataframe
+        df_funding_dest_donors = json_normalize(funding_dest_donors_data['data']).T
+        #df_funding_dest_donors = pd.DataFrame(funding_dest_donors_data['data']).T
 
-    df_funding_dest_donors.columns = (['Top 5 Donors'])
+        df_funding_dest_donors.columns = (['Top 5 Donors'])
+    else:
+        # The request failed, so leave the fields from this source empty
+        funding_dest_donors_metadata = {}
+        df_funding_dest_donors = pd.DataFrame(columns=['Top 5 Donors'])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_funding_dest_donors.columns:
@@ -372,38 +532,48 @@ def merge_data(
 
     ####################  NEEDS ####################
     # Get the data from the API
-    needs_data = requests.get(url_needs).json()
+    needs_data = source_data['needs']
 
-    # Extract metadata
-    if 'metadata' in needs_data:
-        needs_metadata = needs_data['metadata']
+    if needs_data is not None:
+        # Extract metadata
+        if 'metadata' in needs_data:
+            needs_metadata = needs_data['metadata']
+        else:
+            needs_metadata = {}
+
+        # Build a dataframe
+        df_needs = pd.DataFrame(needs_data['data']).T
+
+        # Exclude rows where country code is missing
+        df_needs = df_needs.drop('null')
+
+        # Select relevant fields
+        df_needs = df_needs[[
+            'inNeedTotal', 'inNeedHealth', 'inNeedEducation',
+            'inNeedFoodSecurity', 'inNeedProtection', 'sourceURL',
+            'inNeedShelter-CCCM-NFI', 'inNeedWASH', 'sourceType'
+        ]]
+
+        # Rename fields
+        df_needs.rename(columns={'inNeedTotal': 'Total people in need',
+                                 'inNeedHealth': 'People in need of health support',
+                                 'inNeedEducation': 'Children in need of education',
+                                 'inNeedFoodSecurity': 'People who are food insecure',
+                                 'inNeedProtection': 'People in need of protection',
+                                 'inNeedShelter-CCCM-NFI': 'People in need of shelter',
+                                 'inNeedWASH': 'People in need of water, sanitization & hygiene',
+                                 'sourceURL': 'Source of needs data',
+                                 'sourceType': 'Source type of needs data'
+                                 }, inplace=True)
     else:
+        # The request failed, so leave the fields from this source empty
         needs_metadata = {}
-
-    # Build a dataframe
-    df_needs = pd.DataFrame(needs_data['data']).T
-
-    # Exclude rows where country code is missing
-    df_needs = df_needs.drop('null')
-
-    # Select relevant fields
-    df_needs = df_needs[[
-        'inNeedTotal', 'inNeedHealth', 'inNeedEducation',
-        'inNeedFoodSecurity', 'inNeedProtection', 'sourceURL',
-        'inNeedShelter-CCCM-NFI', 'inNeedWASH', 'sourceType'
-    ]]
-
-    # Rename fields
-    df_needs.rename(columns={'inNeedTotal': 'Total people in need',
-                             'inNeedHealth': 'People in need of health support',
-                             'inNeedEducation': 'Children in need of education',
-                             'inNeedFoodSecurity': 'People who are food insecure',
-                             'inNeedProtection': 'People in need of protection',
-                             'inNeedShelter-CCCM-NFI': 'People in need of shelter',
-                             'inNeedWASH': 'People in need of water, sanitization & hygiene',
-                             'sourceURL': 'Source of needs data',
-                             'sourceType': 'Source type of needs data'
-                             }, inplace=True)
+        df_needs = pd.DataFrame(columns=[
+            'Total people in need', 'People in need of health support', 'Children in need of education',
+            'People who are food insecure', 'People in need of protection', 'Source of needs data',
+            'People in need of shelter', 'People in need of water, sanitization & hygiene',
+            'Source type of needs data'
+        ])
 
     # Add metadata for each field to overall metadata dictionary
     for column in df_needs.columns:
@@ -412,41 +582,24 @@ def merge_data(
 
     ######## FIND PLACES WITH SIMILAR POPULATIONS TO PEOPLE IN NEED ########
 
-    # Get the relateable populations data from .csv
+    # Get the relateable populations data from .csv, indexed by population
     df_relatable_populations = pd.read_csv(relatable_population_path)
-    df_relatable_populations['Population'] = df_relatable_populations[[
-        'Population - World Bank (2015)','Population - UNFPA (2016)'
-    ]].max(axis=1)
-
-    df_relatable_populations = df_relatable_populations[['City, State, Country','Population']].dropna()
-
-    def find_nearest_place_population(reference_value):
-
-        if reference_value:
-            nearest_row = df_relatable_populations.iloc[(df_relatable_populations['Population']- reference_value).abs().argsort()[0]]
-            nearest_population = nearest_row['Population']
-        else:
-            nearest_population = 0.00
+    relatable_populations = dataset_utils.build_relatable_population_index(df_relatable_populations)
 
-        return nearest_population
+    def find_nearest_places(reference_values):
+        # Find the places with the closest population to all the reference values at once, and their populations
+        # (or '' and 0.00 where the reference value is missing)
+        places, populations = relatable_populations.nearest([value if value else None for value in reference_values])
+        found = ~pd.isnull(places)
+        return np.where(found, places, ''), np.where(found, populations, 0.00)
 
-    def find_nearest_place(reference_value):
+    nearest_places, nearest_populations = find_nearest_places(df_needs['Total people in need'])
 
-        if reference_value:
-            nearest_row = df_relatable_populations.iloc[(df_relatable_populations['Population']- reference_value).abs().argsort()[0]]
-            nearest_place = nearest_row['City, State, Country']
-        else:
-            nearest_place = ''
-
-        return nearest_place
-
-    df_needs['Place with similar population as people in need'] = df_needs['Total people in need'].apply(
-        find_nearest_place)
+    df_needs['Place with similar population as people in need'] = nearest_places
     # Add metadata
     metadata_dict['Place with similar population as people in need'] = {}
 
-    df_needs['Population of place with similar population'] = df_needs['Total people in need'].apply(
-        find_nearest_place_population)
+    df_needs['Population of place with similar population'] = nearest_populations
     # Add metadata
     metadata_dict['Population of place with similar population'] = {}
 
@@ -613,12 +766,9 @@ def merge_data(
     strand_01_dict['Needs_Data'] = {}
     strand_01_dict['Total people in need'] = df_needs['Total people in need'].sum()
     strand_01_dict['Count of current crises with people in need'] = df_needs['Total people in need'].count()
-    strand_01_dict['Place with similar population as people in need'] = find_nearest_place(
-        df_needs['Total people in need'].sum()
-    )
-    strand_01_dict['Population of place with similar population'] = find_nearest_place_population(
-        df_needs['Total people in need'].sum()
-    )
+    nearest_places, nearest_populations = find_nearest_places([df_needs['Total people in need'].sum()])
+    strand_01_dict['Place with similar population as people in need'] = nearest_places[0]
+    strand_01_dict['Population of place with similar population'] = nearest_populations[0]
     for name in needs_fields:
         strand_01_dict['Needs_Data'][name] = df_needs[name].sum()
     world_dict['Strand_01_Needs'] = strand_01_dict
@@ -675,21 +825,37 @@ def merge_data(
     return final_json, metadata, df_final
 
 
-def run():
+def run(in_process=True):
     print 'Pulling and merging data'
-    final_json, metadata, final_csv = merge_data()
+    final_json, metadata, final_csv = merge_data(in_process=in_process)
+
+    print 'Writing and publishing the combined files'
+    with publish_utils.Publication() as publication:
+        print 'Writing Combined JSON file'
+        with open(publication.path('displacement_tracker.json'), 'w') as outfile:
+            json.dump(final_json, outfile, indent=4, separators=(',', ': '), ensure_ascii=True, sort_keys=True)
+
+        print 'Writing Combined JSON metadata file'
+        with open(publication.path('displacement_tracker_metadata.json'), 'w') as outfile:
+            json.dump(metadata, outfile, indent=4, separators=(',', ': '), ensure_ascii=True, sort_keys=True)
+
+        print 'Writing Combined CSV file'
+        final_csv.to_csv(publication.path('displacement_tracker.csv'), index_label='CountryCode', encoding='utf-8')
+        write_columnar(publication.path('displacement_tracker.csv'))
 
-    print 'Writing Combined JSON file'
-    with open(os.path.join(resources.constants.EXAMPLE_DERIVED_DATA_PATH, 'displacement_tracker.json'), 'w') as outfile:
-        json.dump(final_json, outfile, indent=4, separators=(',', ': '), ensure_ascii=True, sort_keys=True)
+        print 'Writing Combined CSV export file'
+        export_path = publication.path(resources.constants.DISPLACEMENT_TRACKER_EXPORT_FILE)
+        export_csv = final_csv[final_csv.index != 'null']  # Data without a country code in its source isn't about a country
+        export_csv.to_csv(export_path, index_label='CountryCode', encoding='utf-8')
 
-    print 'Writing Combined JSON metadata file'
-    with open(os.path.join(resources.constants.EXAMPLE_DERIVED_DATA_PATH, 'displacement_tracker_metadata.json'), 'w') as outfile:
-        json.dump(metadata, outfile, indent=4, separators=(',', ': '), ensure_ascii=True, sort_keys=True)
+        print 'Writing compressed variants of the combined files'
+        for file_name in ['displacement_tracker.json', 'displacement_tracker_metadata.json', 'displacement_tracker.csv']:
+            write_compressed_variants(publication.path(file_name))
 
-    print 'Writing Combined CSV file'
-    final_csv.to_csv(os.path.join(resources.constants.EXAMPLE_DERIVED_DATA_PATH, 'displacement_tracker.csv'), index_label='CountryCode', encoding='utf-8')
+        print 'Writing compressed variants and content hashes of the combined CSV export file'
+        for file_path in [export_path] + write_compressed_variants(export_path):
+            write_content_hash(file_path)
 
 
 if __name__ == "__main__":
-    run()
+    run(in_process='http' not in sys.argv[1:])
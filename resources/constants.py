@@ -19,13 +19,66 @@ LATEST_DERIVED_RUN_DATE_FILE = os.path.join(LATEST_DERIVED_DATA_PATH, 'run_dates
 EXAMPLE_RAW_DATA_PATH = os.path.join(RAW_DATA_PATH, 'example')
 EXAMPLE_DERIVED_DATA_PATH = os.path.join(DERIVED_DATA_PATH, 'example')
 
+# Content-addressed store of raw data snapshots (see `utils/snapshot_utils.py`): each distinct raw file is stored once
+# under RAW_OBJECTS_PATH, named by its content hash, and the files of the dated raw data directories and of the latest
+# raw data directory are hardlinks to it
+RAW_OBJECTS_PATH = os.path.join(RAW_DATA_PATH, 'objects')
+
+# Manifest of the raw data files extracted by each HDX run (see `run_hdx.py`), in its dated raw data directory (and
+# merged across runs in the latest raw data directory): the date each file was last extracted, by file name, since the
+# extract_date in the metadata line of a file that didn't change is the date it was first downloaded
+RAW_EXTRACTS_FILE_NAME = 'extracts.json'
+
+# Published versions of the derived data (see `utils/publish_utils.py`): each ETL run publishes an immutable directory
+# under DERIVED_VERSIONS_PATH, and the CURRENT_DERIVED_DATA_PATH symlink points to the one the API serves (the example
+# derived data is served until a version is published). Only the most recent DERIVED_VERSIONS_KEPT versions are kept.
+DERIVED_VERSIONS_PATH = os.path.join(DERIVED_DATA_PATH, 'versions')
+CURRENT_DERIVED_DATA_PATH = os.path.join(DERIVED_DATA_PATH, 'current')
+DERIVED_VERSIONS_KEPT = 3
+
 # Metadata
 METADATA_URL = 'https://docs.google.com/spreadsheets/d/1eOphCuvRHRErw81vIGlt9XcKqT3aP-xtu3P_1_a_1QI/edit#gid=0'
-METADATA_FILE = os.path.join(EXAMPLE_DERIVED_DATA_PATH, 'metadata.csv')
+METADATA_FILE = 'metadata.csv'
 METADATA_INDEX = 'data_endpoint'
 METADATA_LIST_COLS = ['contact']
 METADATA_JSON_COLS = ['additional_metadata', 'merged_metadata']
 
+# Memory budget (in bytes) for the per-worker cache of parsed derived datasets, see `utils/api_utils.py`
+DATASET_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Memory budget (in bytes) for the per-worker cache of serialized endpoint responses, see `utils/response_utils.py`
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Content encodings of pre-compressed derived data, in order of preference when serving
+CONTENT_ENCODINGS = ['br', 'gzip']
+COMPRESSED_FILE_EXTENSIONS = {
+  'br': '.br',
+  'gzip': '.gz'
+}
+
+# Content hashes (sha1 hex digests) of published derived data, written next to the files
+CONTENT_HASH_FILE_EXTENSION = '.sha1'
+
+# Typed columnar copies of derived data (written alongside the csv files if pyarrow is installed)
+COLUMNAR_FILE_EXTENSION = '.parquet'
+COLUMNAR_METADATA_KEY = b'hds_metadata'
+
+# Chunk size (in bytes) for reading and writing large files
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Formats (and their mimetypes) that tabular endpoints can stream their data in with the format query arg, and how many
+# rows are serialized at a time when streaming (see `utils/response_utils.py`)
+EXPORT_FORMATS = {
+  'csv': 'text/csv',
+  'ndjson': 'application/x-ndjson'
+}
+EXPORT_CHUNK_ROWS = 5000
+
+# Fuzzy matching of country names (see `utils/index_utils.py`): how many of the closest values by shared trigrams are
+# scored for each query, and the memory budget (in bytes) for memoized matches of past queries
+FUZZY_MATCH_CANDIDATES = 20
+FUZZY_MATCH_MEMO_MAX_BYTES = 1024 * 1024
+
 # Standard name for a column of country names
 COUNTRY_COL = 'Country'
 
@@ -53,6 +106,17 @@ DATA_SOURCES = {
 # HDX website environments, in order of priority to pull data from (i.e. always try 'prod' first)
 HDX_SITES = ['prod', 'feature', 'test']
 
+# Maximum number of concurrent HDX dataset reads, resource downloads and resource loads (csv parsing) in `run_hdx.py`
+HDX_DISCOVERY_WORKERS = 4
+HDX_DOWNLOAD_WORKERS = 4
+HDX_PARSE_WORKERS = 2
+
+# Where each HDX dataset was last found (see `run_hdx.py`): its site env and resource names, kept so that following
+# runs read it from that site env first, until the entry is older than HDX_SITE_CACHE_MAX_AGE days and the dataset is
+# looked up again in HDX_SITES order (e.g. in case it was published to a site env of higher priority since)
+HDX_SITE_CACHE_FILE = os.path.join(RAW_DATA_PATH, 'hdx_sites.json')
+HDX_SITE_CACHE_MAX_AGE = 7
+
 # HDX data
 HDX_DATASETS = [
   'lcb-displaced', 
@@ -82,6 +146,30 @@ UNHCR_DIR = 'unhcr'
 # FTS API (under UNOCHA)
 FTS_API_BASE_URL = 'https://api.hpc.tools/v1'
 
+# Maximum number of concurrent requests to the FTS API, and of requests per second (per host) across them
+FTS_MAX_CONCURRENCY = 8
+FTS_MAX_REQUESTS_PER_SECOND = 10
+
+# Timeout (in seconds) for each request to the FTS API, and how many times (with exponential backoff starting at
+# FTS_RETRY_BACKOFF seconds) to retry connection errors, timeouts and these response statuses. No retry waits longer
+# than FTS_MAX_RETRY_DELAY seconds, whatever the backoff or the Retry-After header of the response
+FTS_TIMEOUT = 60
+FTS_MAX_RETRIES = 4
+FTS_RETRY_BACKOFF = 1
+FTS_MAX_RETRY_DELAY = 60
+FTS_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Directory of the on-disk cache of FTS API responses (keyed by url), used to revalidate and replay responses
+FTS_CACHE_PATH = os.path.join(RAW_DATA_PATH, 'fts_cache')
+
+# How long (in seconds) a cached FTS API response is used without revalidating it: long for endpoints about years
+# before FTS_APPEAL_YEAR (closed years rarely change), short for everything else (current year, plans, locations)
+FTS_CACHE_TTL = 15 * 60
+FTS_CACHE_CLOSED_YEAR_TTL = 30 * 24 * 60 * 60
+
+# State saved by incremental FTS runs: the last seen totals and details of each plan (see `run_fts.py`)
+FTS_STATE_FILE = os.path.join(RAW_DATA_PATH, 'fts_state.json')
+
 # FTS sub-directory (e.g. under data/raw/latest)
 FTS_DIR = 'fts'
 
@@ -94,6 +182,19 @@ FTS_DOWNLOAD_DATE_FILE = 'download_date.txt'
 # FTS data file prefix
 FTS_FILE_PREFIX = 'fts-appeals'
 
+# Columns (in order) of the funding data that run_fts pulls for each plan, country or year, which the results are
+# collected into before being combined with the plan or country details, and of the derived data files it saves
+FTS_DONOR_PLAN_FUNDING_COLUMNS = ['id', 'name', 'totalFunding', 'plan_id']
+FTS_DONOR_PLAN_OUTPUT_COLUMNS = ['organization_id', 'organization_name', 'totalFunding', 'plan_id', 'plan_code',
+                                 'plan_name', 'countryCode']
+FTS_DONOR_COUNTRY_FUNDING_COLUMNS = ['id', 'name', 'totalFunding', 'year', 'dest_country_id']
+FTS_DONOR_COUNTRY_OUTPUT_COLUMNS = ['organization_name', 'totalFunding', 'year', 'countryCode', 'Country']
+FTS_CLUSTER_FUNDING_COLUMNS = ['name', 'revisedRequirements', 'totalFunding', 'plan_id']
+FTS_CLUSTER_OUTPUT_COLUMNS = ['cluster', 'revisedRequirements', 'totalFunding', 'plan_id', 'plan_code', 'plan_name',
+                              'countryCode', 'percentFunded']
+FTS_COUNTRY_FUNDING_COLUMNS = ['behavior', 'id', 'name', 'totalFunding', 'year']
+FTS_COUNTRY_OUTPUT_COLUMNS = ['behavior', 'Country', 'totalFunding', 'year', 'countryCode']
+
 # FTS data schemas
 FTS_SCHEMAS = {
   'donors': ['Donor organization', 'Funding US$', 'Pledges US$'],
@@ -101,6 +202,9 @@ FTS_SCHEMAS = {
   'recipients': ['Recipient organization', 'Requirements US$', 'Funding US$', 'Pledges US$', 'Coverage %']
 }
 
+# Columns of the derived funding and needs data that their endpoints filter on (indexed when the data is loaded)
+FUNDING_INDEX_COLS = ['countryCode', 'plan_id', 'year']
+
 # DTM column names referring to states within a country
 DTM_STATE_COLS = {
   'location': 'STATE',
@@ -124,6 +228,35 @@ UNHCR_FILE_NAMES = {
   'origin_country': 'unhcr_fullyeartrends_population_by_origin_country_2016.csv'
 }
 
+# ACLED events file mapping to the format of their event date column (see the `/events/acled*` endpoints)
+ACLED_FILE_DATE_FORMATS = {
+  'acled.csv': '%Y-%m-%d',
+  'acled_all_africa.csv': '%d/%m/%Y'
+}
+
+# ACLED columns that events can be filtered on (case-insensitive, column names differ between files)
+ACLED_FILTER_COLS = ['COUNTRY', 'EVENT_TYPE', 'YEAR']
+ACLED_DATE_COL = 'EVENT_DATE'
+
+# Number of ACLED events per page of a filtered, projected or paged request (see the `/events/acled*` endpoints): the
+# page size when no limit is given, and the maximum limit, so no such request serializes the whole table at once
+ACLED_DEFAULT_PAGE_SIZE = 1000
+ACLED_MAX_PAGE_SIZE = 10000
+
+# Places with a well known population, to relate numbers of people to (e.g. 'as many people in need as in Karachi')
+RELATABLE_POPULATION_FILE = '2017_relatable_population_rankings.csv'
+
+# Cleaned csv export of the displacement tracker data (without the rows that aren't countries), published by
+# `displacement_tracker_data.py` along with its pre-compressed variants and content hash, and served as-is
+DISPLACEMENT_TRACKER_EXPORT_FILE = 'displacement_tracker_export.csv'
+
+# Pre-built responses to the ACLED events requests without filters, published by `run_acled.py` for each ACLED file
+# along with their pre-compressed variants and content hashes, and served as-is: all events as json, and as a csv export
+ACLED_EXPORT_FILES = {
+  'acled.csv': {'json': 'acled.json', 'csv': 'acled_export.csv'},
+  'acled_all_africa.csv': {'json': 'acled_all_africa.json', 'csv': 'acled_all_africa_export.csv'}
+}
+
 # UN Department of Economic and Social Affairs file mapping
 ESA_FILE_NAMES = {
   'wpp_overall': 'wpp_medium_projection_variantid2_2000_2017.csv'
@@ -0,0 +1,48 @@
+from flask import jsonify
+
+from resources import constants
+from utils import api_utils, publish_utils
+from utils.data_utils import write_compressed_variants, write_content_hash
+from utils.response_utils import iter_csv_chunks
+
+"""
+This script pre-builds the responses of the `/events/acled*` endpoints to requests without filters (all events, as
+json or as a csv download, see `constants.ACLED_EXPORT_FILES`) from the published ACLED files, and publishes them
+along with their pre-compressed variants and content hashes, so the API serves them as-is instead of serializing
+(and compressing) the whole table.
+The json body is built by the API's own jsonify, so it's the same as the response built from the data.
+"""
+
+
+def write_export(file_path, body):
+    """
+    Write the given response body to the given file_path, along with its pre-compressed variants and the content hashes
+    of all of them (used as their ETags).
+    """
+    with open(file_path, 'wb') as export_file:
+        export_file.write(body)
+    for written_path in [file_path] + write_compressed_variants(file_path):
+        write_content_hash(written_path)
+
+
+def run():
+    # The API app is only needed for its jsonify settings
+    from api import app
+
+    with publish_utils.Publication() as publication:
+        for data_file, export_files in sorted(constants.ACLED_EXPORT_FILES.items()):
+            print 'Building the exports of {}'.format(data_file)
+            success, result, _ = api_utils.safely_load_data(data_file, 'ACLED events', has_metadata=False)
+            if not success:
+                print result
+                continue
+            with app.test_request_context():
+                body = jsonify(data=result.to_dict(orient='list')).get_data()
+            write_export(publication.path(export_files['json']), body)
+            write_export(publication.path(export_files['csv']), b''.join(iter_csv_chunks(result)))
+
+    print 'Done!'
+
+
+if __name__ == "__main__":
+    run()
@@ -1,15 +1,16 @@
 import os.path
+import numpy as np
 import pandas as pd
 from datetime import date
 from distutils import dir_util
 
-import requests
 from pandas.io.json import json_normalize
 
 from resources import constants
-from utils import data_utils, api_utils
+from utils import data_utils, api_utils, http_utils, publish_utils
 import time
 import json
+import sys
 
 """
 This script currently updates the committed and paid funding for appeals, and replaces the old `funding_progress.csv` file.
@@ -53,7 +54,7 @@ def getCountries():
     return data
 
 
-def updateCommittedAndPaidFunding(year=constants.FTS_APPEAL_YEAR):
+def updateCommittedAndPaidFunding(year=constants.FTS_APPEAL_YEAR, max_workers=constants.FTS_MAX_CONCURRENCY):
     data = pd.read_csv('resources/data/derived/example/funding_progress.csv', encoding='utf-8')
 
     # Get committed and paid funding from the FTS API
@@ -62,21 +63,21 @@ def updateCommittedAndPaidFunding(year=constants.FTS_APPEAL_YEAR):
         funded = plan_funds[(plan_funds.boundary == 'incoming') & (plan_funds.status != 'pledge')]
         return funded['amountUSD'].sum()
 
-    data['appealFunded'] = data['id'].apply(pull_committed_funding_for_plan)
+    data['appealFunded'] = http_utils.ordered_map(pull_committed_funding_for_plan, data['id'], max_workers)
     data['percentFunded'] = data.appealFunded / data.revisedRequirements
 
     return data
 
 
-def getInitialRequiredAndCommittedFunding(data):
+def getInitialRequiredAndCommittedFunding(data, max_workers=constants.FTS_MAX_CONCURRENCY):
 
     # Get committed and paid funding from the FTS API
     def pull_committed_funding_for_plan(plan_id):
         plan_funds = api_utils.get_fts_endpoint('/public/fts/flow?planId={}'.format(plan_id), 'incoming')
-        funded = plan_funds['fundingTotal']
+        funded = plan_funds['fundingTotal'].iloc[0]
         return funded
 
-    data['appealFunded'] = data['id'].apply(pull_committed_funding_for_plan)
+    data['appealFunded'] = http_utils.ordered_map(pull_committed_funding_for_plan, data['id'], max_workers)
     
     # Calculate percent funded
     data['percentFunded'] = data.appealFunded / data.revisedRequirements
@@ -86,23 +87,34 @@ def getInitialRequiredAndCommittedFunding(data):
     return data
 
 
-def getDonorPlanFundingAmounts(plans):
+def concat_results(results, columns):
+    """
+    Combine the given results (dataframes, or None when there was no data) into a single dataframe with the given
+    columns, in that order. The results are collected then concatenated once, rather than appended one by one,
+    which would copy the combined data set for every result.
+    """
+    frames = [result for result in results if result is not None]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True).reindex(columns=columns)
+
+
+def getDonorPlanFundingAmounts(plans, max_workers=constants.FTS_MAX_CONCURRENCY):
     """
     For each plan, pull the amount funded by each donor.
     Since the path to the right data in the json is very long, I couldn't sort out how to keep the path in a variable.
 
     """
     # TODO: make a helper function like api_utils.get_fts_endpoint() that can take a very long key chain
-    # TODO: make column indexes of final output a constant
     # TODO: add metadata! With update date.
+    fts_client = http_utils.get_fts_client()
+
     def getFundingByDonorOrg(plan_id):
-        url = None
         endpoint_str = '/public/fts/flow?planId={}&groupby=Organization'.format(plan_id)
-        url = constants.FTS_API_BASE_URL + endpoint_str
-        result = requests.get(url, auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD))
-        result.raise_for_status()
-        if len(result.json()['data']['report1']['fundingTotals']['objects']) > 0:
-            result = json_normalize(result.json()['data']['report1']['fundingTotals']['objects'][0]['singleFundingObjects'])
+        url = fts_client.get_url(endpoint_str)
+        result = fts_client.get_json(endpoint_str)
+        if len(result['data']['report1']['fundingTotals']['objects']) > 0:
+            result = json_normalize(result['data']['report1']['fundingTotals']['objects'][0]['singleFundingObjects'])
             result['plan_id'] = plan_id
         else:
             print 'Empty data from this endpoint: {}'.format(url)
@@ -111,37 +123,38 @@ def getDonorPlanFundingAmounts(plans):
 
     plan_ids = plans['id']
 
-    data = pd.DataFrame([])
-
-    #loop through each plan and append the donor data for it to a combined data set
-    for plan in plan_ids:
-        funding = getFundingByDonorOrg(plan)
-        data = data.append(funding)
+    #fetch the donor data for each plan concurrently, then combine it into a single data set in plan order
+    results = http_utils.ordered_map(getFundingByDonorOrg, plan_ids, max_workers)
+    data = concat_results(results, constants.FTS_DONOR_PLAN_FUNDING_COLUMNS)
 
     data = data.merge(plans, how='left', left_on='plan_id', right_on='id')
-    data.drop(['behavior','id_y', 'direction', 'type'], axis=1,inplace=True)
-    data.columns = (['organization_id', 'organization_name', 'totalFunding', 'plan_id', 'plan_code', 'plan_name','countryCode'])
+    data.rename(columns={'id_x': 'organization_id',
+                         'name_x': 'organization_name',
+                         'code': 'plan_code',
+                         'name_y': 'plan_name'
+                         }, inplace=True)
+    data = data[constants.FTS_DONOR_PLAN_OUTPUT_COLUMNS]
 
     return data
 
 
-def getTopDonorCountryFundingAmounts(countries, year, top=False, top_n=5):
+def getTopDonorCountryFundingAmounts(countries, year, top=False, top_n=5, max_workers=constants.FTS_MAX_CONCURRENCY):
     """
     For each plan, pull the amount funded by each donor.
     Since the path to the right data in the json is very long, I couldn't sort out how to keep the path in a variable.
 
     """
     # TODO: add metadata! With update date.
+    fts_client = http_utils.get_fts_client()
+
     def getDonorByCountry(country, year, top, top_n):
         endpoint_str = '/public/fts/flow?locationid={}&year={}&groupBy=organization'.format(country, year)
-        url = 'https://api.hpc.tools/v1' + endpoint_str
-        result = requests.get(url, auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD))
-        result.raise_for_status()
-        if result.json()['data']['report1']['fundingTotals']['total'] == 0:
+        result = fts_client.get_json(endpoint_str)
+        if result['data']['report1']['fundingTotals']['total'] == 0:
             single = None
             print ('No funding data for country {} in {}'.format(country, year))
         else:
-            single = result.json()['data']['report1']['fundingTotals']['objects'][0]['singleFundingObjects']
+            single = result['data']['report1']['fundingTotals']['objects'][0]['singleFundingObjects']
 
         if single:
             single = json_normalize(single)
@@ -154,40 +167,41 @@ def getTopDonorCountryFundingAmounts(countries, year, top=False, top_n=5):
 
     country_ids = countries['id']
 
-    data = pd.DataFrame([])
-
-    #loop through each plan and append the donor data for it to a combined data set
-    for country_id in country_ids:
+    def getDonorByCountryId(country_id):
         print 'Getting funding for country: {}'.format(country_id)
-        funding = getDonorByCountry(country_id, year, top, top_n)
-        print 'Done. Appending...'
-        data = data.append(funding)
+        return getDonorByCountry(country_id, year, top, top_n)
+
+    #fetch the donor data for each country concurrently, then combine it into a single data set in country order
+    results = http_utils.ordered_map(getDonorByCountryId, country_ids, max_workers)
+    data = concat_results(results, constants.FTS_DONOR_COUNTRY_FUNDING_COLUMNS)
 
     data = data.merge(countries, how='left', left_on='dest_country_id', right_on='id')
-    data.drop(['behavior','id_x', 'direction', 'type', 'dest_country_id', 'id_y'], axis=1,inplace=True)
-    data.columns = (['organization_name', 'totalFunding', 'year', 'countryCode', 'Country'])
+    data.rename(columns={'name_x': 'organization_name',
+                         'iso3': 'countryCode',
+                         'name_y': 'Country'
+                         }, inplace=True)
+    data = data[constants.FTS_DONOR_COUNTRY_OUTPUT_COLUMNS]
 
     return data
 
 
-def getClusterFundingAmounts(plans):
+def getClusterFundingAmounts(plans, max_workers=constants.FTS_MAX_CONCURRENCY):
     """
     For each plan, pull the amount required and funded at the cluster level.
 
     """
     # TODO: make a helper function like api_utils.get_fts_endpoint() that can take a very long key chain
-    # TODO: make column indexes of final output a constant
     # TODO: add metadata! With update date.
 
+    fts_client = http_utils.get_fts_client()
+
     def getFundingByCluster(plan_id):
-        url = None
         endpoint_str = '/public/fts/flow?planId={}&groupby=Cluster'.format(plan_id)
-        url = 'https://api.hpc.tools/v1' + endpoint_str
-        result = requests.get(url, auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD))
-        result.raise_for_status()
+        url = fts_client.get_url(endpoint_str)
+        result = fts_client.get_json(endpoint_str)
 
         #Get the required funding amounts for each cluster
-        requirements = result.json()['data']['requirements']
+        requirements = result['data']['requirements']
         if requirements and 'objects' in requirements:
             requirements = requirements['objects']
             requirements = json_normalize(requirements)
@@ -197,8 +211,8 @@ def getClusterFundingAmounts(plans):
             requirements = None
 
         #Get the actual funded amounts for each cluster
-        if len(result.json()['data']['report3']['fundingTotals']['objects']) > 0:
-            funding = json_normalize(result.json()['data']['report3']['fundingTotals']['objects'][0]['singleFundingObjects'])
+        if len(result['data']['report3']['fundingTotals']['objects']) > 0:
+            funding = json_normalize(result['data']['report3']['fundingTotals']['objects'][0]['singleFundingObjects'])
             funding['plan_id'] = plan_id
         else:
             print ('Empty data from this endpoint: {}'.format(url))
@@ -214,47 +228,47 @@ def getClusterFundingAmounts(plans):
 
     plan_ids = plans['id']
 
-    data = pd.DataFrame([])
+    def getFundingByClusterForPlan(plan_id):
+        print ('Getting for plan {}'.format(plan_id))
+        return getFundingByCluster(plan_id)
 
-    #loop through each plan and append the donor data for it to a combined data set
-    for plan in plan_ids:
-        print ('Getting for plan {}'.format(plan))
-        funding = getFundingByCluster(plan)
-        print ('Success! Appending plan {}'.format(plan))
-        data = data.append(funding)
+    #fetch the cluster data for each plan concurrently, then combine it into a single data set in plan order
+    results = http_utils.ordered_map(getFundingByClusterForPlan, plan_ids, max_workers)
+    data = concat_results(results, constants.FTS_CLUSTER_FUNDING_COLUMNS)
     #TODO: if a plan result in an error, skip that and move on
 
     #Merge on plan information for reference
     data = data.merge(plans, how='left', left_on='plan_id', right_on='id')
 
-    #Select certain columns and rename them
-    data = data[['name_x', 'revisedRequirements', 'totalFunding', 'plan_id','code','name_y','countryCode']]
-    data.columns = (['cluster', 'revisedRequirements', 'totalFunding', 'plan_id', 'plan_code', 'plan_name','countryCode'])
+    #Rename the columns
+    data.rename(columns={'name_x': 'cluster',
+                         'code': 'plan_code',
+                         'name_y': 'plan_name'
+                         }, inplace=True)
 
     #Replace NaN funded amounts with 0s
     data.totalFunding = data.totalFunding.fillna(0)
     #Calculate percent funded
     data['percentFunded'] = data['totalFunding']/data['revisedRequirements']
 
-    return data
+    return data[constants.FTS_CLUSTER_OUTPUT_COLUMNS]
 
 
-def getCountryFundingAmounts(year_list, country_mapping):
+def getCountryFundingAmounts(year_list, country_mapping, max_workers=constants.FTS_MAX_CONCURRENCY):
     """
     For each country, pull the amount of funding received in each year.
     Since the path to the right data in the json is very long, I couldn't sort out how to keep the path in a variable.
 
     """
     # TODO: make a helper function like api_utils.get_fts_endpoint() that can take a very long key chain
-    # TODO: make column indexes of final output a constant
     # TODO: add metadata! With update date.
+    fts_client = http_utils.get_fts_client()
+
     def getActualFundingByCountryGroup(year):
-        url = None
         endpoint_str = '/public/fts/flow?year={}&groupby=Country'.format(year)
-        url = 'https://api.hpc.tools/v1' + endpoint_str
-        result = requests.get(url, auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD))
-        result.raise_for_status()
-        single = result.json()['data']['report3']['fundingTotals']['objects'][0]['singleFundingObjects']
+        url = fts_client.get_url(endpoint_str)
+        result = fts_client.get_json(endpoint_str)
+        single = result['data']['report3']['fundingTotals']['objects'][0]['singleFundingObjects']
         if single:
             single = json_normalize(single)
             single['year'] = year
@@ -263,15 +277,11 @@ def getCountryFundingAmounts(year_list, country_mapping):
             single = None
         return single
 
-    data = pd.DataFrame([])
-
-    #loop through each year and append the data for it to a combined data set
-    for year in year_list:
-        funding = getActualFundingByCountryGroup(year)
-        data = data.append(funding)
+    #fetch the data for each year concurrently, then combine it into a single data set in year order
+    results = http_utils.ordered_map(getActualFundingByCountryGroup, year_list, max_workers)
+    data = concat_results(results, constants.FTS_COUNTRY_FUNDING_COLUMNS)
 
     data = data.merge(country_mapping, how='left', on=['name','id'])
-    data.drop(['id', 'direction', 'type'], axis=1,inplace=True)
 
     #Rename column headings
     data.rename(columns={'name': 'Country',
@@ -279,9 +289,8 @@ def getCountryFundingAmounts(year_list, country_mapping):
                              }, inplace=True)
 
     data = data.sort_values(['Country','year'])
-    #data.columns = (['organization_id', 'organization_name', 'totalFunding', 'plan_id', 'plan_code', 'plan_name','countryCode'])
 
-    return data
+    return data[constants.FTS_COUNTRY_OUTPUT_COLUMNS]
 
 
 
@@ -417,18 +426,122 @@ def loadDataByDimension(dimension):
 #     print 'Done!'
 
 
-def prepend_metadata(metadata, filepath):
-    with open(filepath, 'r') as original:
-        data = original.read()
-    with open(filepath, 'w') as modified:
-        modified.write('#')
-        json.dump(metadata, modified)
-        modified.write('\n' + data)
+def save_derived_data(data, file_name, metadata, publication):
+    """
+    Save the given dataframe as the given derived data file_name with the given metadata prepended,
+    along with its pre-compressed variants and typed columnar copy, in the given version of the derived data
+    to publish for the API to serve (see `utils/publish_utils.py`).
+    """
+    official_data_path = publication.path(file_name)
+    data_utils.write_csv_with_metadata(data, official_data_path, metadata, encoding='utf-8', index=False)
+    data_utils.write_compressed_variants(official_data_path)
+    data_utils.write_columnar(official_data_path)
+
+
+def load_derived_data(file_name):
+    """
+    Load the given derived data file_name published by a previous run (see save_derived_data), from its typed columnar
+    copy if there is an up to date one. Return None if the file doesn't exist.
+    """
+    official_data_path = os.path.join(publish_utils.get_published_data_path(), file_name)
+    if data_utils.has_current_columnar(official_data_path):
+        return data_utils.read_columnar(data_utils.get_columnar_path(official_data_path))[0]
+    if not os.path.exists(official_data_path):
+        return None
+    return pd.read_csv(official_data_path, encoding='utf-8', header=1)
+
+
+def load_state():
+    """
+    Load the state saved by the last incremental run (see save_state), or return an empty state if there is none.
+    """
+    try:
+        with open(constants.FTS_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'plans': {}}
+
 
+def save_state(state):
+    """
+    Save the given state for the next incremental run, replacing the previous state file atomically.
+    """
+    state_dir = os.path.dirname(constants.FTS_STATE_FILE)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    temp_path = constants.FTS_STATE_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(temp_path, constants.FTS_STATE_FILE)
 
-def run():
+
+def get_plan_states(funding, previous_state, update_date):
+    """
+    Return the state of each plan in the given plan-level funding data (see getInitialRequiredAndCommittedFunding),
+    i.e. the details and totals that its donor and cluster breakdowns depend on, keyed by plan id (as a string).
+    Each plan's "updated" marker is the given update_date if its state changed since the given previous_state.
+    """
+    plan_states = {}
+    for plan in funding[['id', 'code', 'name', 'countryCode', 'revisedRequirements', 'appealFunded']].to_dict('records'):
+        plan_id = str(plan['id'])
+        state = {
+            'code': plan['code'],
+            'name': plan['name'],
+            'countryCode': plan['countryCode'],
+            'revisedRequirements': None if pd.isnull(plan['revisedRequirements']) else float(plan['revisedRequirements']),
+            'appealFunded': None if pd.isnull(plan['appealFunded']) else float(plan['appealFunded'])
+        }
+        previous = dict(previous_state['plans'].get(plan_id, {}))
+        updated = previous.pop('updated', None)
+        state['updated'] = updated if previous == state else update_date
+        plan_states[plan_id] = state
+    return plan_states
+
+
+def patch_plan_data(existing, updated, plan_ids, changed_plan_ids):
+    """
+    Patch the given existing per-plan derived data: replace the rows of the given changed_plan_ids with their rows in
+    the given updated data, and drop the rows of plans that are no longer in the given plan_ids.
+    Return the patched data with the rows in plan_ids order (and each plan's rows in their original order), as if it
+    was pulled from scratch.
+    """
+    kept = existing[~existing['plan_id'].isin(changed_plan_ids)]
+    data = pd.concat([kept, updated], ignore_index=True).reindex(columns=updated.columns)
+    plan_positions = data['plan_id'].map(pd.Series(np.arange(len(plan_ids)), index=plan_ids))
+    data = data[plan_positions.notnull()]
+    order = np.argsort(plan_positions[plan_positions.notnull()].values, kind='mergesort')
+    return data.iloc[order].reset_index(drop=True)
+
+
+def refresh_plan_data(get_plan_data, plan_index, changed_plan_ids, file_name):
+    """
+    Pull the per-plan data saved as the given derived data file_name with the given get_plan_data function
+    (e.g. getDonorPlanFundingAmounts), only for the plans in the given plan_index whose ids are in changed_plan_ids,
+    and patch the data saved by the previous run with it (see patch_plan_data).
+    Pull the data for all plans if every plan changed or there is no previous data.
+    """
+    if len(changed_plan_ids) == len(plan_index):
+        return get_plan_data(plan_index)
+    existing = load_derived_data(file_name)
+    if existing is None:
+        return get_plan_data(plan_index)
+    changed_plans = plan_index[plan_index['id'].isin(changed_plan_ids)]
+    updated = get_plan_data(changed_plans)
+    return patch_plan_data(existing, updated, list(plan_index['id']), changed_plan_ids)
+
+
+def run(offline=False, incremental=False):
+    """
+    Pull the latest FTS data and publish the derived data files as a new version (see `utils/publish_utils.py`).
+    FTS API responses are cached on disk (see `constants.FTS_CACHE_PATH`), so reruns only revalidate or re-download
+    what may have changed. If offline is True, only the cached responses are used, without any request to the API.
+    If incremental is True, the plan-level totals are compared to the ones saved by the previous incremental run
+    (see `constants.FTS_STATE_FILE`), and the donor and cluster breakdowns are only pulled for the plans that changed,
+    then patched into the previously derived data.
+    """
 
     t0 = time.time()
+    http_utils.get_fts_client().offline = offline
 
     # Hardcode FTS metadata
     metadata = {}
@@ -438,60 +551,67 @@ def run():
     metadata['source_url'] = 'https://fts.unocha.org'
     metadata['update_frequency'] = 'Hourly'
 
-    print 'Get list of countries and ISO-3 codes'
-    countries = getCountries()
-    print countries.head()
+    print 'Pull and publish the derived data'
+    with publish_utils.Publication() as publication:
+        print 'Get list of countries and ISO-3 codes'
+        countries = getCountries()
+        print countries.head()
+
+
+        print 'Get list of plans'
+        plans = getPlans(year=constants.FTS_APPEAL_YEAR, country_mapping = countries)
+        print plans.head()
 
+        #Filter plans to only include those that are not RRPs and where the funding requirement is > 0
+        plans = plans[(plans.categoryName != 'Regional response plan') & (plans.revisedRequirements > 0)]
 
-    print 'Get list of plans'
-    plans = getPlans(year=constants.FTS_APPEAL_YEAR, country_mapping = countries)
-    print plans.head()
+        plan_index = plans[['id', 'code', 'name', 'countryCode']]
 
-    #Filter plans to only include those that are not RRPs and where the funding requirement is > 0
-    plans = plans[(plans.categoryName != 'Regional response plan') & (plans.revisedRequirements > 0)]
 
-    plan_index = plans[['id', 'code', 'name', 'countryCode']]
+        print 'Get required and committed funding from the FTS API'
+        initial_result = getInitialRequiredAndCommittedFunding(plans)
+        print initial_result.head()
+        save_derived_data(initial_result, 'funding_progress.csv', metadata, publication)
 
+        previous_state = load_state() if incremental else {'plans': {}}
+        plan_states = get_plan_states(initial_result, previous_state, metadata['extract_date'])
+        changed_plan_ids = [plan_id for plan_id in plan_index['id']
+                            if plan_states[str(plan_id)] != previous_state['plans'].get(str(plan_id))]
+        print '{} of {} plans changed since the last incremental run'.format(len(changed_plan_ids), len(plan_index))
 
-    print 'Get required and committed funding from the FTS API'
-    initial_result = getInitialRequiredAndCommittedFunding(plans)
-    print initial_result.head()
-    official_data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, 'funding_progress.csv')
-    initial_result.to_csv(official_data_path, encoding='utf-8', index=False)
-    prepend_metadata(metadata, official_data_path)
+        print 'Get donor funding amounts to each plan from the FTS API'
+        donor_funding_plan = refresh_plan_data(getDonorPlanFundingAmounts, plan_index, changed_plan_ids,
+                                               'funding_donors_appeal.csv')
+        print donor_funding_plan.head()
+        save_derived_data(donor_funding_plan, 'funding_donors_appeal.csv', metadata, publication)
 
-    print 'Get donor funding amounts to each plan from the FTS API'
-    donor_funding_plan = getDonorPlanFundingAmounts(plan_index)
-    print donor_funding_plan.head()
-    official_data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, 'funding_donors_appeal.csv')
-    donor_funding_plan.to_csv(official_data_path, encoding='utf-8', index=False)
-    prepend_metadata(metadata, official_data_path)
+        print 'Get required and committed funding at the cluster level from the FTS API'
+        cluster_funding = refresh_plan_data(getClusterFundingAmounts, plan_index, changed_plan_ids,
+                                            'funding_clusters.csv')
+        print cluster_funding.head()
+        save_derived_data(cluster_funding, 'funding_clusters.csv', metadata, publication)
 
-    print 'Get required and committed funding at the cluster level from the FTS API'
-    cluster_funding = getClusterFundingAmounts(plan_index)
-    print cluster_funding.head()
-    official_data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, 'funding_clusters.csv')
-    cluster_funding.to_csv(official_data_path, encoding='utf-8', index=False)
-    prepend_metadata(metadata, official_data_path)
+        print 'Get funding by destination country for given years'
+        country_funding = getCountryFundingAmounts(range(2015, 2018), countries)
+        print country_funding.head()
+        save_derived_data(country_funding, 'funding_dest_countries.csv', metadata, publication)
 
-    print 'Get funding by destination country for given years'
-    country_funding = getCountryFundingAmounts(range(2015, 2018), countries)
-    print country_funding.head()
-    official_data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, 'funding_dest_countries.csv')
-    country_funding.to_csv(official_data_path, encoding='utf-8', index=False)
-    prepend_metadata(metadata, official_data_path)
+        print 'Get top donors by destination country for given years'
+        donor_funding_country = getTopDonorCountryFundingAmounts(countries, 2016, top=True, top_n=5)
+        print donor_funding_country.head()
+        save_derived_data(donor_funding_country, 'funding_donors_country.csv', metadata, publication)
+    save_state({'plans': plan_states})  # Only once the data it describes was published
 
-    print 'Get top donors by destination country for given years'
-    donor_funding_country = getTopDonorCountryFundingAmounts(countries, 2016, top=True, top_n=5)
-    print donor_funding_country.head()
-    official_data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, 'funding_donors_country.csv')
-    donor_funding_country.to_csv(official_data_path, encoding='utf-8', index=False)
-    prepend_metadata(metadata, official_data_path)
+    if not offline:
+        # The responses used by this run were just fetched or revalidated, older ones are of urls no longer requested
+        pruned = http_utils.get_fts_client().cache.prune(constants.FTS_CACHE_CLOSED_YEAR_TTL)
+        print 'Pruned {} stale responses from the FTS cache'.format(pruned)
 
     print 'Done!'
     print 'Total time taken in minutes: {}'.format((time.time() - t0)/60)
+    print 'FTS API requests: {}'.format(http_utils.get_fts_client().stats())
 
 
 
 if __name__ == "__main__":
-    run()
+    run(offline='offline' in sys.argv[1:], incremental='incremental' in sys.argv[1:])
@@ -1,21 +1,28 @@
 import os.path
 import json
+import threading
 import pandas as pd
-from datetime import date
-from distutils import dir_util
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from datetime import date, datetime
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 
 from hdx.configuration import Configuration
 from hdx.data.dataset import Dataset
 
 from resources import constants
-from utils import data_utils
+from utils import data_utils, http_utils, snapshot_utils
 
 
-def getDataset(dataset_name):
+def readDataset(dataset_name, site_env):
     """
     An HDX Dataset (sub-URL) is a collection of one or more Resources (raw data files).
 
-    Return the Dataset and its list of Resources.
+    Read the given dataset_name from the HDX site environment that is currently configured (the given site_env).
+    Return a tuple of the Dataset (or None if it doesn't exist or couldn't be read) and an error message (or None).
 
     Example:
       URL: https://feature-data.humdata.org/dataset/lake-chad-basin-fts-appeal-data
@@ -25,72 +32,240 @@ def getDataset(dataset_name):
       dataset = Dataset.read_from_hdx(dataset_name)  # downloads the given dataset_name
     """
 
-    print('Get %s Dataset from HDX...' % dataset_name)
-    dataset = None
-    for site_env in constants.HDX_SITES:
-        try:
-            print('Try configuration with hdx_site = %s...' % site_env)
-            Configuration.create(hdx_site=site_env, hdx_read_only=True)
-            dataset = Dataset.read_from_hdx(dataset_name)
-        except Exception as e:
-            print('Exception when trying to read dataset from env [%s]: %s!' % (site_env, e))
+    print('Get %s Dataset from HDX env [%s]...' % (dataset_name, site_env))
+    try:
+        dataset = Dataset.read_from_hdx(dataset_name)
+    except Exception as e:
+        print('Exception when trying to read dataset from env [%s]: %s!' % (site_env, e))
+        return None, 'could not be read from env [%s]: %s' % (site_env, e)
+    if not dataset:
+        print('Configuration works but dataset name [%s] does not exist in env [%s]!' % (dataset_name, site_env))
+        return None, 'does not exist in env [%s]' % site_env
+
+    print('Successfully found dataset from env [%s]: [%s] with %d resources, expected update frequency: %s'
+          % (site_env, dataset_name, len(dataset.resources), dataset.get_expected_update_frequency()))
+    return dataset, None
+
+
+def readDatasets(dataset_names, site_env, max_workers=constants.HDX_DISCOVERY_WORKERS):
+    """
+    Read the given dataset_names from the given HDX site environment concurrently, with at most max_workers at a time.
+    The HDX configuration is global, so it's created once for the site_env before reading all of them.
+    Return a dict of the Datasets found by name, and a dict of the error message of each Dataset that wasn't found.
+    """
+    try:
+        print('Try configuration with hdx_site = %s...' % site_env)
+        Configuration.create(hdx_site=site_env, hdx_read_only=True)
+    except Exception as e:
+        print('Exception when trying to configure env [%s]: %s!' % (site_env, e))
+        return {}, dict((dataset_name, 'could not configure env [%s]: %s' % (site_env, e)) for dataset_name in dataset_names)
+    results = http_utils.ordered_map(lambda dataset_name: readDataset(dataset_name, site_env), dataset_names, max_workers)
+    datasets = {}
+    errors = {}
+    for dataset_name, (dataset, error) in zip(dataset_names, results):
+        if dataset:
+            datasets[dataset_name] = dataset
         else:
-            if not dataset:
-                print('Configuration works but dataset name [%s] does not exist!' % dataset_name)
-            else:
-                print('Successfully found dataset from env [%s]: [%s]' % (site_env, dataset_name))
-                break
+            errors[dataset_name] = error
+    return datasets, errors
 
-    if not dataset:
-        print('Dataset [%s] does not exist despite trying all hdx_site envs!' % dataset_name)
-        raise  
 
-    print('Extract metadata from dataset:')
-    #print(dataset.get_dataset_date())  # This doesn't always exist, optional? what is guaranteed?
-    print(dataset.get_expected_update_frequency())  # This should be guaranteed, see `constants.py`
-    print(dataset.get_location())
-    print(dataset.get_tags())
+def loadSiteCache():
+    """
+    Load the site env and resource names each HDX dataset was last found with (see saveSiteCache),
+    or return an empty cache if there is none.
+    """
+    try:
+        with open(constants.HDX_SITE_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-    print('Get number of resources from dataset...')
-    resources = dataset.resources
-    print(len(resources))
 
-    print('Done downloading this dataset')
-    return dataset
+def saveSiteCache(site_cache):
+    """
+    Save the given site cache for the next runs, replacing the previous cache file atomically.
+    """
+    cache_dir = os.path.dirname(constants.HDX_SITE_CACHE_FILE)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    temp_path = constants.HDX_SITE_CACHE_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(site_cache, f, indent=2, sort_keys=True)
+    os.rename(temp_path, constants.HDX_SITE_CACHE_FILE)
 
 
-def downloadResources(dataset, download_path=constants.RAW_DATA_PATH, current_date_str=date.today().isoformat()):
+def isSiteCacheEntryFresh(entry, current_date_str):
     """
-    Given an HDX Dataset with a list of HDX Resources, download its Resource files and load them as pandas dataframes.
-    Return a dictionary of Resource filenames and their corresponding loaded pandas dataframes.
-    Note: this assumes all resources are csv files, and calls the function loadResourceFromPath().
+    Return whether the given site cache entry is recent enough to read its dataset from its site env first.
     """
-    resources = dataset.resources
-    print('Load %d resources' % len(resources))
+    if not entry or entry.get('site') not in constants.HDX_SITES:
+        return False
+    age = datetime.strptime(current_date_str, '%Y-%m-%d') - datetime.strptime(entry['discovered'], '%Y-%m-%d')
+    return age.days < constants.HDX_SITE_CACHE_MAX_AGE
 
-    # Construct metadata for each resource
+
+def getSiteOrder(dataset_name, site_cache, current_date_str):
+    """
+    Return the list of HDX site envs to read the given dataset_name from, in order: the one it was last found on
+    according to the given site_cache first if its entry is fresh, then the others in `constants.HDX_SITES` order.
+    """
+    entry = site_cache.get(dataset_name)
+    if not isSiteCacheEntryFresh(entry, current_date_str):
+        return list(constants.HDX_SITES)
+    return [entry['site']] + [site_env for site_env in constants.HDX_SITES if site_env != entry['site']]
+
+
+def updateSiteCache(site_cache, dataset_name, dataset, site_env, current_date_str):
+    """
+    Record in the given site_cache that the given dataset_name was found on the given site_env with the given Dataset's
+    resources. Its discovery date is only reset if it wasn't found on the site env of its fresh entry (i.e. it was
+    looked up in `constants.HDX_SITES` order).
+    Return the names of the resources found last time that the Dataset no longer has.
+    """
+    entry = site_cache.get(dataset_name)
+    resource_names = [resource.get('name') for resource in dataset.resources]
+    if isSiteCacheEntryFresh(entry, current_date_str) and entry['site'] == site_env:
+        discovered = entry['discovered']
+    else:
+        discovered = current_date_str
+    site_cache[dataset_name] = {'site': site_env, 'resources': resource_names, 'discovered': discovered}
+    return [name for name in (entry or {}).get('resources', []) if name not in resource_names]
+
+
+def getResourceMetadata(dataset, current_date_str):
+    """
+    Construct the metadata prepended to each Resource file of the given HDX Dataset (see downloadResource).
+    """
     metadata = {}
     metadata['source_date'] = 'Unknown'  # HDX does not appear to surface latest update date
     metadata['extract_date'] = current_date_str
     metadata['update_frequency'] = dataset.get_expected_update_frequency()
     metadata['source_key'] = 'HDX'
+    return metadata
 
-    resource_dfs = {}
-    for resource in resources:
-        resource_url, resource_path = resource.download(download_path)
-        print('Resource URL %s downloaded to %s' % (resource_url, resource_path))
-        metadata['source_url'] = resource_url
-        resource_filename = os.path.basename(resource_path)
+
+def isUnchangedResource(resource_path, metadata, previous_path):
+    """
+    Return whether the given downloaded Resource file (before its metadata is prepended) has the same contents as the
+    given previously downloaded one (e.g. in the latest data directory), and the same metadata apart from its extract_date.
+    """
+    if not os.path.isfile(previous_path):
+        return False
+    with open(previous_path, 'rb') as previous_file:
+        previous_metadata = data_utils.read_metadata_line(previous_file)
+        if previous_metadata is None or dict(previous_metadata, extract_date=None) != dict(metadata, extract_date=None):
+            return False
+        with open(resource_path, 'rb') as resource_file:
+            return data_utils.has_same_content(previous_file, resource_file)
+
+
+def getResourceFileName(resource):
+    """
+    Return the name of the file the given HDX Resource is downloaded to (the last part of its URL path, see
+    `Resource.download`), or its name if it has no URL.
+    """
+    return os.path.basename(urlsplit(resource.get('url') or '').path) or resource.get('name')
+
+
+def downloadResource(resource, download_path, metadata):
+    """
+    Download the given HDX Resource file into the given download_path, and prepend the given metadata (along with the
+    Resource URL as its source_url) to it as its first line.
+    If the file didn't change since it was last downloaded into the latest data directory, it's replaced by that one
+    instead (keeping the extract_date of when it was first downloaded, see getExtracts for the date of this run), so
+    the raw data snapshots can share it.
+    The file is then added to the raw data snapshot store (see `utils/snapshot_utils.py`).
+    Return the path of the downloaded file.
+    """
+    # The Resource is downloaded in place, and a file downloaded earlier with the same name (e.g. by another Dataset)
+    # is already a stored file
+    snapshot_utils.unshare_file(os.path.join(download_path, getResourceFileName(resource)))
+    resource_url, resource_path = resource.download(download_path)
+    print('Resource URL %s downloaded to %s' % (resource_url, resource_path))
+    metadata = dict(metadata, source_url=resource_url)
+    previous_path = os.path.join(constants.LATEST_RAW_DATA_PATH, os.path.basename(resource_path))
+    if isUnchangedResource(resource_path, metadata, previous_path):
+        snapshot_utils.replace_with_link(previous_path, resource_path)
+    else:
         # Rewrite file, prepending metadata as the first line
-        with open(resource_path, 'r') as data_file:
-            with open('temp_{}'.format(resource_filename), 'w') as metadata_file:
-                metadata_file.write('#{}\n'.format(json.dumps(metadata)))
-                metadata_file.write(data_file.read())
-        os.rename('temp_{}'.format(resource_filename), resource_path)
-        resource_dfs[resource_filename] = loadResourceFromPath(resource_path)
+        data_utils.prepend_metadata(resource_path, metadata)
+    snapshot_utils.store_file(resource_path)
+    return resource_path
+
+
+def downloadResources(datasets, download_path=constants.RAW_DATA_PATH, current_date_str=None,
+                      download_workers=constants.HDX_DOWNLOAD_WORKERS, parse_workers=constants.HDX_PARSE_WORKERS):
+    """
+    Given a dict of HDX Datasets by name, each with a list of HDX Resources, download their Resource files and load them
+    as pandas dataframes. A pool of download_workers threads downloads the files of all the Datasets, and a pool of
+    parse_workers threads loads each file as soon as it's downloaded, so a slow Resource doesn't hold up the others.
+    Resources downloaded to the same file name (e.g. by different Datasets) would overwrite each other's file while it's
+    written or loaded, so they are downloaded and loaded one after the other instead (in the given order).
+    The metadata extract_date is the given current_date_str (today by default).
+    Return a dict of the Resource filenames and their corresponding loaded pandas dataframes of each Dataset by name,
+    and a dict of the error messages of each Dataset by name (one for each Resource that couldn't be downloaded or loaded).
+    Note: this assumes all resources are csv files, and calls the function loadResourceFromPath().
+    """
+    if current_date_str is None:
+        current_date_str = date.today().isoformat()
+    resource_dfs = dict((dataset_name, {}) for dataset_name in datasets)
+    errors = dict((dataset_name, []) for dataset_name in datasets)
+    lock = threading.Lock()
+    download_pool = ThreadPool(download_workers)
+    parse_pool = ThreadPool(parse_workers)
+
+    def load(dataset_name, resource_path):
+        resource_filename = os.path.basename(resource_path)
+        try:
+            df = loadResourceFromPath(resource_path)
+        except Exception as e:
+            print('Exception when trying to load resource %s: %s!' % (resource_path, e))
+            with lock:
+                errors[dataset_name].append('could not load resource %s: %s' % (resource_filename, e))
+            return
+        with lock:
+            resource_dfs[dataset_name][resource_filename] = df
+
+    def download(downloads):
+        # The downloads of a same file name are loaded right away, before the next one overwrites the file
+        for dataset_name, resource, metadata in downloads:
+            try:
+                resource_path = downloadResource(resource, download_path, metadata)
+            except Exception as e:
+                print('Exception when trying to download resource %s: %s!' % (resource.get('name'), e))
+                with lock:
+                    errors[dataset_name].append('could not download resource %s: %s' % (resource.get('name'), e))
+                continue
+            if len(downloads) > 1:
+                load(dataset_name, resource_path)
+            else:
+                parse_pool.apply_async(load, (dataset_name, resource_path))
+
+    downloads_by_file_name = OrderedDict()
+    for dataset_name, dataset in datasets.items():
+        print('Load %d resources of %s' % (len(dataset.resources), dataset_name))
+        metadata = getResourceMetadata(dataset, current_date_str)
+        for resource in dataset.resources:
+            downloads_by_file_name.setdefault(getResourceFileName(resource), []).append((dataset_name, resource, metadata))
+    for file_name, downloads in downloads_by_file_name.items():
+        if len(downloads) > 1:
+            print('Download the %d resources named %s one after the other' % (len(downloads), file_name))
+
+    try:
+        for downloads in downloads_by_file_name.values():
+            download_pool.apply_async(download, (downloads,))
+        # All the loads are submitted once the downloads are done
+        download_pool.close()
+        download_pool.join()
+        parse_pool.close()
+        parse_pool.join()
+    finally:
+        download_pool.terminate()
+        parse_pool.terminate()
 
     print('Done downloading this list of resources')
-    return resource_dfs
+    return resource_dfs, errors
 
 
 def loadResourceFromPath(resource_path):
@@ -143,9 +318,9 @@ def joinResources(res1, res1_cols, res2, res2_cols, merge_key=None, merge_fn=Non
     res2_col_uniq = res2[res2_mcol].nunique()
     if res1_col_uniq != res2_col_uniq:
         print('Ambiguous: Columns to merge do not have the same number of unique values!')
-    #  - if values don't match in sorted dataframe, is there a custom merge_fn specified?
-    res1_col_val = res1.sort_values(res1_mcol, ascending=True)[res1_mcol].iloc[0]
-    res2_col_val = res2.sort_values(res2_mcol, ascending=True)[res2_mcol].iloc[0]
+    #  - if the first (smallest) values don't match, is there a custom merge_fn specified?
+    res1_col_val = res1[res1_mcol].min()
+    res2_col_val = res2[res2_mcol].min()
     merged_res = None
     if res1_col_val != res2_col_val and not merge_fn:
         print('Ambiguous: Missing custom merge function despite column values not matching!')
@@ -186,14 +361,9 @@ def mergeByCountryLatestDate(res1, res1_cols, res2, res2_cols, merge_key='countr
         # Assume columns have the same country values, no need to replace, just merge directly
         pass
 
-    # Get latest dates and filter df's for just the latest info
-    # Example: 
-    # res_latest = {'CHD': '2017-01-11', 'CMR': '2017-01-11'}
-    res1_latest = res1.groupby(res1_cols['country']).agg({res1_cols['date']: 'max'}).to_dict()[res1_cols['date']]
-    res2_latest = res2.groupby(res2_cols['country']).agg({res2_cols['date']: 'max'}).to_dict()[res2_cols['date']]
     # Filter df for just the latest info by country (should end up with one row per country, the row with the latest date)
-    res1 = res1[res1[list(res1_cols.values())].apply(lambda r: r[res1_cols['date']] == res1_latest[r[res1_cols['country']]], axis=1)]
-    res2 = res2[res2[list(res2_cols.values())].apply(lambda r: r[res2_cols['date']] == res2_latest[r[res2_cols['country']]], axis=1)]
+    res1 = data_utils.filter_latest(res1, res1_cols['country'], res1_cols['date'])
+    res2 = data_utils.filter_latest(res2, res2_cols['country'], res2_cols['date'])
 
     merged_res = res1.merge(res2, how='outer', left_on=res1_cols['country'], right_on=res2_cols['country'])
     return merged_res
@@ -203,7 +373,9 @@ def createCurrentDateDir(parent_dir):
     """
     Create a new directory with the current date (ISO format) under the given parent_dir.
     Return whether it was successful, the full path for the new directory, and the current date string.
-    If the date directory already exists or is not successful, default to returning the parent_dir as the full path.
+    If the date directory is not successful, default to returning the parent_dir as the full path. If it already
+    exists (e.g. the data is downloaded again on the same day), its files are unshared from the other raw data
+    snapshots first, so downloading them again doesn't modify those.
     """
     current_date_str = date.today().isoformat()
     dir_path = os.path.join(parent_dir, current_date_str)
@@ -215,18 +387,66 @@ def createCurrentDateDir(parent_dir):
         dir_path = parent_dir
     else:
         print("Created new raw data dir: %s" % dir_path)
+    snapshot_utils.unshare_directory(dir_path)
     return success, dir_path, current_date_str
 
 
+def getExtracts(download_path, file_names, current_date_str):
+    """
+    Return the extracts manifest entries (see `constants.RAW_EXTRACTS_FILE_NAME`) of the given file names downloaded
+    into the given download_path on the given current_date_str: the date of this run as their extract_date, and the
+    extract_date and source_url of their metadata line (first_extract_date is when their contents were first downloaded).
+    """
+    extracts = {}
+    for file_name in file_names:
+        with open(os.path.join(download_path, file_name), 'rb') as resource_file:
+            metadata = data_utils.read_metadata_line(resource_file) or {}
+        extracts[file_name] = {
+            'extract_date': current_date_str,
+            'first_extract_date': metadata.get('extract_date'),
+            'source_url': metadata.get('source_url'),
+        }
+    return extracts
+
+
+def loadExtracts(dir_path):
+    """
+    Load the extracts manifest of the given raw data directory (see saveExtracts), or return an empty one if there is none.
+    """
+    try:
+        with open(os.path.join(dir_path, constants.RAW_EXTRACTS_FILE_NAME), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveExtracts(dir_path, extracts):
+    """
+    Save the given extracts manifest in the given raw data directory, replacing the previous manifest file atomically
+    (so a manifest shared with another raw data directory isn't modified).
+    """
+    extracts_path = os.path.join(dir_path, constants.RAW_EXTRACTS_FILE_NAME)
+    temp_path = snapshot_utils.get_temp_path(extracts_path)
+    with open(temp_path, 'w') as f:
+        json.dump(extracts, f, indent=2, sort_keys=True)
+    os.rename(temp_path, extracts_path)
+
+
 def updateLatestDataDir(download_path, current_date_str):
     """
-    Copies all files from the given download_path into the latest data directory configured in
-    `resources/constants.py`. Appends to the run_dates.txt file with the current run date.
+    Links all files from the given download_path into the latest data directory configured in
+    `resources/constants.py` (only the files that changed are touched, see `utils/snapshot_utils.py`), and merges the
+    extracts manifest of the download_path into the one of the latest data directory.
+    Appends to the run_dates.txt file with the current run date.
     """
     if not download_path or not current_date_str:
         print('Could not copy latest data for this run to the latest data directory!')
         return
-    dir_util.copy_tree(download_path, constants.LATEST_RAW_DATA_PATH)
+    extracts = loadExtracts(constants.LATEST_RAW_DATA_PATH)
+    extracts.update(loadExtracts(download_path))
+    updated = snapshot_utils.update_snapshot(download_path, constants.LATEST_RAW_DATA_PATH)
+    saveExtracts(constants.LATEST_RAW_DATA_PATH, extracts)
+    print('Updated %d files of the latest data directory: %s' % (len(updated), ', '.join(updated)))
     with open(constants.LATEST_RAW_RUN_DATE_FILE, 'a') as run_file:
         run_file.write('{}-hdx\n'.format(current_date_str))
     return
@@ -236,28 +456,49 @@ def run():
     print('Download and merge data from HDX')
     datasets = {}
     resources = {}
+    # Failure report: why each dataset couldn't be found on any site env, or which of its resources failed
+    discovery_errors = dict((dataset_name, []) for dataset_name in constants.HDX_DATASETS)
+    resource_errors = dict((dataset_name, []) for dataset_name in constants.HDX_DATASETS)
     # Create current date directory
     print('Create current date directory as the download path...')
     _, download_path, current_date_str = createCurrentDateDir(constants.RAW_DATA_PATH)
-    # Download resources
+    # Find each dataset on the first HDX site env that has it (starting with the one it was last found on), and download
+    # its resources while that env is configured
     print('Download Resources...')
-    num_resources = 0
-    is_new_data = False
-    for dataset_name in constants.HDX_DATASETS:
-        resource_list = None
-        try:
-            dataset = getDataset(dataset_name)
-            datasets[dataset_name] = dataset
-            resource_dfs = downloadResources(dataset, download_path, current_date_str)
-            resources[dataset_name] = resource_dfs
-            num_resources = num_resources + len(resource_dfs)
-            if not is_new_data and len(resource_dfs):
-                is_new_data = True
-        except Exception as e:
-            print('Exception: could not reach the HDX API to download data!')
-            print(e)
-
-    if is_new_data:
+    site_cache = loadSiteCache()
+    site_orders = dict((dataset_name, getSiteOrder(dataset_name, site_cache, current_date_str))
+                       for dataset_name in constants.HDX_DATASETS)
+    remaining = list(constants.HDX_DATASETS)
+    while remaining:
+        for site_env in constants.HDX_SITES:
+            dataset_names = [dataset_name for dataset_name in remaining
+                             if dataset_name not in datasets and site_orders[dataset_name] and site_orders[dataset_name][0] == site_env]
+            if not dataset_names:
+                continue
+            site_datasets, site_errors = readDatasets(dataset_names, site_env)
+            for dataset_name, error in site_errors.items():
+                discovery_errors[dataset_name].append(error)
+            for dataset_name, dataset in site_datasets.items():
+                missing_resources = updateSiteCache(site_cache, dataset_name, dataset, site_env, current_date_str)
+                if missing_resources:
+                    resource_errors[dataset_name].append('resources found last time are missing: %s' % ', '.join(missing_resources))
+            site_resources, site_resource_errors = downloadResources(site_datasets, download_path, current_date_str)
+            for dataset_name, errors in site_resource_errors.items():
+                resource_errors[dataset_name].extend(errors)
+            datasets.update(site_datasets)
+            resources.update(site_resources)
+            for dataset_name in dataset_names:
+                site_orders[dataset_name].pop(0)
+        remaining = [dataset_name for dataset_name in remaining if dataset_name not in datasets and site_orders[dataset_name]]
+    saveSiteCache(site_cache)
+    num_resources = sum(len(resource_dfs) for resource_dfs in resources.values())
+
+    if num_resources:
+        # Merged with the manifest of an earlier run on the same day
+        extracts = loadExtracts(download_path)
+        extracts.update(getExtracts(download_path, set(file_name for resource_dfs in resources.values()
+                                                       for file_name in resource_dfs), current_date_str))
+        saveExtracts(download_path, extracts)
         updateLatestDataDir(download_path, current_date_str)
 
     print('== Num datasets configured: %d ==' % len(constants.HDX_DATASETS))
@@ -268,6 +509,12 @@ def run():
     for dataset_name, resource_dfs in resources.items():
         print('Dataset: %s' % dataset_name)
         print('Resources for dataset: %s' % list(resource_dfs.keys()))
+    print('FAILURES:')
+    for dataset_name in constants.HDX_DATASETS:
+        if dataset_name not in datasets:
+            print('Dataset %s was not found: %s' % (dataset_name, '; '.join(discovery_errors[dataset_name])))
+        elif resource_errors[dataset_name]:
+            print('Dataset %s is incomplete: %s' % (dataset_name, '; '.join(resource_errors[dataset_name])))
 
     # Join resources
     #print('Join Resources...')
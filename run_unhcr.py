@@ -5,10 +5,10 @@ from datetime import date
 from distutils import dir_util
 
 from resources import constants
-from utils import data_utils, api_utils
+from utils import data_utils, api_utils, publish_utils
 
 
-def cleanTable1_1_Data():
+def cleanTable1_1_Data(publication):
     in_file_key = 'raw_asylum_country'
     out_file_key = 'asylum_country'
     file_name = constants.UNHCR_FILE_NAMES[in_file_key]
@@ -27,12 +27,13 @@ def cleanTable1_1_Data():
     df = df[[constants.COUNTRY_COL, 'Type of population', 'Population Mid 2016', 'of whom assisted by UNHCR Mid 2016']]
     df = df.pivot(index=constants.COUNTRY_COL, columns='Type of population', values='Population Mid 2016').reset_index()
 
-    data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, constants.UNHCR_FILE_NAMES[out_file_key])
+    data_path = publication.path(constants.UNHCR_FILE_NAMES[out_file_key])
     df.to_csv(data_path, index=False, encoding='utf-8')
+    data_utils.write_columnar(data_path)
     return df
 
 
-def cleanTable1_2_Data():
+def cleanTable1_2_Data(publication):
     in_file_key = 'raw_origin_country'
     out_file_key = 'origin_country'
     file_name = constants.UNHCR_FILE_NAMES[in_file_key]
@@ -51,8 +52,9 @@ def cleanTable1_2_Data():
     df = df[[constants.COUNTRY_COL, 'Type of population', 'Population Mid 2016', 'of whom assisted by UNHCR Mid 2016']]
     df = df.pivot(index=constants.COUNTRY_COL, columns='Type of population', values='Population Mid 2016').reset_index()
 
-    data_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, constants.UNHCR_FILE_NAMES[out_file_key])
+    data_path = publication.path(constants.UNHCR_FILE_NAMES[out_file_key])
     df.to_csv(data_path, index=False, encoding='utf-8')
+    data_utils.write_columnar(data_path)
     return df
 
 
@@ -67,8 +69,9 @@ def standardizeNumericCols(df, cols):
 
 
 def run():
-    print cleanTable1_1_Data()
-    print cleanTable1_2_Data()
+    with publish_utils.Publication() as publication:
+        print cleanTable1_1_Data(publication)
+        print cleanTable1_2_Data(publication)
 
     print 'Done!'
 
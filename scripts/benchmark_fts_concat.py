@@ -0,0 +1,72 @@
+"""
+Benchmark how `run_fts.concat_results` (collect the per-plan results, then concatenate them once) scales with the
+number of plans, against the `DataFrame.append` loop it replaced, which copies the combined data for every plan.
+The results are synthetic donor fundings shaped like those of `run_fts.getDonorPlanFundingAmounts`: 3 to 8 donors per
+plan, and no data (None) for 1 in 5 plans. Both ways are checked to give the same data.
+Run from the repository root:
+  python scripts/benchmark_fts_concat.py [plan_count ...]
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import run_fts
+from resources import constants
+
+
+DEFAULT_PLAN_COUNTS = [100, 500, 2000]
+
+
+def get_results(plan_count, rng):
+    """
+    Return synthetic donor funding results (dataframes, or None when there was no data) for the given number of plans.
+    """
+    results = []
+    for plan_id in range(plan_count):
+        if rng.randrange(5) == 0:
+            results.append(None)
+            continue
+        donors = rng.randint(3, 8)
+        results.append(pd.DataFrame({
+            'id': [rng.randrange(10000) for _ in range(donors)],
+            'name': ['Donor {}'.format(rng.randrange(10000)) for _ in range(donors)],
+            'totalFunding': [rng.randrange(10 ** 8) for _ in range(donors)],
+            'direction': ['source'] * donors,
+            'plan_id': [plan_id] * donors,
+        }))
+    return results
+
+
+def append_results(results, columns):
+    """
+    Combine the given results the way the FTS aggregations used to, appending them one by one.
+    """
+    data = pd.DataFrame()
+    for result in results:
+        if result is not None:
+            data = data.append(result)
+    return data.reset_index(drop=True).reindex(columns=columns)
+
+
+def main():
+    plan_counts = [int(plan_count) for plan_count in sys.argv[1:]] or DEFAULT_PLAN_COUNTS
+    columns = constants.FTS_DONOR_PLAN_FUNDING_COLUMNS
+    rng = random.Random(0)
+    print '{:>8} {:>8} {:>14} {:>16}'.format('plans', 'rows', 'append loop', 'collect+concat')
+    for plan_count in plan_counts:
+        results = get_results(plan_count, rng)
+        appended = append_results(results, columns)
+        concatenated = run_fts.concat_results(results, columns)
+        assert appended.equals(concatenated), 'the combined data differs for {} plans'.format(plan_count)
+        append_seconds = timeit.timeit(lambda: append_results(results, columns), number=1)
+        concat_seconds = timeit.timeit(lambda: run_fts.concat_results(results, columns), number=1)
+        print '{:>8} {:>8} {:>13.2f}s {:>15.2f}s'.format(plan_count, len(concatenated), append_seconds, concat_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Check the retry, rate limiting (429) and response cache paths of `http_utils.FTSClient` against a local stub of the
+FTS API, without any request to the real one:
+- retryable statuses (5xx) are retried with backoff until a success, or returned once all retries are used up,
+- a 429 Retry-After in seconds is honoured but capped at max_retry_delay, and an HTTP-date falls back to the backoff,
+- cached responses are used until their ttl expires, then revalidated with If-None-Match (a 304 reuses them),
+- offline mode only uses cached responses.
+Run from the repository root:
+  python scripts/check_fts_client.py
+Exits with an error if a check fails.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from utils import http_utils
+
+
+# Statuses the stub responds with to the successive requests for each path (the last one is repeated), and the
+# Retry-After header sent with 429s on the path, if any
+STUB_RESPONSES = {
+    '/flaky': ([503, 502, 200], None),
+    '/down': ([503], None),
+    '/limited': ([429, 200], '86400'),
+    '/limited-until': ([429, 200], 'Wed, 21 Oct 2037 07:28:00 GMT'),
+    '/cached': ([200], None),
+}
+
+STUB_ETAG = '"stub-etag"'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Respond to each path with its next status in STUB_RESPONSES, and record the requests made (path and headers).
+    Successful responses are json with an ETag, and a matching If-None-Match gets a 304.
+    """
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path = self.path.replace('/v1', '', 1)
+        with self.lock:
+            count = len([request for request in self.requests if request[0] == path])
+            self.requests.append((path, dict(self.headers)))
+        statuses, retry_after = STUB_RESPONSES[path]
+        status = statuses[min(count, len(statuses) - 1)]
+        if status == 200 and self.headers.get('If-None-Match') == STUB_ETAG:
+            status = 304
+        self.send_response(status)
+        if status == 429 and retry_after:
+            self.send_header('Retry-After', retry_after)
+        if status == 200:
+            body = json.dumps({'data': {'path': path, 'count': count}})
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', STUB_ETAG)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def get_requests(path):
+    with StubHandler.lock:
+        return [headers for request_path, headers in StubHandler.requests if request_path == path]
+
+
+def check(description, condition):
+    print '{} {}'.format('ok  ' if condition else 'FAIL', description)
+    return condition
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever).start()
+    cache_dir = tempfile.mkdtemp()
+    base_url = 'http://127.0.0.1:{}/v1'.format(server.server_address[1])
+    client = http_utils.FTSClient(base_url=base_url, auth=None, backoff=0.01, max_retries=3, max_retry_delay=0.2,
+                                  rate_limiter=http_utils.RateLimiter(None),
+                                  cache=http_utils.ResponseCache(cache_dir))
+    results = []
+    try:
+        data = client.get_json('/flaky')['data']
+        results.append(check('5xx responses are retried until a success', data['count'] == 2 and len(get_requests('/flaky')) == 3))
+
+        try:
+            client.get_json('/down')
+            raised = False
+        except requests.HTTPError:
+            raised = True
+        results.append(check('the last 5xx is raised once all retries are used up', raised and len(get_requests('/down')) == 4))
+
+        start = time.time()
+        client.get_json('/limited')
+        seconds = time.time() - start
+        results.append(check('a 429 Retry-After of a day is capped at max_retry_delay ({:.2f}s)'.format(seconds),
+                             0.2 <= seconds < 1 and len(get_requests('/limited')) == 2))
+
+        start = time.time()
+        client.get_json('/limited-until')
+        seconds = time.time() - start
+        results.append(check('a 429 Retry-After HTTP-date falls back to the backoff ({:.2f}s)'.format(seconds),
+                             seconds < 0.2 and len(get_requests('/limited-until')) == 2))
+
+        first = client.get_json('/cached')
+        second = client.get_json('/cached')
+        results.append(check('a cached response is used until its ttl expires',
+                             first == second and len(get_requests('/cached')) == 1 and client.cache_hits == 1))
+
+        url = client.get_url('/cached')
+        client.cache.set(url, dict(client.cache.get(url), fetched_at=0))
+        third = client.get_json('/cached')
+        headers = get_requests('/cached')[-1]
+        results.append(check('an expired response is revalidated with If-None-Match and reused on a 304',
+                             third == first and headers.get('if-none-match') == STUB_ETAG and client.not_modified == 1))
+
+        offline_client = http_utils.FTSClient(base_url=base_url, auth=None, cache=http_utils.ResponseCache(cache_dir),
+                                              offline=True)
+        request_count = len(StubHandler.requests)
+        cached = offline_client.get_json('/cached')
+        try:
+            offline_client.get_json('/flaky?uncached')
+            raised = False
+        except requests.ConnectionError:
+            raised = True
+        results.append(check('offline mode only uses cached responses',
+                             cached == first and raised and len(StubHandler.requests) == request_count))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+    print json.dumps(client.stats(), sort_keys=True)
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Check that `index_utils.FuzzyMatcher` resolves country queries to the same best match (and ratio) as the
+`fuzzywuzzy.process.extractOne` scan it replaced in `data_utils.fuzzy_filter`, and compare their latency.
+The corpus is the country columns the endpoints filter on (see `utils/dataset_utils.py`), and the queries are generated
+from it: every value as-is and in other cases, with a character deleted, substituted or transposed, truncated, single
+words, reversed words, common short names and junk strings.
+Queries equal to one of a matcher's ISO-3 aliases are left out, as they are looked up directly by design.
+Each extractOne scan takes tens of milliseconds, so by default a fixed sample of the queries of each column is checked.
+Run from the repository root:
+  python scripts/check_fuzzy_matcher.py [queries_per_column, 0 for all of them]
+Exits with an error if any match differs.
+"""
+import os
+import sys
+import logging
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzywuzzy import process
+
+from resources import constants
+from utils import api_utils, dataset_utils, index_utils
+
+
+# (data file, column matched on, ISO-3 alias column, rows selected) of each endpoint matcher
+CORPUS = [
+    ('gni_per_capita.csv', 'Country Name', 'Country Code', None),
+    ('gni_per_capita.csv', 'Country Code', None, None),
+    (constants.UNHCR_FILE_NAMES['asylum_country'], constants.COUNTRY_COL, 'countryCode', None),
+    (constants.UNHCR_FILE_NAMES['origin_country'], constants.COUNTRY_COL, 'countryCode', None),
+    (constants.ESA_FILE_NAMES['wpp_overall'], constants.COUNTRY_COL, 'countryCode', dataset_utils.select_latest_populations),
+]
+
+# Variations (deletion, substitution, transposition, truncation) generated for each value, and number of queries of each
+# column checked by default
+QUERIES_PER_VALUE = 2
+DEFAULT_SAMPLE_SIZE = 300
+
+SHORT_NAMES = [
+    'usa', 'us', 'uk', 'america', 'britain', 'england', 'russia', 'korea', 'north korea', 'south korea', 'congo', 'drc',
+    'iran', 'syria', 'laos', 'vietnam', 'venezuela', 'bolivia', 'tanzania', 'macedonia', 'moldova', 'czech', 'slovakia',
+    'ivory coast', 'cote d\'ivoire', 'burma', 'myanmar', 'egypt', 'yemen', 'gambia', 'bahamas', 'micronesia', 'palestine',
+    'gaza', 'west bank', 'kosovo', 'taiwan', 'hong kong', 'macau', 'cape verde', 'swaziland', 'eswatini', 'east timor',
+    'st lucia', 'st kitts', 'holland', 'the netherlands', 'uae', 'emirates', 'saudi', 'south sudan', 'sudan', 'niger',
+    'nigeria', 'chad', 'cameroon', 'somalia', 'ethiopia', 'mali', 'world', 'africa', 'europe', 'asia',
+]
+
+JUNK = ['', ' ', '-', '123', 'x', 'zz', 'qwerty', 'not a country', '!!!', 'aaaaaaaaaaaaaaaaaaaa']
+
+
+def get_queries(values, rng, per_value):
+    """
+    Generate the queries for the given corpus values (see the module docstring).
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    queries = set(SHORT_NAMES + JUNK)
+    for value in values:
+        value = u'{}'.format(value)
+        queries.update([value, value.lower(), value.upper(), value.capitalize()])
+        words = value.split()
+        queries.update([words[0], words[-1], u' '.join(reversed(words))] if words else [])
+        for _ in range(per_value):
+            if len(value) < 2:
+                break
+            position = rng.randrange(len(value) - 1)
+            queries.add(value[:position] + value[position + 1:])
+            queries.add(value[:position] + rng.choice(letters) + value[position + 1:])
+            queries.add(value[:position] + value[position + 1] + value[position] + value[position + 2:])
+            queries.add(value[:rng.randrange(1, len(value))])
+    # Like the endpoints, also look up the stripped and capitalized query
+    queries.update([query.strip().capitalize() for query in list(queries)])
+    return sorted(queries)
+
+
+def load_matcher(data_file, column, alias_column, select_rows):
+    """
+    Return the values of the given column of the given derived data file, and the matcher built over them by the endpoints.
+    """
+    result, metadata = api_utils.load_data_file(data_file, has_metadata=True)
+    if select_rows:
+        result = select_rows(result)
+    matcher = dataset_utils.build_country_matcher(column, alias_column, select_rows)(result, metadata)
+    return result[column].tolist(), matcher
+
+
+def main():
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLE_SIZE
+    # extractOne logs a warning for each query that is empty once processed (e.g. junk strings)
+    logging.getLogger().setLevel(logging.ERROR)
+    rng = random.Random(0)
+    total = 0
+    differences = []
+    old_seconds = 0.
+    new_seconds = 0.
+    memo_seconds = 0.
+    for data_file, column, alias_column, select_rows in CORPUS:
+        values, matcher = load_matcher(data_file, column, alias_column, select_rows)
+        choices = set(values)
+        queries = [query for query in get_queries(values, rng, QUERIES_PER_VALUE)
+                   if index_utils.normalize_key(query) not in matcher.aliases]
+        if sample_size and sample_size < len(queries):
+            queries = rng.sample(queries, sample_size)
+        for query in queries:
+            # Previously each request scanned set(values) with extractOne, the matcher is only built when the data changes
+            start = timeit.default_timer()
+            expected = process.extractOne(query, set(values))
+            old_seconds += timeit.default_timer() - start
+            start = timeit.default_timer()
+            match = matcher.find_match(query)
+            new_seconds += timeit.default_timer() - start
+            matcher.match(query)
+            start = timeit.default_timer()
+            matcher.match(query)
+            memo_seconds += timeit.default_timer() - start
+            if match != expected:
+                differences.append((data_file, column, query, match, expected))
+        total += len(queries)
+        print '{} [{}]: {} values, {} queries'.format(data_file, column, len(choices), len(queries))
+    for data_file, column, query, match, expected in differences:
+        print u'DIFFERENT {} [{}] {!r}: {} instead of {}'.format(data_file, column, query, match, expected).encode('utf-8')
+    print '{} of {} queries match extractOne'.format(total - len(differences), total)
+    print 'Latency per query: extractOne {:.2f} ms, FuzzyMatcher {:.3f} ms (memoized {:.4f} ms)'.format(
+        *[seconds * 1000 / total for seconds in (old_seconds, new_seconds, memo_seconds)])
+    if differences:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import run_fts
+import run_acled
 import displacement_tracker_data
 
 run_fts.run()
+run_acled.run()
 displacement_tracker_data.run()
\ No newline at end of file
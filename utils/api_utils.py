@@ -1,12 +1,86 @@
 # -*- coding: utf-8 -*-
 import io
 import ast
+import copy
 import json
 import os.path
-import requests
 from pandas.io.json import json_normalize
 import pandas as pd
 from resources import constants
+from utils import cache_utils, data_utils, http_utils, publish_utils
+
+
+# Per-worker cache of parsed derived datasets, invalidated when the underlying file changes on disk
+DATASET_CACHE = cache_utils.FileCache(constants.DATASET_CACHE_MAX_BYTES)
+
+
+def get_data_file_path(data_file):
+    """
+    Return the full path of the given derived data_file served by the API, in the current published version
+    (see `utils/publish_utils.py`).
+    """
+    return os.path.join(publish_utils.get_published_data_path(), data_file)
+
+
+def read_data_file(file_path, has_metadata=False, na_values=None):
+    """
+    Parse the derived data csv at the given file_path as a pandas dataframe (df), with NaN values replaced by None.
+    If has_metadata, also extract the "#{metadata_json}" first line of the file.
+    If the ETL wrote an up to date columnar copy of the file (see `data_utils.write_columnar`), load that instead.
+    Return a tuple of the df and the metadata dict (or None).
+    """
+    metadata = None
+    if not na_values and data_utils.has_current_columnar(file_path):
+        result, metadata = data_utils.read_columnar(data_utils.get_columnar_path(file_path))
+        result = result.where((pd.notnull(result)), None)
+        if has_metadata and metadata:
+            metadata["source_org"] = constants.DATA_SOURCES[metadata["source_key"]]
+        return result, metadata if has_metadata else None
+    if has_metadata and na_values:
+        result = pd.read_csv(file_path, encoding='utf-8', header=1, na_values=na_values)
+    elif has_metadata:
+        result = pd.read_csv(file_path, encoding='utf-8', header=1)
+    elif na_values:
+        result = pd.read_csv(file_path, encoding='utf-8', na_values=na_values)
+    else:
+        result = pd.read_csv(file_path, encoding='utf-8')
+    result = result.where((pd.notnull(result)), None)
+    if has_metadata:
+        # Extract metadata as json, expected to have the form "#{metadata_json}"
+        # Find "source_key" key and do an org lookup and append with "source_org"
+        with io.open(file_path, 'r', encoding='utf-8') as data_file:
+            metadata_str = data_file.readline().strip()
+            if metadata_str.startswith('#{') and metadata_str.endswith('}'):
+                metadata = json.loads(metadata_str[1:])
+                metadata["source_org"] = constants.DATA_SOURCES[metadata["source_key"]]
+    return result, metadata
+
+
+def load_data_file(data_file, has_metadata=False, na_values=None):
+    """
+    Return the parsed (df, metadata) tuple for the given derived data_file from the per-worker dataset cache,
+    re-parsing the file only if it isn't cached yet or has changed on disk since it was cached.
+    Note: the cached df and metadata are shared between requests, so copy them before modifying them in place.
+    """
+    file_path = get_data_file_path(data_file)
+    na_key = tuple(na_values) if na_values else None
+    return DATASET_CACHE.get(file_path,
+                             lambda path: read_data_file(path, has_metadata, na_values),
+                             key=(has_metadata, na_key),
+                             sizeof=lambda loaded: loaded[0].memory_usage(index=True, deep=True).sum())
+
+
+def load_data_index(data_file, index_name, build_index, has_metadata=False, na_values=None):
+    """
+    Return an index over the given derived data_file (e.g. a `utils.index_utils.DataIndex`) built by build_index(df, metadata),
+    cached alongside the parsed dataset so that it's only rebuilt when the file changes on disk.
+    The index_name identifies the kind of index when several are built over the same file.
+    """
+    file_path = get_data_file_path(data_file)
+    return DATASET_CACHE.get(file_path,
+                             lambda path: build_index(*load_data_file(data_file, has_metadata, na_values)),
+                             key=('index', index_name),
+                             sizeof=lambda index: index.nbytes())
 
 
 def safely_load_data(data_file, data_description, filter_value=None, filter_column=constants.COUNTRY_COL, has_metadata=False, na_values=None):
@@ -17,17 +91,8 @@ def safely_load_data(data_file, data_description, filter_value=None, filter_colu
     success = False
     result = None
     metadata = None
-    file_path = None
     try:
-        file_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, data_file)
-        if has_metadata and na_values:
-            result = pd.read_csv(file_path, encoding='utf-8', header=1, na_values=na_values)
-        elif has_metadata:
-            result = pd.read_csv(file_path, encoding='utf-8', header=1)
-        elif na_values:
-            result = pd.read_csv(file_path, encoding='utf-8', na_values=na_values)
-        else:
-            result = pd.read_csv(file_path, encoding='utf-8')
+        result, metadata = load_data_file(data_file, has_metadata, na_values)
         success = True
         if result.empty:
             result = 'Error: No {} data was found (empty file)'.format(data_description)
@@ -41,16 +106,8 @@ def safely_load_data(data_file, data_description, filter_value=None, filter_colu
         result = 'Error: No {} data was found ({})'.format(data_description, e)
         success = False
 
-    if success:
-        result = result.where((pd.notnull(result)), None)
-        if has_metadata:
-            # Extract metadata as json, expected to have the form "#{metadata_json}"
-            # Find "source_key" key and do an org lookup and append with "source_org"
-            with io.open(file_path, 'r', encoding='utf-8') as data_file:
-                metadata_str = data_file.readline().strip()
-                if metadata_str.startswith('#{') and metadata_str.endswith('}'):
-                    metadata = json.loads(metadata_str[1:])
-                    metadata["source_org"] = constants.DATA_SOURCES[metadata["source_key"]]
+    if success and metadata is not None:
+        metadata = dict(metadata)
 
     return success, result, metadata
 
@@ -60,7 +117,7 @@ def safely_load_json_data(data_file, data_description):
     result = None
     file_path = None
     try:
-        file_path = os.path.join(constants.EXAMPLE_DERIVED_DATA_PATH, data_file)
+        file_path = get_data_file_path(data_file)
         file = open(file_path, 'r')
         result =  file.read()
         result = json.loads(result)
@@ -75,24 +132,6 @@ def safely_load_json_data(data_file, data_description):
     return success, result
 
 
-def load_metadata(endpoint_str=None, column=None, literal=False):
-    """
-    Load the metadata.csv file that maps metadata to each endpoint as a pandas dataframe. 
-    Filter for the given endpoint string (e.g. '/funding/totals/:country' or '/indicators/gni') or metadata file column name (e.g. 'contact', 'source_date') if given.
-    """
-    metadata = pd.read_csv(constants.METADATA_FILE, encoding='utf-8')
-    metadata = metadata.where((pd.notnull(metadata)), None)
-    if endpoint_str and column:
-        metadata = metadata[metadata.data_endpoint == endpoint_str].iloc[0][column]
-        if metadata and literal:
-            metadata = ast.literal_eval(metadata)
-    elif endpoint_str:
-        metadata = metadata[metadata.data_endpoint == endpoint_str]
-    elif column:
-        metadata = metadata[column]
-    return metadata
-
-
 def safe_apply(row, fn):
     """
     Safely apply the given function fn to the row (e.g for a pandas series apply function).
@@ -102,13 +141,18 @@ def safe_apply(row, fn):
     else:
         return row
 
-def format_metadata(orient='index'):
+def read_metadata_file(file_path):
     """
-    Load the metadata.csv file that maps metadata to each endpoint as a pandas dataframe.
-    Reformat it to be json-friendly.
+    Parse the metadata.csv file at the given file_path, which maps metadata to each endpoint.
+    Return a tuple of the raw pandas dataframe (with NaN values replaced by None), the json-friendly dataframe
+    indexed by endpoint (with the list and json columns decoded, see `constants.METADATA_LIST_COLS` and
+    `constants.METADATA_JSON_COLS`), and a dict of the first row for each endpoint, as a tuple of the raw and decoded
+    row dicts.
     """
-    metadata = pd.read_csv(constants.METADATA_FILE, encoding='utf-8', index_col=constants.METADATA_INDEX)
-    metadata = metadata.where((pd.notnull(metadata)), None)
+    raw = pd.read_csv(file_path, encoding='utf-8')
+    endpoints = pd.Index(raw[constants.METADATA_INDEX])
+    raw = raw.where((pd.notnull(raw)), None)
+    metadata = raw.copy()
     cols = set(metadata.columns.tolist())
     for col in constants.METADATA_LIST_COLS:
         if col in cols:
@@ -116,7 +160,55 @@ def format_metadata(orient='index'):
     for col in constants.METADATA_JSON_COLS:
         if col in cols:
             metadata[col] = metadata[col].apply(lambda x: safe_apply(x, json.loads))
-    return metadata.to_dict(orient=orient)
+    by_endpoint = {}
+    for raw_row, row in zip(raw.to_dict(orient='records'), metadata.to_dict(orient='records')):
+        by_endpoint.setdefault(row[constants.METADATA_INDEX], (raw_row, row))
+    metadata = metadata.drop(constants.METADATA_INDEX, axis=1)
+    metadata.index = endpoints
+    return raw, metadata, by_endpoint
+
+
+def load_metadata_registry():
+    """
+    Return the parsed metadata.csv tuple (see read_metadata_file) from the per-worker dataset cache,
+    re-parsing the file only if it isn't cached yet or has changed on disk since it was cached.
+    """
+    return DATASET_CACHE.get(get_data_file_path(constants.METADATA_FILE), read_metadata_file, key='metadata',
+                             sizeof=lambda loaded: 2 * loaded[0].memory_usage(index=True, deep=True).sum())
+
+
+def load_metadata(endpoint_str=None, column=None, literal=False):
+    """
+    Load the metadata.csv file that maps metadata to each endpoint as a pandas dataframe. 
+    Filter for the given endpoint string (e.g. '/funding/totals/:country' or '/indicators/gni') or metadata file column name (e.g. 'contact', 'source_date') if given.
+    If both are given, return the value of that column for the endpoint, parsed as a python literal if literal
+    (already decoded for the list columns, e.g. 'contact').
+    """
+    raw, _, by_endpoint = load_metadata_registry()
+    if endpoint_str and column:
+        if endpoint_str not in by_endpoint:
+            raise IndexError('No metadata for the endpoint {}'.format(endpoint_str))
+        raw_row, row = by_endpoint[endpoint_str]
+        if literal and column in constants.METADATA_LIST_COLS:
+            return copy.deepcopy(row[column])
+        metadata = raw_row[column]
+        if metadata and literal:
+            metadata = ast.literal_eval(metadata)
+    elif endpoint_str:
+        metadata = raw[raw.data_endpoint == endpoint_str]
+    elif column:
+        metadata = raw[column].copy()
+    else:
+        metadata = raw.copy()
+    return metadata
+
+
+def format_metadata(orient='index'):
+    """
+    Load the metadata.csv file that maps metadata to each endpoint as a pandas dataframe.
+    Reformat it to be json-friendly.
+    """
+    return load_metadata_registry()[1].to_dict(orient=orient)
 
 
 def get_fts_endpoint(endpoint_str, key=None):
@@ -125,14 +217,9 @@ def get_fts_endpoint(endpoint_str, key=None):
     Return the normalized json response as a pandas dataframe if successful, or None if not.
     Example: endpoint_str = '/public/fts/flow?year=2017'
     """
-    url = None
-    if endpoint_str.startswith('/'):
-        url = constants.FTS_API_BASE_URL + endpoint_str
-    else:
-        url = '/'.join([constants.FTS_API_BASE_URL, endpoint_str])
-    result = requests.get(url, auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD))
-    result.raise_for_status()
-    result = result.json()['data']
+    client = http_utils.get_fts_client()
+    url = client.get_url(endpoint_str)
+    result = client.get_json(endpoint_str)['data']
     if result:
         if key:
             result = result[key]
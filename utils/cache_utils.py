@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_signature(file_path):
+    """
+    Return a cheap signature for the file at the given file_path that changes whenever the file is rewritten.
+    The signature is a tuple of (inode, modification time, size), so a file replaced by the nightly `update.py` run
+    is detected without reading its contents.
+    """
+    stat = os.stat(file_path)
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+class LRUCache(object):
+    """
+    A least-recently-used cache bounded by an approximate memory budget (in bytes).
+    Each entry is stored along with its estimated size, and the oldest entries are evicted once the budget is exceeded.
+    Keeps hit, miss and eviction counters for reporting via stats().
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None, is_valid=None):
+        """
+        Return the cached value for the given key (marking it as most recently used), or default if it isn't cached.
+        If an is_valid(value) function is given and returns False, the stale entry is dropped and counted as a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            value, size = self._entries.pop(key)
+            if is_valid and not is_valid(value):
+                self.current_bytes -= size
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        """
+        Cache the given value under the given key, evicting least recently used entries to stay within max_bytes.
+        Values that are larger than the whole budget are not cached.
+        """
+        with self._lock:
+            self.discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        """
+        Remove the given key from the cache if it's there.
+        """
+        with self._lock:
+            if key in self._entries:
+                _, size = self._entries.pop(key)
+                self.current_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Return a json-friendly dict of the cache counters and current memory usage.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class FileCache(object):
+    """
+    Cache values derived from files on disk (e.g. parsed dataframes), invalidated when the file signature changes.
+    The loader function is only called on a miss or when the file has been modified since it was last cached.
+    """
+
+    def __init__(self, max_bytes):
+        self._cache = LRUCache(max_bytes)
+
+    def get(self, file_path, loader, key=None, sizeof=None):
+        """
+        Return the cached value for the given file_path (and optional extra key, e.g. the parsing options used),
+        calling loader(file_path) to (re)build it if it's missing or stale.
+        sizeof(value) estimates the memory used by a value in bytes, and defaults to the file size on disk.
+        """
+        signature = file_signature(file_path)
+        cache_key = (file_path, key)
+        entry = self._cache.get(cache_key, is_valid=lambda cached: cached[0] == signature)
+        if entry is not None:
+            return entry[1]
+        value = loader(file_path)
+        size = sizeof(value) if sizeof else signature[2]
+        self._cache.set(cache_key, (signature, value), size)
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
@@ -1,22 +1,56 @@
 import os
+import gzip
+import json
 import errno
+import hashlib
+import shutil
+import tempfile
 import pandas
-from fuzzywuzzy import process
 
+from resources import constants
+from utils import index_utils
 
-def fuzzy_filter(df, col, val, return_verbose=False):
+# Brotli is optional, without it only gzip variants are written and served
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Pyarrow is optional, without it derived data is only written and read as csv
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+
+def fuzzy_filter(df, col, val, return_verbose=False, matcher=None):
     """
     Filter a pandas dataframe (df) for rows where the given column (col) has the closest fuzzy string match ratio to the given value (val). For exampl if a df had a 'Country' column and the given value is 'dominican rep', it would find 'Dominican Republic' as the closest string match and return that row of data. By default, return_verbose is false, which means just return thefiltered dataframe. If true, then also return the matched value and fuzzy string match ratio between the given value and the matched value.
+    Pass a matcher (see `index_utils.FuzzyMatcher`) built once over the column's values to avoid building one for every call.
     Return filtered df, matched value, and fuzzy match ratio
     """
-    values = set(df[col].tolist())
-    matched_value, fuzzy_match_ratio = process.extractOne(val, values)
+    if matcher is None:
+        matcher = index_utils.FuzzyMatcher(df[col].tolist())
+    matched_value, fuzzy_match_ratio = matcher.match(val)
     if return_verbose:
         return df.loc[df[col] == matched_value], matched_value, fuzzy_match_ratio
     else:
         return df.loc[df[col] == matched_value]
 
 
+def filter_latest(df, key_cols, date_col):
+    """
+    Filter a pandas dataframe (df) for the rows with the latest value of the given date column (date_col) for each key,
+    where the key is the given column or list of columns (key_cols), e.g. 'country' or ['country', 'region'].
+    All the rows with the latest date of a key are kept, and rows with a missing key are dropped.
+    Return filtered df
+    """
+    latest_dates = df.groupby(key_cols)[date_col].transform('max')
+    return df.loc[df[date_col] == latest_dates]
+
+
 def safely_mkdir(directory_path):
     """
     Safely create the given directory if it doesn't already exist.
@@ -34,6 +68,200 @@ def safely_mkdir(directory_path):
         success = True
     return success
 
+
+def write_metadata_line(data_file, metadata):
+    """
+    Write the given metadata dict as the "#{metadata_json}" first line of derived or raw data to the given binary file.
+    """
+    data_file.write('#{}\n'.format(json.dumps(metadata)).encode('utf-8'))
+
+
+def write_csv_with_metadata(df, file_path, metadata, **to_csv_kwargs):
+    """
+    Write the given dataframe as csv to the given file_path, with the given metadata as its first line (see
+    write_metadata_line), in a single pass instead of rewriting the file to prepend the metadata.
+    """
+    with open(file_path, 'wb') as data_file:
+        write_metadata_line(data_file, metadata)
+        df.to_csv(data_file, **to_csv_kwargs)
+
+
+def prepend_metadata(file_path, metadata):
+    """
+    Prepend the given metadata to the given (e.g. downloaded) file as its first line (see write_metadata_line).
+    The file is copied in chunks into a temporary file that then replaces it, so memory use stays flat regardless of
+    the file size. The temporary file has a unique name, as files are downloaded (and rewritten) concurrently.
+    """
+    temp_fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(file_path) + '.',
+                                          dir=os.path.dirname(file_path) or '.')
+    try:
+        with open(file_path, 'rb') as data_file:
+            with os.fdopen(temp_fd, 'wb') as metadata_file:
+                write_metadata_line(metadata_file, metadata)
+                shutil.copyfileobj(data_file, metadata_file, constants.FILE_CHUNK_SIZE)
+        shutil.copymode(file_path, temp_path)
+        os.rename(temp_path, file_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_metadata_line(data_file):
+    """
+    Read the "#{metadata_json}" first line of derived or raw data (see write_metadata_line) from the given binary file.
+    Return the metadata dict, or None if the file doesn't start with a metadata line.
+    """
+    first_line = data_file.readline()
+    if not first_line.startswith(b'#{'):
+        return None
+    try:
+        return json.loads(first_line[1:].decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def has_same_content(file_a, file_b):
+    """
+    Return whether the given binary files have the same content from their current positions to their end.
+    The files are compared in chunks, so memory use stays flat regardless of the file size.
+    """
+    while True:
+        chunk_a = file_a.read(constants.FILE_CHUNK_SIZE)
+        if chunk_a != file_b.read(constants.FILE_CHUNK_SIZE):
+            return False
+        if not chunk_a:
+            return True
+
+
+def get_available_encodings():
+    """
+    Return the list of content encodings (e.g. 'br', 'gzip') that can be written, in order of preference.
+    """
+    return [encoding for encoding in constants.CONTENT_ENCODINGS if encoding != 'br' or brotli]
+
+
+def write_compressed_variants(file_path):
+    """
+    Write pre-compressed siblings of the given file next to it (e.g. `data.csv.gz` and `data.csv.br`),
+    so the API can serve them as-is to clients that accept those encodings.
+    The file is compressed in chunks, so memory use stays flat regardless of the file size.
+    Return the list of paths written.
+    """
+    written = []
+    for encoding in get_available_encodings():
+        variant_path = file_path + constants.COMPRESSED_FILE_EXTENSIONS[encoding]
+        temp_path = variant_path + '.tmp'
+        with open(file_path, 'rb') as data_file:
+            if encoding == 'br':
+                compressor = brotli.Compressor()
+                with open(temp_path, 'wb') as variant_file:
+                    for chunk in iter(lambda: data_file.read(constants.FILE_CHUNK_SIZE), b''):
+                        variant_file.write(compressor.process(chunk))
+                    variant_file.write(compressor.finish())
+            else:
+                with open(temp_path, 'wb') as variant_file:
+                    with gzip.GzipFile(fileobj=variant_file, mode='wb', mtime=0) as gzip_file:
+                        shutil.copyfileobj(data_file, gzip_file, constants.FILE_CHUNK_SIZE)
+        os.rename(temp_path, variant_path)
+        written.append(variant_path)
+    return written
+
+
+def get_content_hash(file_path):
+    """
+    Return the content hash (sha1 hex digest) of the given file.
+    The file is hashed in chunks, so memory use stays flat regardless of the file size.
+    """
+    content_hash = hashlib.sha1()
+    with open(file_path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(constants.FILE_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def write_content_hash(file_path):
+    """
+    Write the content hash (see get_content_hash) of the given file next to it (e.g. `data.csv.sha1`), so the API can
+    use it as the file's ETag without hashing the file itself.
+    Return the path written.
+    """
+    hash_path = file_path + constants.CONTENT_HASH_FILE_EXTENSION
+    temp_path = hash_path + '.tmp'
+    with open(temp_path, 'w') as hash_file:
+        hash_file.write(get_content_hash(file_path))
+    os.rename(temp_path, hash_path)
+    return hash_path
+
+
+def get_columnar_path(file_path):
+    """
+    Return the path of the columnar (parquet) copy of the given derived data file, e.g. `data.parquet` for `data.csv`.
+    """
+    return os.path.splitext(file_path)[0] + constants.COLUMNAR_FILE_EXTENSION
+
+
+def write_columnar(file_path):
+    """
+    Write a typed columnar (parquet) copy of the given derived data csv file, storing its "#{metadata_json}" first line
+    (if any) in the copy's key-value metadata instead.
+    The copy is built from the csv as `pandas.read_csv` loads it, and is only kept if it loads back with the same dtypes,
+    so loading either file gives the same dataframe. The csv stays the source of truth: if the copy can't be written
+    (e.g. a column mixes types that parquet can't store), the error is logged and no copy is written.
+    Return the path written, or None if pyarrow isn't installed or no copy was written.
+    """
+    if not parquet:
+        return None
+    with open(file_path, 'rb') as data_file:
+        metadata = read_metadata_line(data_file)
+    columnar_path = get_columnar_path(file_path)
+    temp_path = columnar_path + '.tmp'
+    try:
+        df = pandas.read_csv(file_path, encoding='utf-8', header=1 if metadata is not None else 'infer')
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        loaded_dtypes = table.to_pandas().dtypes
+        if not loaded_dtypes.equals(df.dtypes):
+            raise TypeError('dtypes {} load back as {}'.format(dict(df.dtypes.astype(str)), dict(loaded_dtypes.astype(str))))
+        if metadata is not None:
+            schema_metadata = dict(table.schema.metadata or {})
+            schema_metadata[constants.COLUMNAR_METADATA_KEY] = json.dumps(metadata)
+            table = table.replace_schema_metadata(schema_metadata)
+        parquet.write_table(table, temp_path)
+    except (pyarrow.ArrowException, TypeError, ValueError) as e:
+        print('Skipping the columnar copy of {}: {}'.format(file_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    os.rename(temp_path, columnar_path)
+    return columnar_path
+
+
+def read_columnar(columnar_path):
+    """
+    Load the given columnar (parquet) file as a pandas dataframe, memory-mapping the file.
+    Return a tuple of the dataframe and the metadata dict stored with it (or None).
+    """
+    table = parquet.read_table(pyarrow.memory_map(columnar_path, 'r'))
+    metadata = None
+    schema_metadata = table.schema.metadata or {}
+    if constants.COLUMNAR_METADATA_KEY in schema_metadata:
+        metadata = json.loads(schema_metadata[constants.COLUMNAR_METADATA_KEY].decode('utf-8'))
+    return table.to_pandas(), metadata
+
+
+def has_current_columnar(file_path):
+    """
+    Return whether a columnar copy of the given derived data file can be read instead of it, i.e. pyarrow is installed
+    and the copy exists and is at least as recent as the file itself.
+    """
+    if not parquet:
+        return False
+    columnar_path = get_columnar_path(file_path)
+    if not os.path.exists(columnar_path) or not os.path.exists(file_path):
+        return False
+    return os.path.getmtime(columnar_path) >= os.path.getmtime(file_path)
+
+
 def get_ordinal_number(value):
     try:
         value = int(value)
@@ -0,0 +1,242 @@
+from string import capwords
+
+from resources import constants
+from utils import api_utils, data_utils, index_utils
+
+
+"""
+Direct access to the derived datasets served by the API, shared by the endpoint handlers in `api.py` and by scripts
+that build on the same data (e.g. `displacement_tracker_data.py`) so they can read it in-process instead of over HTTP.
+Each get_* function returns the same data as its endpoint, as a tuple of whether it was successful, either the data
+(in the given orientation) or an error message, and the metadata.
+"""
+
+
+def build_country_matcher(column, alias_column=None, select_rows=None):
+    """
+    Helper function to build the fuzzy matchers used to filter data by country (see data_utils.fuzzy_filter).
+    Returns a function that builds a matcher over the values of the given column of the loaded data (optionally only
+    the rows kept by select_rows), with the values of the given alias_column (e.g. ISO-3 codes) as exact aliases.
+    """
+    def build_index(result, metadata):
+        if select_rows:
+            result = select_rows(result)
+        aliases = dict(zip(result[alias_column], result[column])) if alias_column else None
+        return index_utils.FuzzyMatcher(result[column].tolist(), aliases)
+    return build_index
+
+
+def load_country_matcher(data_file, column, alias_column=None, select_rows=None):
+    """
+    Helper function to load the fuzzy matcher over the given column of the data_file (see build_country_matcher),
+    cached until the file changes.
+    """
+    index_name = 'country_matcher:{}'.format(column)
+    build_index = build_country_matcher(column, alias_column, select_rows)
+    return api_utils.load_data_index(data_file, index_name, build_index, has_metadata=True)
+
+
+def select_latest_populations(result):
+    return result[result['Year'] > 2014]  # The latest official statistics are from 2015, followed by projections into 2017
+
+
+def build_funding_index(group_columns=None):
+    """
+    Helper function to build the indexes used to filter funding and needs data (see load_indexed_data).
+    Returns a function that indexes the loaded data on whichever of the countryCode, plan_id and year columns it has,
+    and if group_columns are given, precomputes the records of these columns for each countryCode (for the index orientation).
+    """
+    def build_index(result, metadata):
+        index_cols = [column for column in constants.FUNDING_INDEX_COLS if column in result.columns]
+        if group_columns:
+            return index_utils.DataIndex(result, index_cols, group_column='countryCode', group_columns=group_columns)
+        return index_utils.DataIndex(result, index_cols)
+    return build_index
+
+
+def load_indexed_data(data_file, data_description, index_name='funding', build_index=build_funding_index()):
+    """
+    Helper function to load the data_file along with its indexes (see build_funding_index), both cached until the file changes.
+    Returns whether data retrieval was successful, either the index (with the loaded data as index.df) or an error message, and the metadata.
+    """
+    success, result, metadata = api_utils.safely_load_data(data_file, data_description, has_metadata=True)
+    if not success:
+        return success, result, metadata
+    try:
+        index = api_utils.load_data_index(data_file, index_name, build_index, has_metadata=True)
+    except Exception as e:
+        return False, 'Error: No {} data was found ({})'.format(data_description, e), None
+    return success, index, metadata
+
+
+def get_indicators_gni(orientation, country=None, country_code=None):
+    """
+    Get the GNI per capita of each country (see the `/indicators/gni` endpoint), optionally fuzzy filtered by
+    country_code (or country name if no country_code is given).
+    """
+    success, result, metadata = api_utils.safely_load_data('gni_per_capita.csv', 'GNI PPP indicator', has_metadata=True)
+    if not success:
+        return success, result, metadata
+    if country_code:
+        country_code = capwords(str(country_code).strip())
+        matcher = load_country_matcher('gni_per_capita.csv', 'Country Code')
+        result = data_utils.fuzzy_filter(result, 'Country Code', country_code, matcher=matcher)
+    elif country:
+        country = str(country).strip().capitalize()
+        matcher = load_country_matcher('gni_per_capita.csv', 'Country Name', 'Country Code')
+        result = data_utils.fuzzy_filter(result, 'Country Name', country, matcher=matcher)
+    result = result[['Country Name', 'Country Code', '2011', '2012', '2013', '2014', '2015']]  # No data after 2015
+    if orientation == 'index':
+        result = result.set_index('Country Code')
+    return success, result.to_dict(orient=orientation), metadata
+
+
+def get_populations_refugeelike(population_type, orientation, country=None):
+    """
+    Get the UNHCR refugee-like populations by asylum or origin country (the population_type), see the
+    `/populations/refugeelike/<population_type>` endpoints, optionally fuzzy filtered by country name.
+    """
+    data_path = constants.UNHCR_FILE_NAMES['{}_country'.format(population_type)]
+    data_description = 'UNHCR refugee-like populations by {} country'.format(population_type)
+    success, result, metadata = api_utils.safely_load_data(data_path, data_description, has_metadata=True)
+    if not success:
+        return success, result, metadata
+    if country:
+        country = str(country).strip().capitalize()
+        matcher = load_country_matcher(data_path, constants.COUNTRY_COL, 'countryCode')
+        result = data_utils.fuzzy_filter(result, constants.COUNTRY_COL, country, matcher=matcher)
+    if orientation == 'index':
+        result = result.set_index('countryCode')
+    result = result.to_dict(orient=orientation)
+    metadata['contact'] = api_utils.load_metadata('/populations/refugeelike/{}'.format(population_type), 'contact', literal=True)
+    return success, result, metadata
+
+
+def get_populations_totals(orientation, country=None):
+    """
+    Get the latest UN ESA total population of each country (see the `/populations/totals` endpoint), optionally
+    fuzzy filtered by country name.
+    """
+    data_path = constants.ESA_FILE_NAMES['wpp_overall']
+    success, result, metadata = api_utils.safely_load_data(data_path, 'UN ESA WPP world populations', has_metadata=True)
+    if not success:
+        return success, result, metadata
+    result = select_latest_populations(result)
+    if country:
+        country = str(country).strip().capitalize()
+        matcher = load_country_matcher(data_path, constants.COUNTRY_COL, 'countryCode', select_latest_populations)
+        result = data_utils.fuzzy_filter(result, constants.COUNTRY_COL, country, matcher=matcher)
+    if orientation == 'index':
+        result = result.set_index('countryCode')
+    result = result.to_dict(orient=orientation)
+    metadata['contact'] = api_utils.load_metadata('/populations/totals', 'contact', literal=True)
+    return success, result, metadata
+
+
+def get_funding_progress(orientation, countryCode=None):
+    """
+    Get the FTS funding progress of each country appeal (see the `/funding/plans/progress` endpoint),
+    optionally filtered by countryCode.
+    """
+    success, index, metadata = load_indexed_data('funding_progress.csv', 'FTS funding progress by country appeal')
+    if not success:
+        return success, index, metadata
+    result = index.df
+    if countryCode:
+        countryCode = str(countryCode).strip().upper()
+        result = index.select(index.lookup('countryCode', [countryCode]))
+    if orientation == 'index':
+        result = result.set_index('countryCode')
+    return success, result.to_dict(orient=orientation), metadata
+
+
+def get_funding_countries_destination(orientation, year, countryCode=None):
+    """
+    Get the FTS funding to each destination country in the given year (see the `/funding/countries/destination`
+    endpoint), optionally filtered by countryCode.
+    """
+    success, index, metadata = load_indexed_data('funding_dest_countries.csv', 'FTS funding by destination country and year')
+    if not success:
+        return success, index, metadata
+    filters = {}
+    if countryCode:
+        countryCode = str(countryCode).strip().upper()
+        filters['countryCode'] = [countryCode]
+    filters['year'] = [int(year)]
+    result = index.select(index.positions(filters))
+    if orientation == 'list':
+        result = result.to_dict(orient='list')
+    if orientation == 'index':
+        result = result.set_index('countryCode').to_dict(orient=orientation)
+    return success, result, metadata
+
+
+def get_funding_countries_donors(orientation, countryCode=None):
+    """
+    Get the FTS funding donors to each country (see the `/funding/countries/donors` endpoint),
+    optionally filtered by countryCode.
+    """
+    build_index = build_funding_index(['organization_name', 'totalFunding'])
+    success, index, metadata = load_indexed_data('funding_donors_country.csv', 'FTS funding donors to each country',
+                                                 'funding_by_country', build_index)
+    if not success:
+        return success, index, metadata
+    result = index.df
+    countryCodes = None
+    if countryCode:
+        countryCode = str(countryCode).strip().upper()
+        countryCodes = [countryCode]
+        result = index.select(index.lookup('countryCode', countryCodes))
+    if orientation == 'list':
+        result = result.to_dict(orient='list')
+    if orientation == 'index':
+        result = index.records_by_group(countryCodes)
+    return success, result, metadata
+
+
+def get_needs_plans(orientation, countryCode=None):
+    """
+    Get the HNO needs of each country appeal (see the `/needs/plans` endpoint), optionally filtered by countryCode.
+    """
+    success, index, metadata = load_indexed_data('2017_appeals_needs_consolidated.csv', 'HNO needs by country appeal')
+    if not success:
+        return success, index, metadata
+    result = index.df
+    if countryCode:
+        countryCode = str(countryCode).strip().upper()
+        result = index.select(index.lookup('countryCode', [countryCode]))
+    if orientation == 'index':
+        result = result.set_index('countryCode')
+    return success, result.to_dict(orient=orientation), metadata
+
+
+def get_fragile_state_index(orientation):
+    """
+    Get the Fragile State Index of each country (see the `/fragility/fragile-state-index` endpoint).
+    """
+    success, result, metadata = api_utils.safely_load_data('fsi_2017.csv', 'Fragile State Index', has_metadata=True)
+    if not success:
+        return success, result, metadata
+    if orientation == 'index':
+        result = result.set_index('countryCode')
+    return success, result.to_dict(orient=orientation), metadata
+
+
+def build_relatable_population_index(result, metadata=None):
+    """
+    Helper function to build the index of places by population (see index_utils.NearestValueIndex) from the relatable
+    population rankings, taking the larger of the World Bank and UNFPA populations of each place.
+    """
+    populations = result[['Population - World Bank (2015)', 'Population - UNFPA (2016)']].astype(float).max(axis=1)
+    return index_utils.NearestValueIndex(populations, result['City, State, Country'])
+
+
+def find_similar_population_places(values):
+    """
+    Find the place with the closest population to each of the given values (e.g. numbers of people in need),
+    from the relatable population rankings indexed once until the file changes.
+    Returns a tuple of arrays of the places and their populations (None and NaN for missing values).
+    """
+    index = api_utils.load_data_index(constants.RELATABLE_POPULATION_FILE, 'nearest_population',
+                                      build_relatable_population_index)
+    return index.nearest(values)
@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from resources import constants
+
+
+class RateLimiter(object):
+    """
+    Limit the rate of requests made to each host to max_per_second, across all threads.
+    Requests beyond the limit are delayed (spaced out evenly) rather than rejected.
+    """
+
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second else 0
+        self._next_times = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Block until a request to the host of the given url is allowed.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            next_time = max(now, self._next_times.get(host, now))
+            self._next_times[host] = next_time + self.interval
+        delay = next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Shared by all requests to the FTS API, see `constants.FTS_MAX_REQUESTS_PER_SECOND`
+FTS_RATE_LIMITER = RateLimiter(constants.FTS_MAX_REQUESTS_PER_SECOND)
+
+# Matches the year an FTS endpoint is about, e.g. '/public/plan/year/2017' or '/public/fts/flow?year=2016'
+YEAR_PATTERN = re.compile(r'(?:/year/|[?&]year=)(\d{4})', re.IGNORECASE)
+
+
+def get_cache_ttl(url):
+    """
+    Return how long (in seconds) a cached response for the given FTS url can be used without revalidating it,
+    see `constants.FTS_CACHE_TTL` and `constants.FTS_CACHE_CLOSED_YEAR_TTL`.
+    """
+    match = YEAR_PATTERN.search(url)
+    if match and int(match.group(1)) < constants.FTS_APPEAL_YEAR:
+        return constants.FTS_CACHE_CLOSED_YEAR_TTL
+    return constants.FTS_CACHE_TTL
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of decoded json responses, keyed by url, with one json file per url in cache_dir.
+    Each entry records the url, the response ETag and Last-Modified headers (to revalidate it),
+    when it was last fetched or revalidated, and the decoded json data.
+    Entries are written to a temporary file then renamed, so concurrent readers never see a partial entry.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        """
+        Return the cached entry for the given url, or None if there is none (or it cannot be read).
+        """
+        try:
+            with open(self.get_path(url), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def set(self, url, entry):
+        """
+        Save the given entry for the given url.
+        """
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        path = self.get_path(url)
+        temp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(temp_path, 'w') as f:
+            json.dump(dict(entry, url=url), f)
+        os.rename(temp_path, path)
+
+    def prune(self, max_age):
+        """
+        Remove the entries (and leftover temporary files) that weren't written (fetched or revalidated) in the last
+        max_age seconds, so the cache doesn't keep the responses of urls that are no longer requested.
+        Return the number of files removed.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        oldest_time = time.time() - max_age
+        removed = 0
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                if file_name.endswith(('.json', '.tmp')) and os.path.getmtime(path) < oldest_time:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # Replaced or removed meanwhile
+                pass
+        return removed
+
+
+class FTSClient(object):
+    """
+    Client for the FTS API sharing one pooled requests Session between threads, so connections (and TLS sessions)
+    are kept alive and reused across requests.
+    Each request is rate limited per host, has a timeout, and is retried with exponential backoff on connection errors,
+    timeouts and retryable statuses (429 and 5xx, see `constants.FTS_RETRY_STATUSES`), waiting at most max_retry_delay
+    seconds before each retry.
+    Keeps timing metrics for every request made, see stats().
+    If given a ResponseCache, responses are cached on disk: a cached response is used as is until its ttl expires
+    (see get_cache_ttl), then revalidated with If-None-Match/If-Modified-Since when the API sent an ETag/Last-Modified.
+    In offline mode, only cached responses are used (regardless of their age) and no request is made,
+    so a run can be replayed against previously recorded responses.
+    Example (e.g. against a local stub server, see `scripts/check_fts_client.py`):
+      client = FTSClient(base_url='http://localhost:8000/v1', auth=None)
+      data = client.get_json('/public/plan/year/2017')['data']
+    """
+
+    def __init__(self, base_url=constants.FTS_API_BASE_URL, auth=None, timeout=constants.FTS_TIMEOUT,
+                 max_retries=constants.FTS_MAX_RETRIES, backoff=constants.FTS_RETRY_BACKOFF,
+                 max_retry_delay=constants.FTS_MAX_RETRY_DELAY, pool_size=constants.FTS_MAX_CONCURRENCY, rate_limiter=FTS_RATE_LIMITER, cache=None, offline=False):
+        self.base_url = base_url
+        self.cache = cache
+        self.offline = offline
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timings = []
+        self.cache_hits = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    def get_url(self, endpoint_str):
+        """
+        Return the full url for the given FTS endpoint_str (e.g. '/public/fts/flow?year=2017').
+        """
+        if endpoint_str.startswith('/'):
+            return self.base_url + endpoint_str
+        return '/'.join([self.base_url, endpoint_str])
+
+    def get_retry_delay(self, response, attempt):
+        """
+        Return how long to wait (in seconds) before retrying after the given attempt (starting at 0),
+        honouring a Retry-After header in seconds if the API sent one (an HTTP-date falls back to the backoff),
+        but never longer than max_retry_delay, so a long Retry-After doesn't stall the run.
+        """
+        retry_after = response.headers.get('Retry-After', '').strip() if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = self.backoff * (2 ** attempt)
+        return min(delay, self.max_retry_delay)
+
+    def get_json(self, endpoint_str):
+        """
+        Make a GET request to the given FTS endpoint_str, retrying transient failures, or use its cached response.
+        Return the decoded json response, or raise an exception (e.g. `requests.HTTPError`) if all attempts failed.
+        """
+        url = self.get_url(endpoint_str)
+        cached = self.cache.get(url) if self.cache is not None else None
+        if self.offline:
+            if cached is None:
+                raise requests.ConnectionError('No cached response for {} in offline mode'.format(url))
+            self.record_cache_hit()
+            return cached['data']
+        if cached is not None and time.time() - cached['fetched_at'] < get_cache_ttl(url):
+            self.record_cache_hit()
+            return cached['data']
+
+        headers = {}
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached is not None and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        response = self.get(url, headers)
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self.not_modified += 1
+            cached['fetched_at'] = time.time()
+            self.cache.set(url, cached)
+            return cached['data']
+        response.raise_for_status()
+        data = response.json()
+        if self.cache is not None:
+            self.cache.set(url, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched_at': time.time(),
+                'data': data
+            })
+        return data
+
+    def get(self, url, headers=None):
+        """
+        Make a GET request to the given url with the given headers, retrying transient failures.
+        Return the last response (which may still have a retryable status once all attempts are used up),
+        or raise the last connection error or timeout.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.wait(url)
+            start = time.time()
+            response = None
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(url, None, time.time() - start)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                self.record(url, response.status_code, time.time() - start)
+                if response.status_code not in constants.FTS_RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            time.sleep(self.get_retry_delay(response, attempt))
+            attempt += 1
+
+    def record(self, url, status_code, seconds):
+        with self._lock:
+            self.timings.append((url, status_code, seconds))
+
+    def record_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def stats(self):
+        """
+        Return a json-friendly summary of the requests made: counts by status (None for connection errors and timeouts),
+        total/mean/max request time in seconds, and how many responses were used from the cache without a request
+        (cache_hits) or after revalidating them (not_modified).
+        """
+        with self._lock:
+            timings = list(self.timings)
+            cache_hits, not_modified = self.cache_hits, self.not_modified
+        by_status = {}
+        for _, status_code, _ in timings:
+            by_status[status_code] = by_status.get(status_code, 0) + 1
+        seconds = [timing[2] for timing in timings]
+        return {
+            'requests': len(timings),
+            'by_status': by_status,
+            'total_seconds': sum(seconds),
+            'mean_seconds': sum(seconds) / len(seconds) if seconds else 0,
+            'max_seconds': max(seconds) if seconds else 0,
+            'cache_hits': cache_hits,
+            'not_modified': not_modified
+        }
+
+
+_fts_client = None
+_fts_client_lock = threading.Lock()
+
+
+def get_fts_client():
+    """
+    Return the shared FTSClient, created on first use with the FTS credentials from `resources/secrets.py`
+    and the on-disk response cache in `constants.FTS_CACHE_PATH`.
+    """
+    global _fts_client
+    with _fts_client_lock:
+        if _fts_client is None:
+            _fts_client = FTSClient(auth=(constants.FTS_CLIENT_ID, constants.FTS_CLIENT_PASSWORD),
+                                    cache=ResponseCache(constants.FTS_CACHE_PATH))
+    return _fts_client
+
+
+def ordered_map(fn, items, max_workers=constants.FTS_MAX_CONCURRENCY):
+    """
+    Apply fn to each of the given items concurrently, using a pool of at most max_workers threads.
+    Return the list of results in the same order as the items, so the output is deterministic regardless of which
+    requests finish first. If any call raises an exception, it is raised here once the pool stops.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
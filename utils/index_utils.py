@@ -0,0 +1,347 @@
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from fuzzywuzzy import fuzz, utils as fuzz_utils
+
+from resources import constants
+from utils import cache_utils
+
+
+EMPTY_POSITIONS = np.array([], dtype=np.int64)
+
+
+def normalize_key(value):
+    """
+    Normalize an index key (or a query value looked up in an index) so that lookups are case and whitespace insensitive,
+    and numbers match regardless of type (e.g. the year 2017 and the query string '2017').
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return u'{}'.format(value).strip().lower()
+
+
+def build_column_index(series):
+    """
+    Build a hash index on the given pandas series (column), mapping each normalized value to the sorted array of
+    row positions where it appears. Null values are not indexed.
+    """
+    keys = series.map(lambda value: normalize_key(value) if value is not None and value == value else None)
+    positions = pd.Series(np.arange(len(series)), index=series.index)[keys.notnull()]
+    return dict((key, group.values) for key, group in positions.groupby(keys[keys.notnull()]))
+
+
+def build_group_records(df, column, columns):
+    """
+    Group the rows of the given dataframe by the given column, and convert the given columns of each group to a list of
+    records (dicts), in row order. Return a dict mapping each normalized value of the column (see normalize_key) to a
+    tuple of the value and the records of its group. Null values are not grouped.
+    """
+    return dict((normalize_key(value), (value, group.to_dict(orient='records')))
+                for value, group in df[columns].groupby(df[column]))
+
+
+class DataIndex(object):
+    """
+    Hash indexes on some columns of a dataframe (see build_column_index), plus an optional date index for range queries
+    and optional records of some columns grouped by a column (see build_group_records),
+    built once when the dataset is loaded so that filtered requests only touch the matching rows.
+    Note: the indexed dataframe must not be modified, as the indexes refer to its row positions.
+    """
+
+    def __init__(self, df, columns, date_column=None, date_format=None, group_column=None, group_columns=None):
+        self.df = df
+        self.columns = dict((column, build_column_index(df[column])) for column in columns)
+        self.group_records = build_group_records(df, group_column, group_columns) if group_column else None
+        self.date_positions = None
+        self.sorted_dates = None
+        if date_column:
+            dates = pd.to_datetime(df[date_column], format=date_format, errors='coerce').values
+            order = np.argsort(dates, kind='mergesort')
+            valid = ~pd.isnull(dates[order])
+            self.date_positions = order[valid]
+            self.sorted_dates = dates[order][valid]
+
+    def lookup(self, column, values):
+        """
+        Return the sorted array of row positions where the given column has any of the given values.
+        """
+        index = self.columns[column]
+        matches = [index.get(normalize_key(value), EMPTY_POSITIONS) for value in values]
+        if len(matches) == 1:
+            return matches[0]
+        return np.unique(np.concatenate(matches))
+
+    def lookup_date_range(self, start_date=None, end_date=None):
+        """
+        Return the sorted array of row positions with a date between the given start_date and end_date (inclusive).
+        """
+        start = np.searchsorted(self.sorted_dates, np.datetime64(start_date), 'left') if start_date else 0
+        end = np.searchsorted(self.sorted_dates, np.datetime64(end_date), 'right') if end_date else len(self.sorted_dates)
+        return np.sort(self.date_positions[start:end])
+
+    def positions(self, filters=None, start_date=None, end_date=None):
+        """
+        Return the sorted array of row positions matching all the given filters, where filters maps each indexed column
+        to a list of accepted values, and start_date/end_date optionally bound the indexed date column.
+        """
+        matches = [self.lookup(column, values) for column, values in (filters or {}).items()]
+        if start_date or end_date:
+            matches.append(self.lookup_date_range(start_date, end_date))
+        if not matches:
+            return np.arange(len(self.df))
+        result = matches[0]
+        for match in matches[1:]:
+            result = np.intersect1d(result, match, assume_unique=True)
+        return result
+
+    def select(self, positions, columns=None):
+        """
+        Return the rows of the indexed dataframe at the given positions, optionally projected onto the given columns.
+        """
+        df = self.df if columns is None else self.df[columns]
+        return df.iloc[positions]
+
+    def records_by_group(self, values=None):
+        """
+        Return a dict mapping each value of the group column to the records of its group,
+        optionally only for the given values (ignoring values without any rows).
+        """
+        if values is None:
+            return dict(self.group_records.values())
+        groups = [self.group_records.get(normalize_key(value)) for value in values]
+        return dict(group for group in groups if group is not None)
+
+    def nbytes(self):
+        """
+        Return the approximate memory used by the indexes and grouped records (not including the indexed dataframe) in bytes.
+        """
+        size = sum(positions.nbytes for index in self.columns.values() for positions in index.values())
+        if self.date_positions is not None:
+            size += self.date_positions.nbytes + self.sorted_dates.nbytes
+        if self.group_records is not None:
+            # Each record is a dict of its own values, keyed by the column names shared by all the records
+            for _, records in self.group_records.values():
+                size += sys.getsizeof(records)
+                for record in records:
+                    size += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record.values())
+        return size
+
+
+class NearestValueIndex(object):
+    """
+    Sorted array of numeric values (e.g. the populations of places) with a label for each, to find the closest value
+    to many reference values at once with a binary search, rather than scanning every value for each of them.
+    Rows with a missing value or label are not indexed.
+    """
+
+    def __init__(self, values, labels):
+        values = np.asarray(values, dtype=np.float64)
+        labels = np.asarray(labels, dtype=object)
+        valid = ~np.isnan(values) & ~pd.isnull(labels)
+        positions = np.flatnonzero(valid)
+        order = np.argsort(values[valid], kind='mergesort')  # Stable, so equal values stay in their original order
+        self.positions = positions[order]
+        self.values = values[valid][order]
+        self.labels = labels[valid][order]
+
+    def nearest(self, reference_values):
+        """
+        Return a tuple of arrays of the labels and values closest to each of the given reference_values, where ties go
+        to whichever was first in the original order. Missing (None or NaN) reference values get a None label and a
+        NaN value.
+        """
+        reference = np.asarray(reference_values, dtype=np.float64).ravel()
+        labels = np.empty(len(reference), dtype=object)
+        values = np.full(len(reference), np.nan)
+        found = ~np.isnan(reference)
+        if not len(self.values) or not found.any():
+            return labels, values
+        reference = reference[found]
+        last = len(self.values) - 1
+        right = np.searchsorted(self.values, reference, 'left').clip(max=last)
+        right = np.searchsorted(self.values, self.values[right], 'left')
+        left = np.searchsorted(self.values, self.values[(right - 1).clip(min=0)], 'left')
+        left_distance = np.where(right > 0, np.abs(reference - self.values[left]), np.inf)
+        right_distance = np.abs(reference - self.values[right])
+        use_left = (left_distance < right_distance) | (
+            (left_distance == right_distance) & (self.positions[left] < self.positions[right]))
+        nearest = np.where(use_left, left, right)
+        labels[found] = self.labels[nearest]
+        values[found] = self.values[nearest]
+        return labels, values
+
+    def nbytes(self):
+        """
+        Return the approximate memory used by the index in bytes.
+        """
+        return self.positions.nbytes + self.values.nbytes + self.labels.nbytes + sum(
+            sys.getsizeof(label) for label in self.labels)
+
+
+def get_trigrams(processed):
+    """
+    Return the set of trigrams of the given processed string (see `fuzzywuzzy.utils.full_process`), padded with spaces so
+    that short strings and word boundaries also have trigrams.
+    """
+    padded = u'  {} '.format(processed)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def get_profile(processed):
+    """
+    Return what's needed to bound the match ratios of the given processed string (see get_wratio_bound), i.e. its
+    character counts, its set of tokens, and its tokens sorted and joined (as for WRatio's token sort and token set
+    ratios) with their character counts.
+    """
+    tokens = processed.split()
+    sorted_tokens = u' '.join(sorted(tokens))
+    sorted_token_set = u' '.join(sorted(set(tokens)))
+    return (processed, Counter(processed), set(tokens), sorted_tokens, Counter(sorted_tokens),
+            sorted_token_set, Counter(sorted_token_set))
+
+
+def get_ratio_bound(counts1, length1, counts2, length2, partial=False):
+    """
+    Return an upper bound of `fuzz.ratio` (or `fuzz.partial_ratio` if partial) divided by 100, of two strings with the
+    given character counts and lengths: their SequenceMatcher (or that of a window of the longer string the length of
+    the shorter one) can't match more characters than they have in common.
+    """
+    if not length1 or not length2:
+        return 0
+    if len(counts1) > len(counts2):
+        counts1, counts2 = counts2, counts1
+    common = sum(min(count, counts2[char]) for char, count in counts1.items() if char in counts2)
+    if partial:
+        shorter = min(length1, length2)
+        common = min(common, shorter)
+        return 2.0 * common / (shorter + common) if common else 0
+    return 2.0 * common / (length1 + length2)
+
+
+def get_wratio_bound(profile1, profile2):
+    """
+    Return an upper bound of `fuzz.WRatio` of two processed strings with the given profiles (see get_profile), following
+    the same steps as WRatio but bounding each ratio it takes (see get_ratio_bound), plus 1 to allow for rounding.
+    """
+    p1, counts1, tokens1, sorted1, sorted_counts1, set_sorted1, set_sorted_counts1 = profile1
+    p2, counts2, tokens2, sorted2, sorted_counts2, set_sorted2, set_sorted_counts2 = profile2
+    if not p1 or not p2:
+        return 0
+    len_ratio = float(max(len(p1), len(p2))) / min(len(p1), len(p2))
+    partial = len_ratio >= 1.5
+    partial_scale = .6 if len_ratio > 8 else .9
+    token_bound = get_ratio_bound(sorted_counts1, len(sorted1), sorted_counts2, len(sorted2), partial)
+    intersection = tokens1 & tokens2
+    if intersection:
+        sorted_sect = u' '.join(sorted(intersection))
+        combined_1to2 = u'{} {}'.format(sorted_sect, u' '.join(sorted(tokens1 - intersection))).strip()
+        combined_2to1 = u'{} {}'.format(sorted_sect, u' '.join(sorted(tokens2 - intersection))).strip()
+        sect_counts, counts_1to2, counts_2to1 = Counter(sorted_sect), Counter(combined_1to2), Counter(combined_2to1)
+        token_bound = max(token_bound,
+                          get_ratio_bound(sect_counts, len(sorted_sect), counts_1to2, len(combined_1to2), partial),
+                          get_ratio_bound(sect_counts, len(sorted_sect), counts_2to1, len(combined_2to1), partial),
+                          get_ratio_bound(counts_1to2, len(combined_1to2), counts_2to1, len(combined_2to1), partial))
+    else:
+        # Without common tokens, the token set ratio only compares the two sorted sets of tokens
+        token_bound = max(token_bound, get_ratio_bound(set_sorted_counts1, len(set_sorted1),
+                                                       set_sorted_counts2, len(set_sorted2), partial))
+    base_bound = get_ratio_bound(counts1, len(p1), counts2, len(p2))
+    if partial:
+        bound = max(base_bound, get_ratio_bound(counts1, len(p1), counts2, len(p2), True) * partial_scale,
+                    token_bound * .95 * partial_scale)
+    else:
+        bound = max(base_bound, token_bound * .95)
+    return 100 * bound + 1
+
+
+class FuzzyMatcher(object):
+    """
+    Resolve a (possibly misspelled) query to the closest of the given values (e.g. country names), giving the same best
+    match as `fuzzywuzzy.process.extractOne(query, set(values))` (see `data_utils.fuzzy_filter`), but with the values
+    processed and indexed once:
+    - a query equal to a value (ignoring case and punctuation, i.e. a perfect score) or to one of the given aliases
+      (e.g. ISO-3 codes, mapping each alias to its value) is looked up directly,
+    - otherwise the values sharing the most trigrams with the query are scored first (with fuzzywuzzy's WRatio), then
+      only the other values whose score could still reach the best one (see get_wratio_bound) are scored,
+    - and the matches of past queries are memoized, up to `constants.FUZZY_MATCH_MEMO_MAX_BYTES`.
+    """
+
+    def __init__(self, values, aliases=None, max_candidates=constants.FUZZY_MATCH_CANDIDATES):
+        # Same order as iterating over set(values), so ties between equal scores are broken the same way as extractOne
+        self.choices = list(set(values))
+        self.processed = [fuzz_utils.full_process(choice, force_ascii=True) for choice in self.choices]
+        self.profiles = [get_profile(processed) for processed in self.processed]
+        self.exact = {}
+        for position, processed in enumerate(self.processed):
+            self.exact.setdefault(processed, position)
+        positions = dict((choice, position) for position, choice in enumerate(self.choices))
+        self.aliases = dict((normalize_key(alias), positions[value]) for alias, value in (aliases or {}).items()
+                            if alias is not None and value in positions)
+        self.trigrams = {}
+        self.trigram_counts = []
+        for position, processed in enumerate(self.processed):
+            trigrams = get_trigrams(processed)
+            self.trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                self.trigrams.setdefault(trigram, []).append(position)
+        self.max_candidates = max_candidates
+        self.memo = cache_utils.LRUCache(constants.FUZZY_MATCH_MEMO_MAX_BYTES)
+
+    def get_candidates(self, processed_query):
+        """
+        Return the positions of the values sharing the most trigrams with the given processed query (relative to the
+        length of the shorter of the two, as WRatio favours partial matches when lengths differ), best first.
+        """
+        query_trigrams = get_trigrams(processed_query)
+        shared = {}
+        for trigram in query_trigrams:
+            for position in self.trigrams.get(trigram, []):
+                shared[position] = shared.get(position, 0) + 1
+        def similarity(position):
+            return float(shared[position]) / min(len(query_trigrams), self.trigram_counts[position])
+        return sorted(shared, key=lambda position: (-similarity(position), position))[:self.max_candidates]
+
+    def match(self, query):
+        """
+        Return a tuple of the value closest to the given query and its match ratio (0-100), or (None, 0) if there are no values.
+        """
+        result = self.memo.get(query)
+        if result is None:
+            result = self.find_match(query)
+            self.memo.set(query, result, sys.getsizeof(query) + sys.getsizeof(result))
+        return result
+
+    def find_match(self, query):
+        if not self.choices:
+            return None, 0
+        # Same processing of the query as extractOne
+        processed_query = fuzz_utils.full_process(query)
+        key = fuzz_utils.full_process(processed_query, force_ascii=True)
+        if not key:
+            return self.choices[0], 0
+        if key in self.exact:
+            return self.choices[self.exact[key]], 100
+        alias = normalize_key(query)
+        if alias in self.aliases:
+            choice = self.choices[self.aliases[alias]]
+            return choice, fuzz.WRatio(processed_query, choice)
+        ratios = dict((position, fuzz.WRatio(processed_query, self.processed[position]))
+                      for position in self.get_candidates(key))
+        best_ratio = max(ratios.values()) if ratios else 0
+        query_profile = get_profile(key)
+        for position, profile in enumerate(self.profiles):
+            if position not in ratios and get_wratio_bound(query_profile, profile) >= best_ratio:
+                ratios[position] = fuzz.WRatio(processed_query, self.processed[position])
+        best_ratio = max(ratios.values())
+        # Like extractOne, ties go to the first of the values
+        best_position = min(position for position, ratio in ratios.items() if ratio == best_ratio)
+        return self.choices[best_position], best_ratio
+
+    def nbytes(self):
+        """
+        Return the approximate memory used by the matcher (not including memoized matches) in bytes.
+        """
+        size = sum(sys.getsizeof(processed) for processed in self.processed)
+        return size + sum(8 * len(positions) for positions in self.trigrams.values())
@@ -0,0 +1,136 @@
+import os
+import errno
+import shutil
+import filecmp
+from datetime import datetime
+
+from resources import constants
+
+
+"""
+Versioned publishing of the derived data served by the API.
+Each ETL run writes its files into a new staging directory, which is published as an immutable version directory under
+`constants.DERIVED_VERSIONS_PATH` by atomically repointing the `constants.CURRENT_DERIVED_DATA_PATH` symlink to it.
+API workers always read the derived data through that symlink, so a request never sees a half-written file, and files
+that didn't change keep their inode (they are hardlinked between versions), so workers keep what they already cached.
+"""
+
+
+def get_published_data_path():
+    """
+    Return the directory of the derived data currently served by the API: the current published version (through its
+    symlink, so the paths of the files stay the same across versions), or the example derived data if no version
+    was published yet.
+    """
+    if os.path.isdir(constants.CURRENT_DERIVED_DATA_PATH):
+        return constants.CURRENT_DERIVED_DATA_PATH
+    return constants.EXAMPLE_DERIVED_DATA_PATH
+
+
+def link_or_copy(source_path, target_path, link=True):
+    """
+    Hardlink the given source file to the given target path (keeping its inode and modification time, and so its
+    file signature), or copy it (with its modification time) if link is False or hardlinks aren't supported.
+    """
+    if link:
+        try:
+            os.link(source_path, target_path)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(source_path, target_path)
+
+
+def swap_symlink(link_path, target_path):
+    """
+    Atomically (re)point the symlink at the given link_path to the given target_path, relative to the link's directory.
+    """
+    temp_path = link_path + '.tmp'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(os.path.relpath(target_path, os.path.dirname(link_path)), temp_path)
+    os.rename(temp_path, link_path)
+
+
+def prune_versions(keep=constants.DERIVED_VERSIONS_KEPT):
+    """
+    Remove the oldest published versions, keeping the given number of most recent ones (and always the current one).
+    Workers still reading files of a removed version are unaffected, as the files are only deleted once closed.
+    Return the list of version directories removed.
+    """
+    current_path = os.path.realpath(constants.CURRENT_DERIVED_DATA_PATH)
+    versions = sorted(version for version in os.listdir(constants.DERIVED_VERSIONS_PATH) if not version.startswith('.'))
+    removed = []
+    for version in versions[:-keep] if keep else versions:
+        version_path = os.path.join(constants.DERIVED_VERSIONS_PATH, version)
+        if os.path.realpath(version_path) != current_path:
+            shutil.rmtree(version_path)
+            removed.append(version_path)
+    return removed
+
+
+class Publication(object):
+    """
+    A new version of the derived data, published when the with block it's used in completes without error
+    (and discarded otherwise, leaving the current version as it was). For example:
+      with publish_utils.Publication() as publication:
+          df.to_csv(publication.path('funding_progress.csv'), index=False)
+    Files of the current version that aren't written again are carried over, and files that are written again
+    with the same contents are replaced by the current ones, both as hardlinks so they keep their file signature.
+    Files are only ever written into the staging directory, so the hardlinked files of published versions are
+    never modified in place. Publications are expected to run one at a time (e.g. the data scripts run by `update.py`).
+    """
+
+    def __init__(self):
+        self.version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+        self.version_path = os.path.join(constants.DERIVED_VERSIONS_PATH, self.version)
+        self.staging_path = os.path.join(constants.DERIVED_VERSIONS_PATH, '.staging-{}'.format(self.version))
+        self.base_path = None
+
+    def __enter__(self):
+        self.base_path = os.path.realpath(get_published_data_path())
+        os.makedirs(self.staging_path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.publish()
+        else:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+        return False
+
+    def path(self, file_name):
+        """
+        Return the path to write the given derived data file_name to in this version.
+        """
+        return os.path.join(self.staging_path, file_name)
+
+    def carry_over(self):
+        """
+        Hardlink the files of the base version (the one published when this one was started) into the staging
+        directory, unless they were written again with different contents.
+        Files of the example derived data are copied instead, as they aren't immutable (e.g. they're updated by git).
+        """
+        link = os.path.dirname(self.base_path) == os.path.realpath(constants.DERIVED_VERSIONS_PATH)
+        for file_name in os.listdir(self.base_path):
+            base_file_path = os.path.join(self.base_path, file_name)
+            if not os.path.isfile(base_file_path):
+                continue
+            file_path = self.path(file_name)
+            if os.path.exists(file_path):
+                if not link or not filecmp.cmp(base_file_path, file_path, shallow=False):
+                    continue
+                os.remove(file_path)
+            link_or_copy(base_file_path, file_path, link)
+
+    def publish(self):
+        """
+        Complete the staging directory with the files carried over from the base version, move it to its version
+        directory and make it the current version, then prune the oldest versions.
+        """
+        self.carry_over()
+        os.rename(self.staging_path, self.version_path)
+        swap_symlink(constants.CURRENT_DERIVED_DATA_PATH, self.version_path)
+        print 'Published derived data version {}'.format(self.version)
+        prune_versions()
@@ -0,0 +1,206 @@
+import json
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+import numpy as np
+from flask import request, Response
+
+from resources import constants
+from utils import api_utils, cache_utils
+
+
+# Per-worker cache of fully serialized endpoint responses, keyed by request and dataset version
+RESPONSE_CACHE = cache_utils.LRUCache(constants.RESPONSE_CACHE_MAX_BYTES)
+
+# Per-worker cache of raw derived file contents served as-is, along with their content hash
+FILE_RESPONSE_CACHE = cache_utils.FileCache(constants.RESPONSE_CACHE_MAX_BYTES)
+
+
+def get_dataset_version(data_files):
+    """
+    Return the combined version of the given derived data_files (a tuple of their file signatures).
+    Any rewrite of one of the files, e.g. by the nightly `update.py` run, results in a new version.
+    """
+    return tuple(cache_utils.file_signature(api_utils.get_data_file_path(data_file)) for data_file in data_files)
+
+
+def get_accepted_encodings(available_encodings):
+    """
+    Return the content encodings accepted by the current request (via Accept-Encoding) out of the given
+    available_encodings, in order of our preference (see `constants.CONTENT_ENCODINGS`).
+    """
+    return [encoding for encoding in available_encodings if request.accept_encodings[encoding]]
+
+
+def cache_response(*data_files):
+    """
+    Decorator for endpoints whose output depends only on the url, the query args and the given derived data_files.
+    The first successful (200) response for each (endpoint, url args, query args, dataset version) is kept as
+    serialized bytes, so following identical requests skip loading, filtering and serializing the data entirely.
+    Nothing is compressed at request time (only the pre-compressed variants of derived files are served compressed,
+    see send_data_file). Error responses and streamed responses (see send_table) are never cached.
+    Example:
+      @cache_response('fsi_2017.csv')
+      def get_fragile_state_index(orientation): ...
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                version = get_dataset_version(data_files)
+            except OSError:
+                # Missing data file, let the endpoint report the error
+                return fn(*args, **kwargs)
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))), version)
+            cached = RESPONSE_CACHE.get(key)
+            if cached is None:
+                response = fn(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                headers = [(name, value) for name, value in response.headers if name not in ('Content-Type', 'Content-Length')]
+                cached = (body, response.mimetype, headers)
+                RESPONSE_CACHE.set(key, cached, len(body))
+            body, mimetype, headers = cached
+            response = Response(body, mimetype=mimetype)
+            response.headers.extend(headers)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_file_sibling_path(file_path, extension):
+    """
+    Return the path of the sibling of the given file with the given extension (e.g. a pre-compressed variant),
+    or None if it doesn't exist or is older than the file itself (i.e. left over from a previous version).
+    """
+    sibling_path = file_path + extension
+    try:
+        if cache_utils.file_signature(sibling_path)[1] >= cache_utils.file_signature(file_path)[1]:
+            return sibling_path
+    except OSError:
+        pass
+    return None
+
+
+def get_file_variant_path(file_path, encoding):
+    """
+    Return the path of the pre-compressed variant of the given file for the given content encoding,
+    or None if it doesn't exist or is out of date (see get_file_sibling_path).
+    """
+    return get_file_sibling_path(file_path, constants.COMPRESSED_FILE_EXTENSIONS[encoding])
+
+
+def read_file_response(file_path):
+    """
+    Read the file at the given file_path as bytes for serving it as-is.
+    Return a tuple of the file contents, its strong ETag (sha1 of the contents, as published with the file by
+    `data_utils.write_content_hash` if it's up to date) and its last modified (UTC) datetime.
+    """
+    with open(file_path, 'rb') as data_file:
+        body = data_file.read()
+    hash_path = get_file_sibling_path(file_path, constants.CONTENT_HASH_FILE_EXTENSION)
+    if hash_path:
+        with open(hash_path, 'r') as hash_file:
+            etag = hash_file.read().strip()
+    else:
+        etag = hashlib.sha1(body).hexdigest()
+    last_modified = datetime.utcfromtimestamp(cache_utils.file_signature(file_path)[1])
+    return body, etag, last_modified
+
+
+def send_data_file(data_file, data_description, mimetype, download_name=None):
+    """
+    Respond with the given derived data_file as stored on disk, without parsing and re-serializing it.
+    Sets a strong ETag and Last-Modified, and answers with a 304 Not Modified when the client already has this version
+    (If-None-Match / If-Modified-Since), so polling clients only download the file when it actually changes.
+    Range requests are answered with a 206 Partial Content, so interrupted downloads can be resumed.
+    If the ETL wrote pre-compressed variants of the file (see `data_utils.write_compressed_variants`), the preferred
+    one accepted by the client is sent instead, so nothing is compressed at request time.
+    If a download_name is given, the file is sent as an attachment with that file name.
+    """
+    file_path = api_utils.get_data_file_path(data_file)
+    try:
+        body, etag, last_modified = FILE_RESPONSE_CACHE.get(file_path, read_file_response)
+    except Exception as e:
+        return 'Error: No {} data was found ({})'.format(data_description, e), 501
+    if not body:
+        return 'Error: No {} data was found (empty file)'.format(data_description), 501
+    response = Response(body, mimetype=mimetype)
+    for encoding in get_accepted_encodings(constants.CONTENT_ENCODINGS):
+        variant_path = get_file_variant_path(file_path, encoding)
+        if variant_path:
+            # Each encoded variant has its own strong ETag, as required for different representations
+            body, etag, _ = FILE_RESPONSE_CACHE.get(variant_path, read_file_response)
+            response = Response(body, mimetype=mimetype)
+            response.content_encoding = encoding
+            break
+    response.vary.add('Accept-Encoding')
+    if download_name:
+        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(download_name)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
+
+def get_export_format():
+    """
+    Return the format requested with the format query arg to stream tabular data in (see `constants.EXPORT_FORMATS`),
+    or None if there is none (i.e. for the usual json response).
+    Raise a ValueError if the format isn't supported.
+    """
+    export_format = request.args.get('format', None)
+    if not export_format:
+        return None
+    export_format = export_format.strip().lower()
+    if export_format not in constants.EXPORT_FORMATS:
+        raise ValueError('Unsupported format {}, use one of: {}'.format(export_format, ', '.join(sorted(constants.EXPORT_FORMATS))))
+    return export_format
+
+
+def to_json_value(value):
+    """
+    Convert numpy scalars (e.g. numpy.bool_) that the json module can't serialize to the equivalent python value.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def iter_csv_chunks(df, chunk_rows=constants.EXPORT_CHUNK_ROWS):
+    """
+    Serialize the given dataframe as csv (with a header row, without the index) chunk_rows rows at a time,
+    yielding the utf-8 encoded bytes of each chunk.
+    """
+    for start in xrange(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_csv(index=False, header=(start == 0), encoding='utf-8')
+        yield chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+
+
+def iter_ndjson_chunks(df, chunk_rows=constants.EXPORT_CHUNK_ROWS):
+    """
+    Serialize the given dataframe as newline delimited json (one object per row, with the columns in order, and null
+    for missing values) chunk_rows rows at a time, yielding the bytes of each chunk.
+    """
+    columns = df.columns.tolist()
+    for start in xrange(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].astype(object)
+        rows = chunk.where(chunk.notnull(), None).itertuples(index=False, name=None)
+        yield ''.join(json.dumps(OrderedDict(zip(columns, row)), default=to_json_value) + '\n' for row in rows)
+
+
+def send_table(df, file_name, export_format):
+    """
+    Respond with the given dataframe as an attachment named after file_name in the given export_format (csv or ndjson),
+    streamed in chunks (see iter_csv_chunks and iter_ndjson_chunks) so the whole serialized table is never held in memory
+    however big it is.
+    """
+    if export_format == 'csv':
+        chunks = iter_csv_chunks(df)
+    else:
+        chunks = iter_ndjson_chunks(df)
+    response = Response(chunks, mimetype=constants.EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(file_name, export_format)
+    return response
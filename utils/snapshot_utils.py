@@ -0,0 +1,117 @@
+import os
+import errno
+import shutil
+import threading
+
+from resources import constants
+from utils import data_utils, publish_utils
+
+
+"""
+Content-addressed storage of the raw data snapshots (the dated raw data directories and the latest raw data directory).
+Each distinct raw file is stored once under `constants.RAW_OBJECTS_PATH`, named by its content hash, and the files of
+the snapshot directories are hardlinks to it, so a daily run only takes disk space for the files that changed, and
+updating the latest directory only touches the files that changed.
+Stored files are shared between snapshots, so they must never be modified in place: files are only ever replaced
+(written to a temporary file that is renamed over them).
+"""
+
+
+def get_object_path(content_hash, store_path=constants.RAW_OBJECTS_PATH):
+    """
+    Return the path of the stored file with the given content hash, e.g. `objects/3f/3f786850e387550fdab836ed7e6dc881de23001b`.
+    """
+    return os.path.join(store_path, content_hash[:2], content_hash)
+
+
+def get_temp_path(file_path):
+    """
+    Return the path of a temporary file to replace the given file_path with, unique to the current process and thread
+    (files are downloaded and stored concurrently).
+    """
+    return '{}.{}.{}.tmp'.format(file_path, os.getpid(), threading.current_thread().ident)
+
+
+def replace_with_link(object_path, file_path):
+    """
+    Atomically replace the given file_path (if it exists) with a hardlink to the given stored file (or a copy of it if
+    hardlinks aren't supported), unless it already is one.
+    Return whether the file_path was replaced.
+    """
+    if os.path.exists(file_path) and os.path.samefile(object_path, file_path):
+        return False
+    temp_path = get_temp_path(file_path)
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    publish_utils.link_or_copy(object_path, temp_path)
+    os.rename(temp_path, file_path)
+    return True
+
+
+def store_file(file_path, store_path=constants.RAW_OBJECTS_PATH):
+    """
+    Add the given file to the store, and make it a hardlink to the stored file with the same contents if there already
+    is one (so identical files of different snapshots take disk space only once).
+    Return the path of the stored file.
+    """
+    object_path = get_object_path(data_utils.get_content_hash(file_path), store_path)
+    data_utils.safely_mkdir(os.path.dirname(object_path))
+    if not os.path.exists(object_path):
+        try:
+            os.link(file_path, object_path)
+            return object_path
+        except OSError as error:
+            # Stored meanwhile (e.g. by another download with the same contents), or hardlinks aren't supported
+            if error.errno != errno.EEXIST:
+                shutil.copy2(file_path, object_path)
+    replace_with_link(object_path, file_path)
+    return object_path
+
+
+def store_directory(dir_path, store_path=constants.RAW_OBJECTS_PATH):
+    """
+    Add all the files of the given snapshot directory to the store (see store_file).
+    Return a dict of the paths of the stored files by file name.
+    """
+    return dict((file_name, store_file(os.path.join(dir_path, file_name), store_path))
+                for file_name in sorted(os.listdir(dir_path)) if os.path.isfile(os.path.join(dir_path, file_name)))
+
+
+def update_snapshot(source_path, target_path):
+    """
+    Update the given target snapshot directory (e.g. the latest raw data directory) with the files of the given source
+    snapshot directory, hardlinking each file that isn't already the same file (inode) in the target directory, so only
+    the files that changed are touched. Files of the target directory that aren't in the source one are kept.
+    Return the list of file names updated.
+    """
+    data_utils.safely_mkdir(target_path)
+    updated = []
+    for file_name in sorted(os.listdir(source_path)):
+        source_file_path = os.path.join(source_path, file_name)
+        if os.path.isfile(source_file_path) and replace_with_link(source_file_path, os.path.join(target_path, file_name)):
+            updated.append(file_name)
+    return updated
+
+
+def unshare_file(file_path):
+    """
+    Replace the given file with a private copy if it's shared with other snapshots (a hardlink to a stored file), so it
+    can be written in place (e.g. by a download) without modifying the other snapshots.
+    Return whether the file was copied.
+    """
+    if not os.path.isfile(file_path) or os.stat(file_path).st_nlink <= 1:
+        return False
+    temp_path = get_temp_path(file_path)
+    shutil.copy2(file_path, temp_path)
+    os.rename(temp_path, file_path)
+    return True
+
+
+def unshare_directory(dir_path):
+    """
+    Replace the files of the given snapshot directory that are shared with other snapshots with private copies (see
+    unshare_file), e.g. before the data is downloaded again into an existing dated directory on the same day.
+    Return the list of file names copied.
+    """
+    return [file_name for file_name in sorted(os.listdir(dir_path))
+            if unshare_file(os.path.join(dir_path, file_name))]